@@ -20,10 +20,10 @@ from django.conf import settings
 from ebdata.blobs.auto_purge import page_should_be_purged
 from ebdata.blobs.models import Page
 from ebdata.nlp.addresses import parse_addresses
+from ebdata.nlp.gazetteer import gazetteer
 from ebpub.db.models import NewsItem, SchemaField, Lookup
 from ebpub.geocoder import SmartGeocoder, AmbiguousResult, DoesNotExist, InvalidBlockButValidStreet
-from ebpub.geocoder.parser.parsing import normalize, ParsingError
-from ebpub.streets.models import Suburb
+from ebpub.geocoder.parser.parsing import ParsingError
 from ebpub.utils.text import slugify, smart_excerpt
 import datetime
 import time
@@ -152,7 +152,7 @@ def auto_locations(paragraph_list, default_city=''):
     for para in paragraph_list:
         for addy, city in parse_addresses(para):
             # Skip addresses if they have a city that's a known suburb.
-            if city and Suburb.objects.filter(normalized_name=normalize(city)).count():
+            if city and gazetteer.is_suburb(city):
                 report.append('got suburb "%s, %s"' % (addy, city))
                 continue
 
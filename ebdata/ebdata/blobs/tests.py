@@ -0,0 +1,191 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import django.test
+import mock
+import threading
+import time
+import unittest
+
+
+class StubRetriever(object):
+    """Stands in for a Retriever; crawl() only clones it."""
+
+    host_limiter = None
+
+    def clone(self):
+        return StubRetriever()
+
+
+class StubSeed(object):
+
+    def __init__(self, i, host='example.com', delay=0):
+        self.url = 'http://%s/feed%d.rss' % (host, i)
+        self.base_url = 'http://%s/' % host
+        self.delay = delay
+
+
+class CrawlRecorder(object):
+    """
+    Stands in for FeedUpdater, recording which seeds were updated and
+    how many updates were running at once, per host and in total.
+    """
+
+    def __init__(self, wait_for=1, fail_urls=()):
+        self.lock = threading.Lock()
+        self.updated = []
+        self.retrievers = []
+        self.running = 0
+        self.max_running = 0
+        self.running_per_host = {}
+        self.max_per_host = 0
+        self.wait_for = wait_for
+        self.fail_urls = fail_urls
+
+    def __call__(self, seed, retriever, logger, geotag_queue=None):
+        recorder = self
+        class Updater(object):
+            def update(self):
+                recorder.update(seed, retriever, geotag_queue)
+        return Updater()
+
+    def update(self, seed, retriever, geotag_queue):
+        limiter = retriever.host_limiter
+        limiter.acquire(seed.url)
+        try:
+            with self.lock:
+                self.retrievers.append(retriever)
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                host = seed.base_url
+                self.running_per_host[host] = self.running_per_host.get(host, 0) + 1
+                self.max_per_host = max(self.max_per_host, self.running_per_host[host])
+            # Give the other workers a chance to start.
+            deadline = time.time() + 0.2
+            while self.running < self.wait_for and time.time() < deadline:
+                time.sleep(0.01)
+            geotag_queue.put(seed.url)
+            with self.lock:
+                self.updated.append(seed.url)
+                self.running -= 1
+                self.running_per_host[host] -= 1
+        finally:
+            limiter.release(seed.url)
+        if seed.url in self.fail_urls:
+            raise ValueError('oops')
+
+
+@mock.patch('ebdata.blobs.update_feeds.save_locations_for_page')
+class TestCrawl(unittest.TestCase):
+
+    def _crawl(self, seeds, recorder, workers, max_per_host=1):
+        from ebdata.blobs import update_feeds
+        logger = mock.Mock()
+        threads_before = threading.active_count()
+        with mock.patch('ebdata.blobs.update_feeds.FeedUpdater', recorder):
+            update_feeds.crawl(seeds, StubRetriever(), logger, workers, max_per_host)
+        # All the worker and geotagging threads are done.
+        self.assertEqual(threading.active_count(), threads_before)
+        return logger
+
+    def test_fan_out(self, mock_save_locations):
+        seeds = [StubSeed(i, host='example%d.com' % i) for i in range(6)]
+        recorder = CrawlRecorder(wait_for=3)
+        self._crawl(seeds, recorder, workers=3)
+        self.assertEqual(sorted(recorder.updated), sorted(s.url for s in seeds))
+        self.assertEqual(recorder.max_running, 3)
+        # Each worker has its own retriever, sharing one HostLimiter.
+        self.assertEqual(len(set([id(r) for r in recorder.retrievers])) > 1, True)
+        self.assertEqual(len(set([id(r.host_limiter) for r in recorder.retrievers])), 1)
+        # Every new page was geotagged.
+        self.assertEqual(sorted(args[0][0] for args in mock_save_locations.call_args_list),
+                         sorted(s.url for s in seeds))
+
+    def test_per_host_limit(self, mock_save_locations):
+        seeds = [StubSeed(0), StubSeed(0, host='example.org'), StubSeed(1),
+                 StubSeed(1, host='example.org'), StubSeed(2), StubSeed(3)]
+        recorder = CrawlRecorder(wait_for=2)
+        self._crawl(seeds, recorder, workers=3, max_per_host=1)
+        self.assertEqual(len(recorder.updated), 6)
+        self.assertEqual(recorder.max_per_host, 1)
+        # But different hosts were crawled at the same time.
+        self.assertEqual(recorder.max_running, 2)
+
+    def test_seed_delay(self, mock_save_locations):
+        from ebdata.retrieval.retrievers import HostLimiter
+        seeds = [StubSeed(1, delay=3), StubSeed(2, delay=5), StubSeed(3, host='example.org')]
+        with mock.patch.object(HostLimiter, 'set_min_interval') as mock_set_interval:
+            self._crawl(seeds, CrawlRecorder(), workers=2)
+        self.assertEqual(sorted(args[0] for args in mock_set_interval.call_args_list),
+                         [('http://example.com/', 3), ('http://example.com/', 5),
+                          ('http://example.org/', 0)])
+
+    def test_worker_error(self, mock_save_locations):
+        seeds = [StubSeed(i, host='example%d.com' % i) for i in range(4)]
+        recorder = CrawlRecorder(fail_urls=(seeds[1].url,))
+        # Geotagging errors don't stop the geotagger, either.
+        def save_locations(page):
+            if page == seeds[2].url:
+                raise ValueError('oops')
+        mock_save_locations.side_effect = save_locations
+        logger = self._crawl(seeds, recorder, workers=2)
+        self.assertEqual(len(recorder.updated), 4)
+        # The queue was drained, including the failed seed's page.
+        self.assertEqual(sorted(args[0][0] for args in mock_save_locations.call_args_list),
+                         sorted(s.url for s in seeds))
+        self.assertEqual(logger.exception.call_count, 2)
+
+
+class TestGetNewEntries(django.test.TestCase):
+
+    def _make_seed(self):
+        from ebdata.blobs.models import Seed
+        from ebpub.db.models import Schema
+        schema = Schema.objects.create(
+            name='article', plural_name='articles', slug='articles',
+            indefinite_article='an', last_updated='2012-01-01',
+            date_name='date', date_name_plural='dates')
+        return Seed.objects.create(
+            schema=schema,
+            url='http://example.com/feed.rss', base_url='http://example.com/',
+            delay=0, depth=1, is_crawled=False, is_rss_feed=True,
+            is_active=True, rss_full_entry=True, normalize_www=3,
+            pretty_name='Example', autodetect_locations=False,
+            guess_article_text=False, strip_noise=False)
+
+    def test_skips_seen(self):
+        from ebdata.blobs.models import Page
+        from ebdata.blobs.update_feeds import FeedUpdater
+        seed = self._make_seed()
+        Page.objects.create(
+            seed=seed, url='http://example.com/old', scraped_url='http://example.com/old',
+            html='<p>old</p>', when_crawled=datetime.datetime.now(), is_article=True,
+            is_pdf=False, is_printer_friendly=False, times_skipped=0)
+        feed = {'entries': [
+                {'link': 'http://example.com/old', 'title': 'Old'},
+                {'link': 'http://example.com/new', 'title': 'New'},
+                {'link': 'http://example.com/new', 'title': 'New again'},
+                {'title': 'No link'},
+                ]}
+        updater = FeedUpdater(seed, StubRetriever(), mock.Mock())
+        # One query for all the entries.
+        with self.assertNumQueries(1):
+            entries = updater.get_new_entries(feed)
+        self.assertEqual([(url, title) for (url, title, date, entry) in entries],
+                         [('http://example.com/new', 'New')])
@@ -46,6 +46,7 @@ from ebdata.blobs.geotagging import save_locations_for_page
 from ebdata.blobs.models import Seed, Page
 from ebdata.retrieval import UnicodeRetriever
 from ebdata.retrieval import log # Register the logging hooks.
+from ebdata.retrieval.retrievers import HostLimiter
 from ebdata.templatemaker.htmlutils import printer_friendly_link
 from ebdata.textmining.treeutils import make_tree
 from ebpub.utils.dates import parse_date
@@ -53,7 +54,9 @@ import feedparser
 import cgi
 import datetime
 import logging
+import Queue
 import re
+import threading
 import time
 import urllib
 import urlparse
@@ -136,10 +139,13 @@ def normalize_url(base_href, url, normalize_www_flag):
 
 
 class FeedUpdater(object):
-    def __init__(self, seed, retriever, logger):
+    def __init__(self, seed, retriever, logger, geotag_queue=None):
         self.seed = seed
         self.retriever = retriever
         self.logger = logger
+        # If set, new Pages are put on this queue for a separate
+        # worker to geotag, rather than geotagging them here.
+        self.geotag_queue = geotag_queue
 
     def update(self):
         try:
@@ -147,6 +153,18 @@ class FeedUpdater(object):
         except UnicodeDecodeError:
             self.logger.info('UnicodeDecodeError on %r', self.seed.url)
             return
+        for url, title, article_date, entry in self.get_new_entries(feed):
+            p = self.retrieve_page(url, title, article_date, entry)
+            if p is not None:
+                self.geotag(p)
+
+    def get_new_entries(self, feed):
+        """
+        Returns a list of (url, title, article_date, entry) for the
+        entries in the parsed ``feed`` that we should retrieve,
+        skipping any whose URLs have already been retrieved.
+        """
+        entries = []
         for entry in feed['entries']:
             if 'feedburner_origlink' in entry:
                 url = entry['feedburner_origlink']
@@ -191,85 +209,106 @@ class FeedUpdater(object):
                 self.logger.debug('Skipping %s due to download_page()', url)
                 continue
 
-            # If we've already retrieved the page, there's no need to retrieve
-            # it again.
-            try:
-                Page.objects.filter(url=url)[0]
-            except IndexError:
-                pass
-            else:
-                self.logger.debug('URL %s has already been retrieved', url)
+            entries.append((url, title, article_date, entry))
+
+        # If we've already retrieved the page, there's no need to retrieve
+        # it again.  Check them all at once.
+        seen = set(Page.objects.filter(url__in=[e[0] for e in entries]).values_list('url', flat=True))
+        new_entries = []
+        for entry in entries:
+            if entry[0] in seen:
+                self.logger.debug('URL %s has already been retrieved', entry[0])
                 continue
+            seen.add(entry[0])
+            new_entries.append(entry)
+        return new_entries
 
-            # If this seed contains the full content in the RSS feed <summary>,
-            # then we just use it instead of downloading the contents.
-            if self.seed.rss_full_entry:
-                is_printer_friendly = False
-                try:
-                    html = entry['summary']
-                except KeyError:
-                    html = entry['description']
-            else:
-                is_printer_friendly = False
-                html = None
+    def retrieve_page(self, url, title, article_date, entry):
+        """
+        Retrieves the article for one feed entry and saves it as a new
+        Page, which is returned; or returns None if there's nothing to
+        save.
+        """
+        # If this seed contains the full content in the RSS feed <summary>,
+        # then we just use it instead of downloading the contents.
+        if self.seed.rss_full_entry:
+            is_printer_friendly = False
+            try:
+                html = entry['summary']
+            except KeyError:
+                html = entry['description']
+        else:
+            is_printer_friendly = False
+            html = None
+            if getattr(self.retriever, 'host_limiter', None) is None:
                 time.sleep(self.seed.delay)
+            # Otherwise the retriever's HostLimiter keeps us polite.
 
-                # First, try deducing for the printer-friendly page, given the URL.
-                print_url = self.get_printer_friendly_url(url)
-                if print_url is not None:
-                    try:
-                        html = self.get_article_page(print_url)
-                        is_printer_friendly = True
-                    except Exception, e:
-                        self.logger.info('Error retrieving supposedly accurate printer-friendly page %s: %s', print_url, e)
-
-                # If a printer-friendly page didn't exist, get the real page.
-                if html is None:
-                    try:
-                        html = self.get_article_page(url)
-                    except Exception, e:
-                        self.logger.info('Error retrieving %s: %s', url, e)
-                        continue
-
-                    # If a page was downloaded, try looking for a printer-friendly
-                    # link, and download that.
-                    print_page = self.get_printer_friendly_page(html, url)
-                    if print_page is not None:
-                        is_printer_friendly = True
-                        html = print_page
-
-                new_html = self.scrape_article_from_page(html)
-                if new_html is not None:
-                    html = new_html
-
-                if article_date is None:
-                    article_date = self.scrape_article_date_from_page(html)
-
-            if not html.strip():
-                self.logger.debug('Got empty HTML page')
-                continue
+            # First, try deducing for the printer-friendly page, given the URL.
+            print_url = self.get_printer_friendly_url(url)
+            if print_url is not None:
+                try:
+                    html = self.get_article_page(print_url)
+                    is_printer_friendly = True
+                except Exception, e:
+                    self.logger.info('Error retrieving supposedly accurate printer-friendly page %s: %s', print_url, e)
+
+            # If a printer-friendly page didn't exist, get the real page.
+            if html is None:
+                try:
+                    html = self.get_article_page(url)
+                except Exception, e:
+                    self.logger.info('Error retrieving %s: %s', url, e)
+                    return None
+
+                # If a page was downloaded, try looking for a printer-friendly
+                # link, and download that.
+                print_page = self.get_printer_friendly_page(html, url)
+                if print_page is not None:
+                    is_printer_friendly = True
+                    html = print_page
+
+            new_html = self.scrape_article_from_page(html)
+            if new_html is not None:
+                html = new_html
+
+            if article_date is None:
+                article_date = self.scrape_article_date_from_page(html)
+
+        if not html.strip():
+            self.logger.debug('Got empty HTML page')
+            return None
 
-            article_headline = strip_tags(title)
-            if len(article_headline) > 252:
-                article_headline = article_headline[252:] + '...'
-            p = Page.objects.create(
-                seed=self.seed,
-                url=url,
-                scraped_url=(is_printer_friendly and print_url or url),
-                html=html,
-                when_crawled=datetime.datetime.now(),
-                is_article=True,
-                is_pdf=False,
-                is_printer_friendly=is_printer_friendly,
-                article_headline=article_headline,
-                article_date=article_date,
-                has_addresses=None,
-                when_geocoded=None,
-                geocoded_by='',
-                times_skipped=0,
-                robot_report='',
-            )
-            self.logger.info('Created %s story %r', self.seed.base_url, article_headline)
+        article_headline = strip_tags(title)
+        if len(article_headline) > 252:
+            article_headline = article_headline[252:] + '...'
+        p = Page.objects.create(
+            seed=self.seed,
+            url=url,
+            scraped_url=(is_printer_friendly and print_url or url),
+            html=html,
+            when_crawled=datetime.datetime.now(),
+            is_article=True,
+            is_pdf=False,
+            is_printer_friendly=is_printer_friendly,
+            article_headline=article_headline,
+            article_date=article_date,
+            has_addresses=None,
+            when_geocoded=None,
+            geocoded_by='',
+            times_skipped=0,
+            robot_report='',
+        )
+        self.logger.info('Created %s story %r', self.seed.base_url, article_headline)
+        return p
+
+    def geotag(self, p):
+        """
+        Finds locations in the new Page ``p``, or queues it to be done.
+        """
+        if self.geotag_queue is not None:
+            self.geotag_queue.put(p)
+        else:
             save_locations_for_page(p)
 
     def normalize_url(self, url):
@@ -325,19 +364,106 @@ class FeedUpdater(object):
         """
         return None
 
-def update(seed_id=None):
+def update(seed_id=None, workers=1, max_per_host=1):
     """
     Retrieves and saves every new item for every Seed that is an RSS feed.
+
+    If ``workers`` is more than 1, that many Seeds are updated at once,
+    in separate threads, and new Pages are geotagged in another
+    thread so downloading doesn't wait for geotagging.  In that case,
+    at most ``max_per_host`` requests go to any one site at a time,
+    and each Seed's ``delay`` applies across all threads to its site.
     """
     retriever = UnicodeRetriever(cache=None)
     logger = logging.getLogger('eb.retrieval.blob_rss')
     qs = Seed.objects.filter(is_rss_feed=True, is_active=True)
     if seed_id is not None:
         qs = qs.filter(id=seed_id)
-    for seed in qs:
-        updater = FeedUpdater(seed, retriever, logger)
-        updater.update()
+    if workers <= 1:
+        for seed in qs:
+            updater = FeedUpdater(seed, retriever, logger)
+            updater.update()
+    else:
+        crawl(list(qs), retriever, logger, workers, max_per_host)
 
-if __name__ == "__main__":
+
+def crawl(seeds, retriever, logger, workers, max_per_host=1):
+    """
+    Updates the given Seeds in ``workers`` threads, geotagging new
+    Pages in one more thread.  See update().
+    """
+    from django.db import connection
+    limiter = HostLimiter(max_per_host=max_per_host)
+    seed_queue = Queue.Queue()
+    for seed in seeds:
+        limiter.set_min_interval(seed.base_url, seed.delay)
+        seed_queue.put(seed)
+    geotag_queue = Queue.Queue()
+
+    def update_seeds():
+        thread_retriever = retriever.clone()
+        thread_retriever.host_limiter = limiter
+        try:
+            while True:
+                try:
+                    seed = seed_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    FeedUpdater(seed, thread_retriever, logger, geotag_queue).update()
+                except Exception:
+                    logger.exception('Error updating seed %s', seed.url)
+        finally:
+            connection.close()
+
+    def geotag_pages():
+        try:
+            while True:
+                p = geotag_queue.get()
+                if p is None:
+                    break
+                try:
+                    save_locations_for_page(p)
+                except Exception:
+                    logger.exception('Error geotagging page %s', p.url)
+        finally:
+            connection.close()
+
+    geotagger = threading.Thread(target=geotag_pages)
+    geotagger.start()
+    threads = [threading.Thread(target=update_seeds)
+               for i in range(min(workers, len(seeds)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    geotag_queue.put(None)
+    geotagger.join()
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage="""usage: %prog [options] [seed_id]
+
+Retrieves and saves every new item for every active RSS feed Seed,
+or just the given one.""")
+    optparser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                         help='Number of seeds to update at once. Default %default.')
+    optparser.add_option('--max-per-host', action='store', type='int', default=1,
+                         help='With --jobs, maximum concurrent requests to any one site. Default %default.')
+    opts, args = optparser.parse_args(argv)
+    seed_id = None
+    if args:
+        try:
+            seed_id = int(args[0])
+        except ValueError:
+            optparser.error('Invalid seed id %r' % args[0])
     from ebdata.retrieval import log_debug
-    update()
+    update(seed_id, workers=opts.jobs, max_per_host=opts.max_per_host)
+
+
+if __name__ == "__main__":
+    main()
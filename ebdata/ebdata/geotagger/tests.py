@@ -16,3 +16,47 @@
 #   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+
+import django.test
+
+
+class TestGazetteer(django.test.TestCase):
+
+    fixtures = ('test-locationdetail-views.json',)
+
+    def setUp(self):
+        from ebdata.nlp.gazetteer import gazetteer
+        gazetteer.clear()
+
+    tearDown = setUp
+
+    def _tag(self, text):
+        from ebdata.nlp.places import location_tagger
+        return location_tagger(pre='<x>', post='</x>')(text)
+
+    def test_no_queries_once_loaded(self):
+        self.assertEqual(self._tag('In Hood 1 today'), 'In <x>Hood 1</x> today')
+        with self.assertNumQueries(0):
+            self.assertEqual(self._tag('Hood 2 and Hood 3'),
+                             '<x>Hood 2</x> and Hood 3')
+
+    def test_ignore_location_types(self):
+        from ebdata.nlp.places import location_grabber
+        self.assertEqual(location_grabber(('neighborhoods',))('Hood 1'), [])
+        self.assertEqual(location_grabber()('Hood 1'), [(0, 6, 'Hood 1')])
+
+    def test_reloads_after_changes(self):
+        from ebpub.db.models import Location, LocationSynonym
+        self.assertEqual(self._tag('The Hood'), 'The Hood')
+        LocationSynonym.objects.create(pretty_name='The Hood',
+                                       location=Location.objects.get(name='Hood 1'))
+        self.assertEqual(self._tag('The Hood'), '<x>The Hood</x>')
+        Location.objects.filter(name='Hood 2').delete()
+        self.assertEqual(self._tag('Hood 2'), 'Hood 2')
+
+    def test_is_suburb(self):
+        from ebdata.nlp.gazetteer import gazetteer
+        from ebpub.streets.models import Suburb
+        self.assertEqual(gazetteer.is_suburb('Evanston'), False)
+        Suburb.objects.create(name='Evanston')
+        self.assertEqual(gazetteer.is_suburb('evanston '), True)
@@ -0,0 +1,173 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compares the speed of :py:class:`PhraseMatcher
+<ebdata.nlp.phrases.PhraseMatcher>` with the old one-regex-per-phrase
+grabber, :py:func:`regex_phrase_grabber
+<ebdata.nlp.phrases.regex_phrase_grabber>`, and checks that their
+results are identical.
+
+Usage::
+
+  python -m ebdata.nlp.benchmark [options] [ARTICLE_FILE ...]
+
+By default, both the phrases (neighborhood and street names) and the
+articles that mention them are generated at random, reproducibly.
+Pass text files to use real articles instead, and ``--from-db`` to
+use the names of the Locations and Places in your database (which
+requires ``DJANGO_SETTINGS_MODULE`` to be set).
+"""
+
+from ebdata.nlp.phrases import PhraseMatcher, regex_phrase_grabber
+import random
+import time
+
+NAME_WORDS = (
+    'Adams', 'Allston', 'Ashmont', 'Back', 'Bay', 'Beacon', 'Bowdoin',
+    'Brighton', 'Bunker', 'Cedar', 'Central', 'Charles', 'Chestnut',
+    'Columbia', 'Common', 'Court', 'Dudley', 'East', 'Elm', 'Fields',
+    'Forest', 'Franklin', 'Garden', 'Grove', 'Harbor', 'Heights', 'Hill',
+    'Hyde', 'Jackson', 'Jamaica', 'King', 'Lake', 'Lincoln', 'Madison',
+    'Maple', 'Market', 'Mill', 'Mission', 'North', 'Oak', 'Park',
+    'Pine', 'Plain', 'Pleasant', 'Point', 'Prospect', 'River', 'Roslindale',
+    'South', 'Spring', 'Square', 'Union', 'Valley', 'View', 'Village',
+    'Warren', 'Washington', 'West', 'Wood',
+    )
+
+STREET_SUFFIXES = ('Street', 'St', 'Avenue', 'Ave', 'Road', 'Boulevard')
+
+FILLER = (
+    'Police said the incident happened shortly after midnight.',
+    'Residents have complained about the noise for months.',
+    'The city council will take up the proposal next week.',
+    'No injuries were reported, according to a fire department spokesman.',
+    'The building has been vacant since 2009.',
+    'Neighbors say the intersection needs a traffic light.',
+    'A community meeting is scheduled for Tuesday at 7 p.m.',
+    'The restaurant is expected to open in the spring.',
+    )
+
+MENTIONS = (
+    'A man was arrested near %s on Saturday.',
+    'The %s neighborhood association opposes the plan.',
+    'Crews will repave %s starting Monday.',
+    'The fire started in a home on %s.',
+    'Officials toured %s and the surrounding blocks.',
+    )
+
+
+def make_phrases(count, rng):
+    """
+    Returns a list of ``count`` distinct, plausible place names.
+    """
+    phrases = set()
+    while len(phrases) < count:
+        words = rng.sample(NAME_WORDS, rng.choice((1, 2, 2, 3)))
+        if rng.random() < 0.4:
+            words.append(rng.choice(STREET_SUFFIXES))
+        phrases.add(' '.join(words))
+    # Same order as the places.py queries use.
+    return sorted(phrases, reverse=True)
+
+
+def make_articles(count, phrases, rng, paragraphs=8):
+    """
+    Returns ``count`` articles, each a few paragraphs of filler
+    sentences mentioning some of the phrases.
+    """
+    articles = []
+    for i in range(count):
+        paras = []
+        for j in range(paragraphs):
+            sentences = rng.sample(FILLER, 3)
+            for k in range(rng.randint(0, 2)):
+                mention = rng.choice(MENTIONS) % rng.choice(phrases)
+                sentences.insert(rng.randint(0, len(sentences)), mention)
+            paras.append(' '.join(sentences))
+        articles.append('\n\n'.join(paras))
+    return articles
+
+
+def db_phrases():
+    """
+    The names of all the Locations and Places in the database,
+    and their synonyms.
+    """
+    from ebdata.nlp.gazetteer import gazetteer
+    return gazetteer.place_names() + gazetteer.location_names(ignore_location_types=())
+
+
+def time_grabber(grabber, articles):
+    """
+    Grabs phrases from all the ``articles`` and returns (seconds, results).
+    """
+    start = time.time()
+    results = [grabber(article) for article in articles]
+    return time.time() - start, results
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='usage: %prog [options] [ARTICLE_FILE ...]')
+    optparser.add_option('-p', '--phrases', action='store', type='int', default=2000,
+                         help='Number of random phrases to generate. Default %default.')
+    optparser.add_option('-a', '--articles', action='store', type='int', default=200,
+                         help='Number of random articles to generate. Default %default.')
+    optparser.add_option('--from-db', action='store_true', default=False,
+                         help='Use Location and Place names from the database.')
+    optparser.add_option('--seed', action='store', type='int', default=0,
+                         help='Random seed. Default %default.')
+    opts, args = optparser.parse_args(argv)
+
+    rng = random.Random(opts.seed)
+    if opts.from_db:
+        phrases = db_phrases()
+    else:
+        phrases = make_phrases(opts.phrases, rng)
+    if args:
+        articles = [open(path).read().decode('utf8') for path in args]
+    else:
+        articles = make_articles(opts.articles, phrases, rng)
+
+    start = time.time()
+    matcher = PhraseMatcher(phrases)
+    build_time = time.time() - start
+
+    regex_time, regex_results = time_grabber(regex_phrase_grabber(list(phrases)), articles)
+    matcher_time, matcher_results = time_grabber(matcher.grab, articles)
+
+    print "%d phrases, %d articles (%d characters)" % (
+        len(phrases), len(articles), sum(len(a) for a in articles))
+    print "Found %d phrases" % sum(len(r) for r in matcher_results)
+    print "regex_phrase_grabber(): %.3f seconds (%.2f ms each)" % (
+        regex_time, 1000 * regex_time / len(articles))
+    print "PhraseMatcher:          %.3f seconds (%.2f ms each), plus %.3f seconds to build" % (
+        matcher_time, 1000 * matcher_time / len(articles), build_time)
+    print "Speedup: %.1fx" % (regex_time / (matcher_time or 1e-9))
+    if matcher_results != regex_results:
+        print "ERROR: results differ!"
+        return 1
+    print "Results are identical."
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A process-wide cache of the place names we look for in text: the
+names of all Locations, Places, their synonyms, and Suburbs.
+
+The names are loaded from the database the first time they're
+needed, and the :py:class:`PhraseMatcher
+<ebdata.nlp.phrases.PhraseMatcher>` for each set of names is built
+once, so after that, tagging or grabbing names costs no queries.
+
+Saving or deleting any of those models (or a LocationType or
+PlaceType) makes this process reload on next use, and other
+processes within ``GAZETTEER_CHECK_INTERVAL`` seconds if they share a
+cache backend; see :py:func:`ebpub.db.models.gazetteer_generation`.
+Names are reloaded every ``GAZETTEER_CACHE_TIME`` seconds regardless
+(both are in :py:mod:`ebpub.db.constants`), in case of changes made
+without signals, such as raw SQL.
+
+Use the shared instance::
+
+    from ebdata.nlp.gazetteer import gazetteer
+    matcher = gazetteer.location_matcher()
+"""
+
+from ebdata.nlp.phrases import PhraseMatcher
+from ebpub.db import constants
+from ebpub.db.models import Location, LocationSynonym, gazetteer_generation
+from ebpub.geocoder.parser.parsing import normalize
+from ebpub.streets.models import Place, PlaceSynonym, Suburb
+import logging
+import threading
+import time
+
+logger = logging.getLogger('ebdata.nlp.gazetteer')
+
+DEFAULT_IGNORE_LOCATION_TYPES = ('boroughs', 'cities')
+
+
+class Gazetteer(object):
+    """
+    Names of Locations, Places and Suburbs, loaded once per process;
+    see the module docstring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._built = {}
+        self._generation = (None, None)
+        self._expires = 0
+        self._next_check = 0
+
+    def clear(self):
+        """
+        Forgets everything, so it's reloaded on next use.
+        """
+        with self._lock:
+            self._names = None
+            self._built = {}
+
+    def _load(self):
+        # Same orderings as the queries ebdata.nlp.places used to do
+        # on every call; PhraseMatcher preserves them for equal-length names.
+        names = {}
+        names['locations'] = list(
+            Location.objects.values_list('name', 'location_type__slug').order_by('-name'))
+        names['location_synonyms'] = list(
+            LocationSynonym.objects.values_list('pretty_name', flat=True).order_by('-pretty_name'))
+        names['places'] = list(
+            Place.objects.filter(place_type__is_geocodable=True).values_list('pretty_name', flat=True).order_by('-pretty_name'))
+        names['place_synonyms'] = list(
+            PlaceSynonym.objects.values_list('pretty_name', flat=True).order_by('-pretty_name'))
+        names['suburbs'] = frozenset(
+            Suburb.objects.values_list('normalized_name', flat=True))
+        logger.debug('Loaded %d location and %d place names' % (
+                len(names['locations']) + len(names['location_synonyms']),
+                len(names['places']) + len(names['place_synonyms'])))
+        return names
+
+    def _is_stale(self, now):
+        local, shared = self._generation
+        if gazetteer_generation(check_shared=False)[0] != local:
+            return True
+        if now >= self._next_check:
+            self._next_check = now + constants.GAZETTEER_CHECK_INTERVAL
+            if gazetteer_generation()[1] != shared:
+                return True
+        return now >= self._expires
+
+    def _get(self, key, build):
+        """
+        Returns the cached value for ``key``, calling ``build(names)``
+        to make it if needed, after reloading the names if they're stale.
+        """
+        now = time.time()
+        with self._lock:
+            if self._names is None or self._is_stale(now):
+                # Get the generation first, so changes made while
+                # loading trigger another reload.
+                self._generation = gazetteer_generation()
+                self._names = self._load()
+                self._built = {}
+                self._expires = now + constants.GAZETTEER_CACHE_TIME
+                self._next_check = now + constants.GAZETTEER_CHECK_INTERVAL
+            if key not in self._built:
+                self._built[key] = build(self._names)
+            return self._built[key]
+
+    def location_names(self, ignore_location_types=DEFAULT_IGNORE_LOCATION_TYPES):
+        """
+        Names of all Locations (except those of the given LocationType
+        slugs) and all LocationSynonyms.
+        """
+        return self._get(('location_names', tuple(ignore_location_types)),
+                         lambda names: _location_names(names, ignore_location_types))
+
+    def place_names(self):
+        """
+        Names of all geocodable Places, and all PlaceSynonyms.
+        """
+        return self._get('place_names', _place_names)
+
+    def location_matcher(self, ignore_location_types=DEFAULT_IGNORE_LOCATION_TYPES):
+        """
+        A PhraseMatcher for :py:meth:`location_names`.
+        """
+        return self._get(('location_matcher', tuple(ignore_location_types)),
+                         lambda names: PhraseMatcher(_location_names(names, ignore_location_types)))
+
+    def place_matcher(self):
+        """
+        A PhraseMatcher for :py:meth:`place_names`.
+        """
+        return self._get('place_matcher',
+                         lambda names: PhraseMatcher(_place_names(names)))
+
+    def is_suburb(self, city):
+        """
+        Whether ``city`` is the name of a Suburb.
+        """
+        suburbs = self._get('suburbs', lambda names: names['suburbs'])
+        return normalize(city) in suburbs
+
+
+def _location_names(names, ignore_location_types):
+    ignore = set(ignore_location_types)
+    return [name for (name, slug) in names['locations'] if slug not in ignore] \
+        + names['location_synonyms']
+
+def _place_names(names):
+    return names['places'] + names['place_synonyms']
+
+
+gazetteer = Gazetteer()
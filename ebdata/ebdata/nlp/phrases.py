@@ -0,0 +1,266 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebdata
+#
+#   ebdata is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebdata is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Finding many phrases in text at once.
+
+:py:class:`PhraseMatcher` builds an Aho-Corasick automaton from a list
+of phrases, once, and can then find every occurrence of all of them
+in a single pass over the text.  Its results are the same as those of
+the original algorithm, :py:func:`regex_phrase_grabber`, which
+runs one regular expression per phrase:
+
+* Phrases are tried longest first (ties in their original order).
+
+* A phrase only matches on word boundaries (as in ``r'\\b...\\b'``).
+
+* Matched text is blanked out, so it can't be matched again by a
+  later (shorter) phrase.
+
+Phrases are treated as regular expressions by the original algorithm,
+so any phrase containing regex metacharacters, or starting or ending
+with a space, is still matched with a regex at the right point in the
+order.  In practice that's only the odd name like "St. Charles".
+
+These don't need Django; see :py:mod:`ebdata.nlp.places` for
+grabbers built from the Locations and Places in the database.
+"""
+
+import heapq
+import re
+import string
+
+# Characters matched by \w in a regex without the LOCALE or UNICODE flags.
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+REGEX_METACHARS = frozenset('.^$*+?{}[]|()\\')
+
+
+def _is_literal(phrase):
+    """
+    Whether a phrase means the same thing as a literal string and
+    as a regex, and can't be produced by blanking out other matches.
+    """
+    return bool(phrase) and phrase[0] != ' ' and phrase[-1] != ' ' \
+        and not REGEX_METACHARS.intersection(phrase)
+
+
+def regex_phrase_grabber(phrases):
+    """
+    The original phrase grabber: tries a regex for each phrase in
+    turn.  Slow with many phrases; kept for comparison with
+    :py:class:`PhraseMatcher`.
+    """
+    def grab_phrases(text):
+        phrases.sort(key=len, reverse=True)
+        tags = []
+        def handle_match(m):
+            # Note the start & end positions,
+            # and take care to preserve the length of the input
+            # by replacing the match with whitespace.
+            tags.append((m.start(), m.end(), m.group()))
+            return ' '*(m.end() - m.start())
+
+        for phrase in phrases:
+            if phrase in text:
+                text = re.sub(r'\b%s\b' % phrase, handle_match, text)
+        tags.sort()
+        return tags
+
+    return grab_phrases
+
+
+class PhraseMatcher(object):
+    """
+    Finds a fixed set of phrases in text; see the module docstring.
+
+    Build one per set of phrases and reuse it, since building the
+    automaton takes time proportional to the total length of the
+    phrases::
+
+        >>> matcher = PhraseMatcher(['Chicago', 'South Chicago'])
+        >>> matcher.grab('on South Chicago Ave in Chicago, IL')
+        [(3, 16, 'South Chicago'), (24, 31, 'Chicago')]
+    """
+
+    def __init__(self, phrases):
+        # Stable, so equal-length phrases keep their original order.
+        self.phrases = sorted(phrases, key=len, reverse=True)
+        # Trie nodes, as parallel lists indexed by node number.
+        # Node 0 is the root.
+        self._goto = [{}]
+        self._fail = [0]
+        # Indexes into self.phrases of literal phrases ending at each node,
+        # including via failure links.
+        self._out = [[]]
+        self._regexes = {}
+        # Each literal phrase's first index, and the indexes of all its copies.
+        self._literal_index = {}
+        self._copies = {}
+        self._regex_indexes = []
+        for i, phrase in enumerate(self.phrases):
+            if not _is_literal(phrase):
+                self._regex_indexes.append(i)
+                continue
+            first = self._literal_index.setdefault(phrase, i)
+            self._copies.setdefault(first, []).append(i)
+            if first == i:
+                self._add(phrase, i)
+        self._build_failure_links()
+
+    def _add(self, phrase, index):
+        node = 0
+        for char in phrase:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][char] = next_node
+            node = next_node
+        self._out[node].append(index)
+
+    def _build_failure_links(self):
+        # Breadth-first, so every node's failure target is finished first.
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = list(goto[0].values())
+        pos = 0
+        while pos < len(queue):
+            node = queue[pos]
+            pos += 1
+            for char, child in goto[node].iteritems():
+                queue.append(child)
+                target = fail[node]
+                while target and char not in goto[target]:
+                    target = fail[target]
+                target = goto[target].get(char, 0)
+                if target == child:
+                    target = 0
+                fail[child] = target
+                out[child] = out[child] + out[target]
+
+    def occurrences(self, text):
+        """
+        Returns a dict mapping the index (in ``self.phrases``) of each
+        literal phrase found anywhere in ``text`` to a sorted list of
+        start positions, ignoring word boundaries and overlaps.
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        phrases = self.phrases
+        found = {}
+        node = 0
+        for pos, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                for index in out[node]:
+                    found.setdefault(index, []).append(pos + 1 - len(phrases[index]))
+        return found
+
+    def grab(self, text):
+        """
+        Returns a sorted list of (start, end, matched_text) tuples
+        for the phrases found in ``text``.
+        """
+        found = self.occurrences(text)
+        # Indexes of the phrases to try, in order.  Literal phrases
+        # that don't occur in the text at all can be skipped.
+        pending = self._regex_indexes[:]
+        for first in found:
+            pending.extend(self._copies[first])
+        if not pending:
+            return []
+        heapq.heapify(pending)
+        current = list(text)
+        length = len(current)
+        tags = []
+        # The shortest regex match blanked out so far.  Once there's
+        # one, longer literal phrases could match across it in ways
+        # the automaton didn't see, so they fall back to regexes too.
+        shortest_regex_match = None
+        last = None
+        while pending:
+            i = heapq.heappop(pending)
+            if i == last:
+                continue
+            last = i
+            phrase = self.phrases[i]
+            first = self._literal_index.get(phrase)
+            if first is None or (shortest_regex_match is not None
+                                 and shortest_regex_match < len(phrase)):
+                matched = self._grab_regex(phrase, current, tags)
+                if matched:
+                    if shortest_regex_match is not None:
+                        matched.append(shortest_regex_match)
+                    shortest_regex_match = min(matched)
+                    j = i + 1
+                    while j < len(self.phrases) and len(self.phrases[j]) > shortest_regex_match:
+                        heapq.heappush(pending, j)
+                        j += 1
+                continue
+            starts = found.get(first)
+            if not starts:
+                continue
+            phrase_len = len(phrase)
+            chars = list(phrase)
+            first_is_word = phrase[0] in WORD_CHARS
+            last_is_word = phrase[-1] in WORD_CHARS
+            # Like re.sub(), find all the non-overlapping matches
+            # before blanking any of them.
+            matches = []
+            last_end = 0
+            for start in starts:
+                end = start + phrase_len
+                if start < last_end or current[start:end] != chars:
+                    continue
+                before = start and current[start - 1] in WORD_CHARS
+                after = end < length and current[end] in WORD_CHARS
+                if before == first_is_word or after == last_is_word:
+                    continue
+                matches.append(start)
+                last_end = end
+            for start in matches:
+                current[start:start + phrase_len] = [' '] * phrase_len
+                tags.append((start, start + phrase_len, phrase))
+        tags.sort()
+        return tags
+
+    __call__ = grab
+
+    def _grab_regex(self, phrase, current, tags):
+        """
+        Matches one phrase the way :py:func:`regex_phrase_grabber`
+        does, blanking out ``current`` in place.  Returns the lengths
+        of the non-empty matches.
+        """
+        text = ''.join(current)
+        if phrase not in text:
+            return []
+        regex = self._regexes.get(phrase)
+        if regex is None:
+            regex = self._regexes[phrase] = re.compile(r'\b%s\b' % phrase)
+        lengths = []
+        def handle_match(m):
+            tags.append((m.start(), m.end(), m.group()))
+            if m.end() > m.start():
+                lengths.append(m.end() - m.start())
+            return ' ' * (m.end() - m.start())
+        current[:] = list(regex.sub(handle_match, text))
+        return lengths
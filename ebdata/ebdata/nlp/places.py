@@ -17,8 +17,8 @@
 #
 
 import re
-from ebpub.db.models import Location, LocationSynonym
-from ebpub.streets.models import Place, PlaceSynonym
+from ebdata.nlp.gazetteer import gazetteer, DEFAULT_IGNORE_LOCATION_TYPES
+from ebdata.nlp.phrases import PhraseMatcher
 
 """
 Factories that return 'grabber' and 'tagger' functions, for finding
@@ -41,6 +41,10 @@ in the original text.
 e.g. you might not want to create <span>South<span>Boston</span></span>.
 Longer phrases will be matched before shorter phrases.
 
+All the grabbers and taggers find phrases with a
+:py:class:`PhraseMatcher <ebdata.nlp.phrases.PhraseMatcher>`, which
+looks for all of them in one pass over the text.
+
 TODO: docstrings for each of these
 """
 
@@ -48,42 +52,15 @@ def loose_phrase_grabber(phrases):
     """
     Given a list of strings ('phrases'), returns a phrase grabber
     function that does not care about markup around phrases.
-    """
-    def grab_phrases(text):
-        phrases.sort(key=len, reverse=True)
-        tags = []
-        def handle_match(m):
-            # Note the start & end positions,
-            # and take care to preserve the length of the input
-            # by replacing the match with whitespace.
-            tags.append((m.start(), m.end(), m.group()))
-            return ' '*(m.end() - m.start())
-
-        for phrase in phrases:
-            # don't bother buiding and exhaustively searching unless
-            # we at least weakly see this phrase in the text, 
-            # re compiling and searching is not cheap added up 
-            # over all locations.
-            if phrase in text:
-                text = re.sub(r'\b%s\b' % phrase, handle_match, text)
-
-            # TODO: we could actually do this in linear time entirely without
-            # regexes. (str.find is average linear)
-            # something like (UNTESTED):
-            # start = 0
-            # while True:
-            #     start = text.find(phrase, start)
-            #     if start == -1:
-            #         break
-            #     end = start + len(phrase)
-            #     tags.append((start, end, phrase))
-            #     start += 1
-            # text = text.replace(phrase, ' ' * len(phrase))
-            # Would need to profile that though.
-        tags.sort()
-        return tags
 
-    return grab_phrases
+    The phrases are compiled into a
+    :py:class:`PhraseMatcher <ebdata.nlp.phrases.PhraseMatcher>` up
+    front, so build the grabber once and reuse it.  ``phrases`` may
+    also be an existing PhraseMatcher.
+    """
+    if not isinstance(phrases, PhraseMatcher):
+        phrases = PhraseMatcher(phrases)
+    return phrases.grab
 
 def paranoid_phrase_grabber(phrases, pre, post):
     """
@@ -127,37 +104,34 @@ def place_tagger(pre='<addr>', post='</addr>', paranoid=True):
     """
     Returns a phrase tagger function where the phrases are the names of all
     Places and PlaceSynonyms in the database.
+
+    The names are cached by :py:mod:`ebdata.nlp.gazetteer`, so this is
+    cheap to call repeatedly.
     """
-    phrases = [p['pretty_name'] for p in Place.objects.filter(place_type__is_geocodable=True).values('pretty_name').order_by('-pretty_name')]
-    synonyms = [m['pretty_name'] for m in PlaceSynonym.objects.values('pretty_name').order_by('-pretty_name')]
-    return phrase_tagger(phrases + synonyms, pre, post, paranoid)
+    return phrase_tagger(gazetteer.place_matcher(), pre, post, paranoid)
 
 def location_tagger(pre='<addr>', post='</addr>', paranoid=True,
-                    ignore_location_types=('boroughs', 'cities')):
+                    ignore_location_types=DEFAULT_IGNORE_LOCATION_TYPES):
     """
     Returns a phrase tagger function where the phrases are the names of all
     Locations and LocationSynonyms in the database.
+
+    The names are cached by :py:mod:`ebdata.nlp.gazetteer`, so this is
+    cheap to call repeatedly.
     """
-    location_qs = Location.objects.values('name').order_by('-name').exclude(location_type__slug__in=ignore_location_types)
-    locations = [p['name'] for p in location_qs]
-    synonyms = [m['pretty_name'] for m in LocationSynonym.objects.values('pretty_name').order_by('-pretty_name')]
-    return phrase_tagger(locations + synonyms, pre, post, paranoid)
+    matcher = gazetteer.location_matcher(ignore_location_types)
+    return phrase_tagger(matcher, pre, post, paranoid)
 
 def place_grabber():
     """
     Returns a phrase grabber function where the phrases are the names of all
     Places and PlaceSynonyms in the database.
     """
-    phrases = [p['pretty_name'] for p in Place.objects.filter(place_type__is_geocodable=True).values('pretty_name').order_by('-pretty_name')]
-    synonyms = [m['pretty_name'] for m in PlaceSynonym.objects.values('pretty_name').order_by('-pretty_name')]
-    return loose_phrase_grabber(phrases + synonyms)
+    return loose_phrase_grabber(gazetteer.place_matcher())
 
-def location_grabber(ignore_location_types=('boroughs', 'cities')):
+def location_grabber(ignore_location_types=DEFAULT_IGNORE_LOCATION_TYPES):
     """
     Returns a phrase grabber function where the phrases are the names of all
     Locations and LocationSynonyms in the database.
     """
-    location_qs = Location.objects.values('name').order_by('-name').exclude(location_type__slug__in=ignore_location_types)
-    locations = [p['name'] for p in location_qs]
-    synonyms = [m['pretty_name'] for m in LocationSynonym.objects.values('pretty_name').order_by('-pretty_name')]
-    return loose_phrase_grabber(locations + synonyms)
+    return loose_phrase_grabber(gazetteer.location_matcher(ignore_location_types))
@@ -21,6 +21,7 @@ from ebdata.nlp.addresses import parse_addresses
 from ebdata.nlp.places import phrase_tagger
 from ebdata.nlp.places import loose_phrase_grabber
 from ebdata.nlp.places import paranoid_phrase_grabber
+from ebdata.nlp.phrases import PhraseMatcher, regex_phrase_grabber
 
 import unittest
 
@@ -781,6 +782,52 @@ class TestPhraseGrabber(unittest.TestCase):
                          [(83, 90, 'Chicago')])
 
 
+class TestPhraseMatcher(unittest.TestCase):
+
+    def assertSameAsRegex(self, phrases, text):
+        expected = regex_phrase_grabber(list(phrases))(text)
+        self.assertEqual(PhraseMatcher(phrases).grab(text), expected)
+        return expected
+
+    def test_longest_first(self):
+        tags = self.assertSameAsRegex(['Lake View', 'Lake View East', 'View'],
+                                      'In Lake View East today, a Lake View man...')
+        self.assertEqual(tags, [(3, 17, 'Lake View East'), (27, 36, 'Lake View')])
+
+    def test_word_boundaries(self):
+        tags = self.assertSameAsRegex(['Park', 'Oak'], 'Oakland Parkway, Oak Park.')
+        self.assertEqual(tags, [(17, 20, 'Oak'), (21, 25, 'Park')])
+
+    def test_overlapping_same_length(self):
+        # Ties go to whichever phrase came first.
+        self.assertEqual(self.assertSameAsRegex(['Hyde Park', 'Park Hill'], 'Hyde Park Hill'),
+                         [(0, 9, 'Hyde Park')])
+        self.assertEqual(self.assertSameAsRegex(['Park Hill', 'Hyde Park'], 'Hyde Park Hill'),
+                         [(5, 14, 'Park Hill')])
+
+    def test_boundaries_after_blanking(self):
+        # Word boundaries are checked against the blanked-out text.
+        self.assertEqual(self.assertSameAsRegex(['ab', '-x'], 'ab-x'),
+                         [(0, 2, 'ab')])
+        self.assertEqual(self.assertSameAsRegex(['-x', 'ab'], 'ab-x'),
+                         [(0, 2, 'ab'), (2, 4, '-x')])
+
+    def test_regex_phrases(self):
+        # The old grabber treated phrases as regexes; so do we.
+        tags = self.assertSameAsRegex(['St. Louis', 'Louis', 'Louisville'],
+                                      'St. Louis, StX Louis and Louisville')
+        self.assertEqual(tags, [(0, 9, 'St. Louis'), (11, 20, 'StX Louis'),
+                                (25, 35, 'Louisville')])
+
+    def test_duplicates_and_empty(self):
+        self.assertSameAsRegex(['Elm', 'Elm', 'Elm St'], 'Elm St and Elm')
+        self.assertSameAsRegex([''], 'Elm St')
+        self.assertEqual(self.assertSameAsRegex([], 'Elm St'), [])
+
+    def test_unicode(self):
+        self.assertSameAsRegex([u'Caf\xe9', u'Caf'], u'Caf\xe9 Caf\xe9s Caf')
+
+
 
 class TestPhraseTagger(unittest.TestCase):
     def test_double_matching(self):
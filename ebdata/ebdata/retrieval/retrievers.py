@@ -23,12 +23,15 @@ A Retriever class simply knows how to retrieve a resource off of the Web. It
 knows nothing about *scraping*, i.e., parsing the contents of Web pages.
 """
 
+import copy
 import os
 import httplib2
 from Cookie import SimpleCookie, CookieError
 from urllib import urlencode
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 import logging
+import Queue
+import threading
 import time
 import socket
 
@@ -45,10 +48,142 @@ class Default:
     # Used to determine whether a default argument was given to Retriever.__init__().
     pass
 
+class HostLimiter(object):
+    """
+    Politeness limits shared between threads: at most ``max_per_host``
+    concurrent requests to any one host, and at least ``min_interval``
+    seconds between the starts of requests to the same host.
+
+    Give one to several Retrievers as their ``host_limiter``.
+    """
+
+    def __init__(self, max_per_host=2, min_interval=0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+        self._intervals = {}
+
+    def _host(self, uri):
+        return urlparse(uri)[1].lower()
+
+    def set_min_interval(self, uri, seconds):
+        """
+        Overrides ``min_interval`` for the host of ``uri``.
+        If called more than once for a host, the longest interval wins.
+        """
+        host = self._host(uri)
+        with self._lock:
+            self._intervals[host] = max(seconds, self._intervals.get(host, 0))
+
+    def acquire(self, uri):
+        """
+        Blocks until a request to ``uri`` is allowed.
+        Be sure to call release() afterward.
+        """
+        host = self._host(uri)
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = semaphore
+        semaphore.acquire()
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self._intervals.get(host, self.min_interval)
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, uri):
+        self._semaphores[self._host(uri)].release()
+
+
+# Server errors worth retrying.
+RETRY_STATUSES = ('500', '502', '503', '504')
+
+
+class RetrievalStats(object):
+    """
+    Thread-safe per-host counts of requests, errors and cache hits,
+    and request latencies, for monitoring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+    def record(self, uri, elapsed, error=False, cache_hit=False):
+        """
+        Records one HTTP request (or cache lookup) for ``uri`` that
+        took ``elapsed`` seconds.
+        """
+        host = urlparse(uri)[1].lower()
+        with self._lock:
+            counts = self._hosts.get(host)
+            if counts is None:
+                counts = self._hosts[host] = {
+                    'requests': 0, 'errors': 0, 'cache_hits': 0,
+                    'total_time': 0.0, 'max_time': 0.0}
+            counts['requests'] += 1
+            counts['errors'] += int(bool(error))
+            counts['cache_hits'] += int(bool(cache_hit))
+            counts['total_time'] += elapsed
+            counts['max_time'] = max(counts['max_time'], elapsed)
+
+    def as_dict(self):
+        """
+        Returns a dict mapping each host to a dict of its counts,
+        plus ``mean_time``.
+        """
+        with self._lock:
+            result = dict([(host, counts.copy())
+                           for (host, counts) in self._hosts.items()])
+        for counts in result.values():
+            counts['mean_time'] = counts['total_time'] / counts['requests']
+        return result
+
+
+class FetchResult(object):
+    """
+    The outcome of fetching one URI with Retriever.fetch_many().
+
+    ``content`` and ``headers`` are as returned by
+    fetch_data_and_headers(); ``error`` is the exception raised, if any.
+    ``unchanged`` is True if the server (or the HTTP cache) says the
+    page hasn't changed since we last fetched it; in that case, if the
+    Retriever has no cache, ``content`` is None.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.content = None
+        self.headers = None
+        self.error = None
+        self.cache_hit = False
+        self.unchanged = False
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '<FetchResult %s>' % self.uri
+
+
 LOG_ENTRY_FMT = "%(timestamp)s\t%(method)s\t%(uri)s\t%(status)s\t%(elapsed)s\t%(size)s"
 
 class Retriever(object):
     'HTTP client.'
+
+    # How many times to try a request that times out or gets a
+    # server error, waiting retry_backoff seconds before the first
+    # retry and doubling that each time.
+    max_attempts = 3
+    retry_backoff = 0.5
+
     def __init__(self, user_agent=None, cache=Default, timeout=20, sleep=0):
         # Use cache=None to explicitly turn off caching.
         # If you don't provide cache, then it will cache in
@@ -71,6 +206,34 @@ class Retriever(object):
         # This makes sure we don't sleep before the very first requested page.
         self.page_downloaded = False
 
+        # Optional HostLimiter shared with other Retrievers.
+        self.host_limiter = None
+        # Shared with clones.
+        self.stats = RetrievalStats()
+        # Map of URI -> (etag, last-modified) for conditional GETs in
+        # fetch_many(), if we don't have an HTTP cache to do that for us.
+        self._validators = {}
+
+    def clone(self):
+        """
+        Returns a new Retriever with the same settings, cache, cookies
+        and host_limiter, but its own HTTP connections, eg. for use
+        in another thread.
+        """
+        new = copy.copy(self)
+        new.h = httplib2.Http(self.h.cache, timeout=self.h.timeout)
+        new.h.force_exception_to_status_code = self.h.force_exception_to_status_code
+        new.h.follow_redirects = self.h.follow_redirects
+        new._cookies = copy.deepcopy(self._cookies)
+        new.cache_hit = False
+        return new
+
+    def _sleep_before_retry(self, attempt_number):
+        delay = self.retry_backoff * (2 ** (attempt_number - 1))
+        if delay:
+            self.logger.debug('Waiting %s seconds before retrying', delay)
+            time.sleep(delay)
+
     def clear_cookies(self):
         self._cookies = SimpleCookie()
 
@@ -100,15 +263,23 @@ class Retriever(object):
 
         # Get the response.
         resp_headers = None
-        for attempt_number in range(3):
+        for attempt_number in range(self.max_attempts):
+            if attempt_number:
+                self._sleep_before_retry(attempt_number)
             self.logger.debug('Attempt %s: %s %s', attempt_number + 1, method, uri)
             if data:
                 self.logger.debug('%r', data)
+            if self.host_limiter is not None:
+                self.host_limiter.acquire(uri)
+            started = time.time()
+            failed = True
             try:
                 resp_headers, content = self.h.request(uri, method, body=body, headers=headers)
-                if resp_headers['status'] == '500':
-                    self.logger.debug("Request got a 500 error: %s %s", method, uri)
+                if resp_headers['status'] in RETRY_STATUSES:
+                    self.logger.debug("Request got a %s error: %s %s",
+                                      resp_headers['status'], method, uri)
                     continue # Try again.
+                failed = False
                 if resp_headers.fromcache:
                     self.cache_hit = True
                 break
@@ -123,11 +294,16 @@ class Retriever(object):
                 continue # Try again
             except httplib2.ServerNotFoundError:
                 raise RetrievalError("Could not %s %r: server not found" % (method, uri))
+            finally:
+                if self.host_limiter is not None:
+                    self.host_limiter.release(uri)
+                self.stats.record(uri, time.time() - started, error=failed,
+                                  cache_hit=(not failed and self.cache_hit))
         if resp_headers is None:
-            raise RetrievalError("Request timed out 3 times: %s %s" % (method, uri))
+            raise RetrievalError("Request timed out %s times: %s %s" % (self.max_attempts, method, uri))
 
         # Raise RetrievalError if necessary.
-        if raise_on_error and resp_headers['status'] in ('400', '408', '500'):
+        if raise_on_error and resp_headers['status'] in ('400', '408') + RETRY_STATUSES:
             raise RetrievalError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
         if raise_on_error and resp_headers['status'] == '404':
             raise PageNotFoundError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
@@ -170,6 +346,78 @@ class Retriever(object):
         """
         return self.fetch_data(*args, **kwargs)
 
+    def fetch_many(self, uris, max_workers=4, max_per_host=2):
+        """
+        Fetches several URIs concurrently, with GET requests.
+        Returns a list of FetchResults, in the same order as ``uris``.
+        Errors are reported in each FetchResult, not raised.
+
+        Requests are made by up to ``max_workers`` threads, each
+        keeping its own keep-alive connection to each host.  At most
+        ``max_per_host`` requests go to any one host at a time, at
+        least ``self.sleep`` seconds apart.
+
+        Pages that haven't changed since the last fetch, according to
+        their ETag or Last-Modified headers, are marked
+        ``unchanged``.  Per-host timings and cache hits are recorded
+        in ``self.stats``.
+        """
+        results = [FetchResult(uri) for uri in uris]
+        jobs = Queue.Queue()
+        for result in results:
+            jobs.put(result)
+        limiter = HostLimiter(max_per_host, self.sleep)
+
+        def work():
+            retriever = self.clone()
+            retriever.sleep = 0  # The limiter takes care of that.
+            retriever.host_limiter = limiter
+            while True:
+                try:
+                    result = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                retriever._fetch_result(result)
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(max_workers, len(results)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _fetch_result(self, result):
+        # Fills in a FetchResult for fetch_many().
+        started = time.time()
+        headers = {}
+        use_validators = self.h.cache is None
+        if use_validators:
+            etag, last_modified = self._validators.get(result.uri, (None, None))
+            if etag:
+                headers['if-none-match'] = etag
+            if last_modified:
+                headers['if-modified-since'] = last_modified
+        try:
+            content, resp_headers = self.fetch_data_and_headers(result.uri,
+                                                                headers=headers)
+        except Exception, e:
+            self.logger.debug("Error fetching %s: %s", result.uri, e)
+            result.error = e
+        else:
+            result.headers = resp_headers
+            if resp_headers['status'] == '304':
+                result.unchanged = True
+            else:
+                result.content = content
+                result.cache_hit = result.unchanged = self.cache_hit
+                if use_validators and resp_headers['status'] == '200':
+                    validators = (resp_headers.get('etag'),
+                                  resp_headers.get('last-modified'))
+                    if validators != (None, None):
+                        self._validators[result.uri] = validators
+        result.elapsed = time.time() - started
+
     def cached_get_to_file(self, uri, filename):
         """
         Downloads the given URI and saves it to a temporary file. Returns the
@@ -219,4 +467,5 @@ class UnicodeRetriever(Retriever):
         content, headers = Retriever.fetch_data_and_headers(self, *args, **kwargs)
         guess = chardet.detect(content)
         # Maybe this should take into account guess['confidence']?
-        return guess['encoding'], content, headers
+        # (There's no guess for empty content, eg. a 304 response.)
+        return guess['encoding'] or 'ascii', content, headers
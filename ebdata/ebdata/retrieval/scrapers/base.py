@@ -28,6 +28,7 @@ from ebpub.utils.text import address_to_block
 import datetime
 import logging
 import pytz
+import threading
 import traceback
 
 local_tz = pytz.timezone(settings.TIME_ZONE)
@@ -43,8 +44,11 @@ class BaseScraper(object):
     logname = 'basescraper'
     sleep = 0
     timeout = 20
+    # How many records create_or_update_many() saves per transaction.
+    bulk_chunk_size = 500
 
     def __init__(self, use_cache=True):
+        self._local = threading.local()
         if not use_cache:
             self.retriever = Retriever(cache=None, sleep=self.sleep, timeout=self.timeout)
         else:
@@ -56,6 +60,18 @@ class BaseScraper(object):
         self.num_skipped = 0
 
 
+    def _get_retriever(self):
+        # Worker threads may each have their own Retriever;
+        # see ListDetailScraper.detail_workers.
+        local = self.__dict__.get('_local')
+        return getattr(local, 'retriever', None) or self._retriever
+
+    def _set_retriever(self, retriever):
+        self._retriever = retriever
+
+    retriever = property(_get_retriever, _set_retriever)
+
+
     def geocode(self, location_name, **kwargs):
         """
         Tries to geocode the given location string, returning a Point object
@@ -180,7 +196,18 @@ class BaseScraper(object):
               Default False.
 
         """
+        ni = self._build_newsitem(**kwargs)
+        ni.save(force_insert=True)
+        if attributes is not None:
+            ni.attributes = attributes
+        self.num_added += 1
+        self.logger.info(u'Created NewsItem %s: %s (total created in this scrape: %s)', ni.schema.slug, ni.id, self.num_added)
+        return ni
 
+
+    def _build_newsitem(self, **kwargs):
+        # Geocodes as needed and returns an unsaved NewsItem.
+        # See create_newsitem() for the kwargs.
         convert_to_block = kwargs.pop('convert_to_block', False)
         location, location_name = self.geocode_if_needed(
             kwargs.get('location', None),
@@ -204,7 +231,7 @@ class BaseScraper(object):
         # kwargs, which raises an error when using multiple schemas.
         schema = kwargs.get('schema', None) or self.schema
 
-        ni = NewsItem.objects.create(
+        return NewsItem(
             schema=schema,
             title=kwargs['title'],
             description=kwargs.get('description', ''),
@@ -215,11 +242,6 @@ class BaseScraper(object):
             location_name=location_name,
             location_object=kwargs.get('location_object', None),
         )
-        if attributes is not None:
-            ni.attributes = attributes
-        self.num_added += 1
-        self.logger.info(u'Created NewsItem %s: %s (total created in this scrape: %s)', schema.slug, ni.id, self.num_added)
-        return ni
 
 
     @transaction.commit_on_success
@@ -231,6 +253,12 @@ class BaseScraper(object):
 
         Returns the NewsItem.
         """
+        return self._update_existing(newsitem, new_values, new_attributes)
+
+
+    def _update_existing(self, newsitem, new_values, new_attributes):
+        # Same as update_existing(), but leaves transaction handling
+        # to the caller.
         newsitem_updated = False
         # First, check the NewsItem's values.
         for k, v in new_values.items():
@@ -279,3 +307,158 @@ class BaseScraper(object):
         else:
             return self.create_newsitem(attributes=attributes, **kwargs)
 
+
+
+    def create_or_update_many(self, records, chunk_size=None):
+        """
+        Bulk version of create_or_update(), for big imports.
+
+        ``records`` is an iterable of ``(old_record, attributes, kwargs)``
+        tuples, ie. the arguments you'd pass to create_or_update().
+        Returns a list of the created or updated NewsItems, in the
+        same order.
+
+        Records are handled in chunks of ``chunk_size`` (default
+        ``self.bulk_chunk_size``), each in one transaction.  New
+        NewsItems in a chunk, and their attributes, are saved with one
+        multi-row INSERT per table (and per Schema, for attributes).
+        Existing ones are updated individually as per update_existing().
+
+        New records that are exact duplicates of an earlier one in
+        the same call are not saved again; they count as skipped,
+        and the earlier NewsItem is returned in their place.
+
+        num_added, num_changed and num_skipped are updated as usual.
+        """
+        chunk_size = chunk_size or self.bulk_chunk_size
+        results = []
+        seen = {}
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                results.extend(self._create_or_update_chunk(chunk, seen))
+                chunk = []
+        if chunk:
+            results.extend(self._create_or_update_chunk(chunk, seen))
+        return results
+
+    @transaction.commit_on_success
+    def _create_or_update_chunk(self, records, seen):
+        # ``seen`` maps a key for each new record so far in this
+        # create_or_update_many() call to its NewsItem.
+        results = [None] * len(records)
+        to_create = []  # (index, newsitem, attributes)
+        duplicates = []  # (index, key)
+        for i, (old_record, attributes, kwargs) in enumerate(records):
+            if old_record:
+                results[i] = self._update_existing(old_record, kwargs,
+                                                   attributes or {})
+                continue
+            key = _record_key(attributes, kwargs)
+            if key is not None and key in seen:
+                duplicates.append((i, key))
+                continue
+            ni = self._build_newsitem(**kwargs)
+            to_create.append((i, ni, attributes))
+            if key is not None:
+                seen[key] = ni
+            results[i] = ni
+
+        if to_create:
+            _bulk_insert_newsitems([ni for (i, ni, attrs) in to_create])
+            _bulk_insert_attributes([(ni, attrs) for (i, ni, attrs) in to_create
+                                     if attrs is not None], self.logger)
+            self.num_added += len(to_create)
+            self.logger.info(u'Created %d NewsItems (total created in this scrape: %s)',
+                             len(to_create), self.num_added)
+        for i, key in duplicates:
+            self.logger.debug('Skipping duplicate record %d in batch', i)
+            results[i] = seen[key]
+            self.num_skipped += 1
+        return results
+
+
+def _record_key(attributes, kwargs):
+    # A hashable key identifying a new record's data, for spotting
+    # duplicates; or None if the data isn't hashable.
+    try:
+        key = (tuple(sorted(kwargs.items())),
+               tuple(sorted((attributes or {}).items())))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _bulk_insert_newsitems(newsitems):
+    """
+    Saves the unsaved ``newsitems`` with one multi-row INSERT,
+    setting their ids.
+
+    Like NewsItem.save(), this fills in auto_now fields, but it doesn't
+    send any model signals.
+    """
+    from django.db import connection
+    opts = NewsItem._meta
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    # Reserve the ids up front, so we know which row is which.
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                   "FROM generate_series(1, %s)",
+                   [opts.db_table, opts.pk.column, len(newsitems)])
+    for ni, (new_id,) in zip(newsitems, cursor.fetchall()):
+        ni.id = new_id
+
+    fields = [f for f in opts.local_fields]
+    rows = []
+    params = []
+    for ni in newsitems:
+        placeholders = []
+        for f in fields:
+            value = f.get_db_prep_save(f.pre_save(ni, True), connection=connection)
+            if hasattr(f, 'get_placeholder'):
+                placeholders.append(f.get_placeholder(value, connection))
+            else:
+                placeholders.append('%s')
+            params.append(value)
+        rows.append('(%s)' % ', '.join(placeholders))
+    cursor.execute("INSERT INTO %s (%s) VALUES %s" % (
+            qn(opts.db_table),
+            ', '.join([qn(f.column) for f in fields]),
+            ', '.join(rows)),
+                   params)
+    transaction.commit_unless_managed()
+
+
+def _bulk_insert_attributes(newsitems_and_attributes, logger):
+    """
+    Inserts Attribute rows for a list of (newly created NewsItem,
+    attributes dict) pairs, with one multi-row INSERT per Schema.
+    Warnings go to ``logger``.
+    """
+    from django.db import connection
+    from ebpub.db.models import Attribute, field_mapping
+    by_schema = {}
+    for ni, attributes in newsitems_and_attributes:
+        by_schema.setdefault(ni.schema_id, []).append((ni, attributes))
+    mappings = field_mapping(by_schema.keys())
+    cursor = connection.cursor()
+    for schema_id, pairs in by_schema.items():
+        mapping = mappings.get(schema_id, {}).items()
+        if not mapping:
+            if [attrs for (ni, attrs) in pairs if attrs]:
+                logger.warn(
+                    "Can't save non-empty attributes dict with an empty schema")
+            continue
+        row = '(%s)' % ', '.join(['%s'] * (len(mapping) + 2))
+        params = []
+        for ni, attributes in pairs:
+            params.extend([ni.id, schema_id])
+            params.extend([attributes.get(k, None) for k, v in mapping])
+        cursor.execute("INSERT INTO %s (news_item_id, schema_id, %s) VALUES %s" % (
+                Attribute._meta.db_table,
+                ', '.join([v for k, v in mapping]),
+                ', '.join([row] * len(pairs))),
+                       params)
+    transaction.commit_unless_managed()
@@ -17,6 +17,13 @@
 #
 
 from base import BaseScraper, ScraperBroken
+from ebdata.retrieval.retrievers import HostLimiter
+
+import collections
+import Queue
+import sys
+import threading
+import time
 
 
 class SkipRecord(Exception):
@@ -27,6 +34,30 @@ class StopScraping(Exception):
     "Exception that signifies scraping should stop."
     pass
 
+# Returned by ListDetailScraper._detail_record() for skipped records.
+_SKIPPED = object()
+
+TIMING_NAMES = ('fetch', 'parse', 'lookup', 'save', 'wait')
+
+
+class _DetailJob(object):
+    # A record waiting for its detail page, in pipelined mode.
+
+    def __init__(self, list_record, old_record, detail_required):
+        self.list_record = list_record
+        self.old_record = old_record
+        self.detail_required = detail_required
+        self.page = None
+        self.exc_info = None
+        self.fetch_time = 0.0
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def get_page(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.page
+
 class ListDetailScraper(BaseScraper):
     """
     A screen-scraper optimized for list-detail types of sites.
@@ -128,9 +159,13 @@ class ListDetailScraper(BaseScraper):
         The main scraping method. This retrieves all pages, parses
         them, calls cleaning hooks, and saves the data.
 
+        Time spent in each phase is logged at the end, and left in
+        ``self.timings``.
+
         Subclasses should not have to override this method.
         """
         self.num_skipped = 0
+        self.timings = dict.fromkeys(TIMING_NAMES, 0.0)
 
         self.logger.info("update() in %s started" % str(self.__class__))
         try:
@@ -140,6 +175,10 @@ class ListDetailScraper(BaseScraper):
             pass
         finally:
             self.logger.info("update() finished")
+            self.logger.info(
+                "Seconds spent fetching detail pages: %(fetch).1f; parsing: %(parse).1f;"
+                " finding existing records: %(lookup).1f; saving: %(save).1f;"
+                " waiting for detail pages: %(wait).1f" % self.timings)
 
     def update_from_string(self, page):
         """
@@ -148,46 +187,195 @@ class ListDetailScraper(BaseScraper):
         This is useful if you've got cached versions of content that
         you want to parse; also, update() calls it under the hood.
 
+        If ``detail_workers`` is set, detail pages are fetched in that
+        many threads; see _update_from_string_pipelined().
+
         Subclasses should not have to override this method.
         """
-        for list_record in self.parse_list(page):
-            try:
-                list_record = self.clean_list_record(list_record)
-            except SkipRecord, e:
-                self.num_skipped += 1
-                self.logger.debug(u"Skipping list record for %r: %s " % (list_record, e))
+        if self.has_detail and self.detail_workers > 0:
+            return self._update_from_string_pipelined(page)
+        for list_record in self._timed_iter(self.parse_list(page), 'parse'):
+            prepared = self._prepare_list_record(list_record)
+            if prepared is None:
                 continue
-            except ScraperBroken, e:
-                # Re-raise the ScraperBroken with some addtional helpful information.
-                raise ScraperBroken('%r -- %s' % (list_record, e))
-            self.logger.debug("Clean list record: %r" % list_record)
-
-            old_record = self.existing_record(list_record)
-            self.logger.debug("Existing record: %r" % old_record)
-
-            if self.has_detail and self.detail_required(list_record, old_record):
-                self.logger.debug("Detail page is required")
-                try:
-                    page = self.get_detail(list_record)
-                    detail_record = self.parse_detail(page, list_record)
-                    detail_record = self.clean_detail_record(detail_record)
-                except SkipRecord, e:
-                    self.num_skipped += 1
-                    self.logger.debug("Skipping detail record for list %r: %s" % (list_record, e))
+            list_record, old_record, detail_required = prepared
+            if detail_required:
+                def get_page():
+                    start = time.time()
+                    try:
+                        return self.get_detail(list_record)
+                    finally:
+                        self._add_timing('fetch', time.time() - start)
+                detail_record = self._detail_record(list_record, get_page)
+                if detail_record is _SKIPPED:
                     continue
-                except ScraperBroken, e:
-                    # Re-raise the ScraperBroken with some additional helpful information.
-                    raise ScraperBroken('%r -- %s' % (list_record, e))
-                self.logger.debug("Clean detail record: %r" % detail_record)
             else:
                 self.logger.debug("Detail page is not required")
                 detail_record = None
+            self._save_record(old_record, list_record, detail_record)
+
+    def _update_from_string_pipelined(self, page):
+        """
+        Like update_from_string(), but fetches detail pages in
+        ``self.detail_workers`` threads, up to ``detail_fetch_ahead``
+        records ahead of the one being saved.  Everything else,
+        including parsing the detail pages, still happens in this
+        thread, in the original order.
+
+        Requests are limited to ``detail_max_per_host`` at a time per
+        host, and start at least ``self.sleep`` seconds apart.
+        Each thread uses its own copy of ``self.retriever``, so
+        get_detail() must not otherwise depend on shared state.
+        """
+        jobs = Queue.Queue()
+        limiter = HostLimiter(self.detail_max_per_host, self.sleep)
+        workers = []
+        for i in range(self.detail_workers):
+            worker = threading.Thread(target=self._detail_worker,
+                                      args=(jobs, limiter))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        fetch_ahead = self.detail_fetch_ahead or self.detail_workers * 4
+        pending = collections.deque()
+        try:
+            for list_record in self._timed_iter(self.parse_list(page), 'parse'):
+                prepared = self._prepare_list_record(list_record)
+                if prepared is None:
+                    continue
+                job = _DetailJob(*prepared)
+                if job.detail_required:
+                    jobs.put(job)
+                pending.append(job)
+                while len(pending) > fetch_ahead:
+                    self._finish_job(pending.popleft())
+            while pending:
+                self._finish_job(pending.popleft())
+        finally:
+            # If we're bailing out, don't bother fetching the rest.
+            for job in pending:
+                job.cancelled = True
+            for worker in workers:
+                jobs.put(None)
+            for worker in workers:
+                worker.join()
+
+    def _detail_worker(self, jobs, limiter):
+        # Runs in a worker thread, with its own Retriever.
+        retriever = self._retriever.clone()
+        retriever.sleep = 0  # The limiter takes care of that.
+        retriever.host_limiter = limiter
+        self._local.retriever = retriever
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            if not job.cancelled:
+                start = time.time()
+                try:
+                    job.page = self.get_detail(job.list_record)
+                except:
+                    job.exc_info = sys.exc_info()
+                job.fetch_time = time.time() - start
+            job.done.set()
+
+    def _finish_job(self, job):
+        if job.detail_required:
+            start = time.time()
+            job.done.wait()
+            self._add_timing('wait', time.time() - start)
+            self._add_timing('fetch', job.fetch_time)
+            detail_record = self._detail_record(job.list_record, job.get_page)
+            if detail_record is _SKIPPED:
+                return
+        else:
+            self.logger.debug("Detail page is not required")
+            detail_record = None
+        old_record = job.old_record
+        if old_record is None:
+            # It may have been saved since it was queued, if it's
+            # repeated on the list page within detail_fetch_ahead.
+            old_record = self._existing_record(job.list_record)
+        self._save_record(old_record, job.list_record, detail_record)
+
+    def _prepare_list_record(self, list_record):
+        # Cleans the list record and finds any existing record.
+        # Returns (list_record, old_record, detail_required),
+        # or None if the record should be skipped.
+        try:
+            start = time.time()
+            try:
+                list_record = self.clean_list_record(list_record)
+            finally:
+                self._add_timing('parse', time.time() - start)
+        except SkipRecord, e:
+            self.num_skipped += 1
+            self.logger.debug(u"Skipping list record for %r: %s " % (list_record, e))
+            return None
+        except ScraperBroken, e:
+            # Re-raise the ScraperBroken with some addtional helpful information.
+            raise ScraperBroken('%r -- %s' % (list_record, e))
+        self.logger.debug("Clean list record: %r" % list_record)
+
+        old_record = self._existing_record(list_record)
+        detail_required = bool(self.has_detail and
+                               self.detail_required(list_record, old_record))
+        return (list_record, old_record, detail_required)
+
+    def _existing_record(self, list_record):
+        start = time.time()
+        old_record = self.existing_record(list_record)
+        self._add_timing('lookup', time.time() - start)
+        self.logger.debug("Existing record: %r" % old_record)
+        return old_record
+
+    def _detail_record(self, list_record, get_page):
+        # Fetches (via ``get_page()``), parses and cleans the detail
+        # record.  Returns _SKIPPED if the record should be skipped.
+        self.logger.debug("Detail page is required")
+        try:
+            page = get_page()
+            start = time.time()
+            try:
+                detail_record = self.parse_detail(page, list_record)
+                detail_record = self.clean_detail_record(detail_record)
+            finally:
+                self._add_timing('parse', time.time() - start)
+        except SkipRecord, e:
+            self.num_skipped += 1
+            self.logger.debug("Skipping detail record for list %r: %s" % (list_record, e))
+            return _SKIPPED
+        except ScraperBroken, e:
+            # Re-raise the ScraperBroken with some additional helpful information.
+            raise ScraperBroken('%r -- %s' % (list_record, e))
+        self.logger.debug("Clean detail record: %r" % detail_record)
+        return detail_record
+
+    def _save_record(self, old_record, list_record, detail_record):
+        start = time.time()
+        try:
+            self.save(old_record, list_record, detail_record)
+        except SkipRecord, e:
+            self.logger.debug(u"Skipping list record during save: %r " % e)
+            self.num_skipped += 1
+        finally:
+            self._add_timing('save', time.time() - start)
 
+    def _timed_iter(self, iterable, name):
+        # Yields from iterable, counting the time spent in it as ``name``.
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
             try:
-                self.save(old_record, list_record, detail_record)
-            except SkipRecord, e:
-                self.logger.debug(u"Skipping list record during save: %r " % e)
-                self.num_skipped += 1
+                item = iterator.next()
+            finally:
+                self._add_timing(name, time.time() - start)
+            yield item
+
+    def _add_timing(self, name, seconds):
+        timings = self.__dict__.setdefault('timings',
+                                           dict.fromkeys(TIMING_NAMES, 0.0))
+        timings[name] += seconds
 
     def update_from_dir(self, dirname):
         """
@@ -216,6 +404,15 @@ class ListDetailScraper(BaseScraper):
     parse_detail_re = None
     has_detail = True
 
+    # To fetch detail pages in several threads at once, set this to
+    # the number of threads; see _update_from_string_pipelined().
+    detail_workers = 0
+    # Max concurrent detail requests to any one host.
+    detail_max_per_host = 2
+    # How many records to fetch ahead of the one being saved;
+    # default is 4 * detail_workers.
+    detail_fetch_ahead = None
+
     def list_pages(self):
         """
         Iterator that yields list pages, as strings.
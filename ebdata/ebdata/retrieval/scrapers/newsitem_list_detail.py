@@ -17,17 +17,160 @@
 #
 
 from django.conf import settings
+from django.contrib.gis.db.models import GeometryField
+from django.core.exceptions import ValidationError
+from django.db.models import Model, TextField
 from ebdata.retrieval.scrapers.list_detail import ListDetailScraper
 from ebdata.retrieval.utils import locations_are_close
 from ebpub.db.models import Schema, NewsItem, Lookup, DataUpdate, field_mapping
 from ebpub.geocoder import SmartGeocoder, GeocodingException, ParsingError, AmbiguousResult
 from ebpub.geocoder.reverse import reverse_geocode
+from ebpub.utils.dates import today
 
 import datetime
+import hashlib
 import pytz
 
 local_tz = pytz.timezone(settings.TIME_ZONE)
 
+
+class ExistingRecordIndex(object):
+    """
+    An in-memory index of the NewsItems of one Schema, keyed on the
+    values of some of their fields, so scrapers can find existing
+    records without a query per record.
+
+    The ids and key values of the Schema's NewsItems are loaded
+    with one query, the first time get() is called.  After that,
+    get() only queries the database to fetch NewsItems that matched.
+    Call add() after saving a NewsItem to keep the index current.
+
+    If ``min_date`` is given, only NewsItems with an item_date on or
+    after it are loaded, so the index grows with the scrape rather
+    than with the Schema's whole history.  Older NewsItems are still
+    found, with one query for each value that misses the index.
+
+    To keep the index small, text fields (eg. description) are
+    indexed by the MD5 of their values, computed by the database,
+    and geometry fields aren't loaded at all; both are compared
+    exactly in SQL when fetching the matches.  If all the fields are
+    geometries, there's nothing to index; see ``index_names``.
+    """
+
+    def __init__(self, schema, field_names, min_date=None):
+        self.schema_id = schema.id
+        self.min_date = min_date
+        self.field_names = tuple(field_names)
+        self._fields = dict([(f.name, f) for f in NewsItem._meta.fields
+                             if f.name in self.field_names])
+        # Fields kept in memory.
+        self.index_names = tuple([name for name in self.field_names
+                                  if not isinstance(self._fields[name], GeometryField)])
+        self._hashed_names = set([name for name in self.index_names
+                                  if isinstance(self._fields[name], TextField)])
+        self._rows = None  # id -> {field name: normalized value}
+        self._indexes = {}  # tuple of field names -> {key: set of ids}
+
+    def _normalize(self, name, value):
+        # Make python values from records and from the database
+        # comparable.
+        if isinstance(value, Model):
+            value = value.pk
+        if value is None:
+            return None
+        field = self._fields[name]
+        try:
+            if field.rel:
+                return field.rel.get_related_field().to_python(value)
+            value = field.to_python(value)
+        except (TypeError, ValueError, ValidationError):
+            return value
+        if name in self._hashed_names:
+            # Same as postgresql's md5() in a UTF8 database.
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            return hashlib.md5(value).hexdigest()
+        return value
+
+    def _load(self):
+        self._rows = {}
+        qs = NewsItem.objects.filter(schema__id=self.schema_id)
+        if self.min_date is not None:
+            qs = qs.filter(item_date__gte=self.min_date)
+        columns = []
+        select = {}
+        for name in self.index_names:
+            if name in self._hashed_names:
+                alias = 'md5_%s' % name
+                select[alias] = 'md5(db_newsitem.%s)' % self._fields[name].column
+                columns.append(alias)
+            else:
+                columns.append(name)
+        if select:
+            qs = qs.extra(select=select)
+        for row in qs.values_list('id', *columns).order_by():
+            values = {}
+            for name, value in zip(self.index_names, row[1:]):
+                if name not in self._hashed_names:
+                    value = self._normalize(name, value)
+                values[name] = value
+            self._rows[row[0]] = values
+
+    def _index(self, names):
+        index = self._indexes.get(names)
+        if index is None:
+            index = self._indexes[names] = {}
+            for newsitem_id, values in self._rows.items():
+                key = tuple([values[name] for name in names])
+                index.setdefault(key, set()).add(newsitem_id)
+        return index
+
+    def get(self, values):
+        """
+        Returns a list of the NewsItems whose fields match all the
+        field name -> value pairs in the ``values`` dict.
+        """
+        names = tuple(sorted([name for name in values.keys()
+                              if name in self.index_names]))
+        if not names:
+            return list(NewsItem.objects.filter(schema__id=self.schema_id, **values))
+        if self._rows is None:
+            self._load()
+        key = tuple([self._normalize(name, values[name]) for name in names])
+        ids = self._index(names).get(key)
+        if not ids:
+            if self.min_date is None:
+                return []
+            # It may be older than the index.
+            return list(NewsItem.objects.filter(schema__id=self.schema_id,
+                                                item_date__lt=self.min_date,
+                                                **values))
+        # Hashes can collide, and geometries aren't indexed.
+        exact = dict([(name, value) for (name, value) in values.items()
+                      if name not in names or name in self._hashed_names])
+        return list(NewsItem.objects.filter(id__in=ids, **exact))
+
+    def add(self, newsitem):
+        """
+        Adds a newly-saved NewsItem to the index, or updates the
+        index after changes to an existing one.
+        """
+        if self._rows is None:
+            # Not loaded yet; it'll be in there when we do.
+            return
+        values = dict([(name, self._normalize(
+                        name, getattr(newsitem, self._fields[name].attname)))
+                       for name in self.index_names])
+        old_values = self._rows.get(newsitem.id)
+        self._rows[newsitem.id] = values
+        for names, index in self._indexes.items():
+            if old_values is not None:
+                old_key = tuple([old_values[name] for name in names])
+                index.get(old_key, set()).discard(newsitem.id)
+            key = tuple([values[name] for name in names])
+            index.setdefault(key, set()).add(newsitem.id)
+
+
 class NewsItemListDetailScraper(ListDetailScraper):
     """
     A ListDetailScraper that saves its data into the NewsItem table.
@@ -61,6 +204,14 @@ class NewsItemListDetailScraper(ListDetailScraper):
     schema_slugs = None
     logname = None
 
+    # During update(), an ExistingRecordIndex, if
+    # existing_record_index_fields() returns any fields.
+    existing_record_index = None
+
+    # How far back existing_record_index loads NewsItems, by item_date;
+    # older ones are looked up with a query per record.  None means all.
+    existing_record_index_window = datetime.timedelta(days=90)
+
     def __init__(self, *args, **kwargs):
         if self.logname is None:
             self.logname = '%s.%s' % (settings.SHORT_NAME, self.schema_slugs[0])
@@ -137,6 +288,24 @@ class NewsItemListDetailScraper(ListDetailScraper):
         return Lookup.objects.get_or_create_lookup(sf, name, code, description, make_text_slug, self.logger)
 
 
+    def existing_record_index_fields(self):
+        """
+        Override this to return a list of NewsItem field names that
+        identify an existing record, to have update() build an
+        ExistingRecordIndex on them as ``self.existing_record_index``
+        for use in existing_record().
+
+        Default is None, meaning no index.
+        """
+        return None
+
+    def create_or_update(self, old_record, attributes, **kwargs):
+        newsitem = super(NewsItemListDetailScraper, self).create_or_update(
+            old_record, attributes, **kwargs)
+        if self.existing_record_index is not None and newsitem is not None:
+            self.existing_record_index.add(newsitem)
+        return newsitem
+
 
     def update(self):
         """
@@ -146,6 +315,17 @@ class NewsItemListDetailScraper(ListDetailScraper):
         self.num_changed = 0
         update_start = datetime.datetime.now()
 
+        index_fields = None
+        if len(self.schema_slugs) == 1:
+            index_fields = self.existing_record_index_fields()
+        if index_fields:
+            min_date = None
+            if self.existing_record_index_window is not None:
+                min_date = today() - self.existing_record_index_window
+            index = ExistingRecordIndex(self.schema, index_fields, min_date)
+            if index.index_names:
+                self.existing_record_index = index
+
         # We use a try/finally here so that the DataUpdate object is created
         # regardless of whether the scraper raised an exception.
         try:
@@ -153,6 +333,8 @@ class NewsItemListDetailScraper(ListDetailScraper):
             super(NewsItemListDetailScraper, self).update()
             got_error = False
         finally:
+            self.existing_record_index = None
+
             # Rollback, in case the database is in an aborted
             # transaction. This avoids the "psycopg2.ProgrammingError:
             # current transaction is aborted, commands ignored until
@@ -16,10 +16,15 @@
 #   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import BaseHTTPServer
+import SocketServer
 import datetime
 import django.test
 import mock
 import os
+import threading
+import time
+import unittest
 HERE = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -129,6 +134,218 @@ class TestBaseScraper(django.test.TestCase):
                          (args, kwargs))
 
 
+class TestListDetailScraper(unittest.TestCase):
+
+    def _make_scraper(self, **attrs):
+        from ebdata.retrieval.scrapers.list_detail import ListDetailScraper
+        from ebdata.retrieval.scrapers.list_detail import SkipRecord
+
+        class DummyScraper(ListDetailScraper):
+            def parse_list(self, page):
+                for i in range(int(page)):
+                    yield {'id': i}
+            def existing_record(self, record):
+                return None
+            def detail_required(self, list_record, old_record):
+                return list_record['id'] % 5 != 0
+            def get_detail(self, record):
+                # Finish out of order.
+                time.sleep((10 - record['id'] % 10) * 0.001)
+                if record['id'] % 7 == 0:
+                    raise SkipRecord('nope')
+                self.fetch_threads.add(threading.currentThread())
+                return 'detail %d' % record['id']
+            def parse_detail(self, page, list_record):
+                return {'page': page}
+            def save(self, old_record, list_record, detail_record):
+                self.saved.append((list_record['id'], detail_record))
+
+        scraper = DummyScraper(use_cache=False)
+        scraper.logger = mock.Mock()
+        scraper.retriever = mock.Mock()
+        scraper.saved = []
+        scraper.fetch_threads = set()
+        for key, val in attrs.items():
+            setattr(scraper, key, val)
+        return scraper
+
+    def test_update_from_string__pipelined(self):
+        serial = self._make_scraper()
+        serial.update_from_string('40')
+        self.assertEqual(serial.fetch_threads, set([threading.currentThread()]))
+
+        pipelined = self._make_scraper(detail_workers=4)
+        pipelined.update_from_string('40')
+        self.assertEqual(pipelined.saved, serial.saved)
+        self.assertEqual(pipelined.num_skipped, serial.num_skipped)
+        self.assertEqual(pipelined.num_skipped, 4)
+        self.assertEqual(pipelined.saved[:3],
+                         [(0, None), (1, {'page': 'detail 1'}),
+                          (2, {'page': 'detail 2'})])
+        self.assert_(threading.currentThread() not in pipelined.fetch_threads)
+        self.assert_(pipelined.timings['fetch'] > 0)
+        self.assertEqual(sorted(pipelined.timings.keys()),
+                         ['fetch', 'lookup', 'parse', 'save', 'wait'])
+
+    def test_update_from_string__pipelined_error(self):
+        from ebdata.retrieval.scrapers.list_detail import StopScraping
+        scraper = self._make_scraper(detail_workers=2)
+        def get_detail(record):
+            if record['id'] == 3:
+                raise StopScraping()
+            return 'detail'
+        scraper.get_detail = get_detail
+        self.assertRaises(StopScraping, scraper.update_from_string, '20')
+        self.assertEqual([saved[0] for saved in scraper.saved], [0, 1, 2])
+
+    def test_update_from_string__pipelined_repeats(self):
+        # A record repeated within the fetch-ahead window
+        # is only created once.
+        scraper = self._make_scraper(detail_workers=2)
+        scraper.parse_list = lambda page: [{'id': i} for i in [1, 2, 1, 3, 2]]
+        def existing_record(record):
+            return dict(scraper.saved).get(record['id'])
+        def save(old_record, list_record, detail_record):
+            if old_record is None:
+                scraper.saved.append((list_record['id'], detail_record))
+        scraper.existing_record = existing_record
+        scraper.save = save
+        scraper.update_from_string('')
+        self.assertEqual([saved[0] for saved in scraper.saved], [1, 2, 3])
+
+
+class TestHostLimiter(unittest.TestCase):
+
+    def test_max_per_host(self):
+        from ebdata.retrieval.retrievers import HostLimiter
+        limiter = HostLimiter(max_per_host=1)
+        limiter.acquire('http://example.com/a')
+        # Other hosts aren't blocked.
+        limiter.acquire('http://example.org/a')
+        acquired = []
+        def acquire():
+            limiter.acquire('http://EXAMPLE.com/b')
+            acquired.append(True)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join(0.05)
+        self.assertEqual(acquired, [])
+        limiter.release('http://example.com/a')
+        thread.join(1)
+        self.assertEqual(acquired, [True])
+
+    @mock.patch('ebdata.retrieval.retrievers.time')
+    def test_min_interval(self, mock_time):
+        from ebdata.retrieval.retrievers import HostLimiter
+        limiter = HostLimiter(max_per_host=5, min_interval=2)
+        mock_time.time.return_value = 100.0
+        limiter.acquire('http://example.com/a')
+        self.assertEqual(mock_time.sleep.call_count, 0)
+        limiter.acquire('http://example.com/b')
+        self.assertEqual(mock_time.sleep.call_args, ((2.0,), {}))
+        limiter.acquire('http://example.com/c')
+        self.assertEqual(mock_time.sleep.call_args, ((4.0,), {}))
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # A tiny HTTP server for testing Retriever.fetch_many().
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path == '/etag':
+            if self.headers.get('if-none-match') == '"v1"':
+                return self._respond(304, '', etag='"v1"')
+            return self._respond(200, 'tagged', etag='"v1"')
+        if self.path == '/flaky' and self.requests.count('/flaky') == 1:
+            return self._respond(503, 'try later')
+        if self.path == '/broken':
+            return self._respond(500, 'oops')
+        return self._respond(200, 'content of %s' % self.path)
+
+    def _respond(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestRetriever(unittest.TestCase):
+
+    def setUp(self):
+        _StandInHandler.requests = []
+        self.server = _StandInServer(('127.0.0.1', 0), _StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_retriever(self):
+        from ebdata.retrieval.retrievers import Retriever
+        retriever = Retriever(cache=None)
+        retriever.retry_backoff = 0
+        return retriever
+
+    def test_fetch_many(self):
+        retriever = self._make_retriever()
+        uris = [self.base + '/page/%d' % i for i in range(10)]
+        results = retriever.fetch_many(uris, max_workers=3)
+        self.assertEqual([r.uri for r in results], uris)
+        self.assertEqual([r.content for r in results],
+                         ['content of /page/%d' % i for i in range(10)])
+        self.assertEqual([r.error for r in results], [None] * 10)
+        stats = retriever.stats.as_dict()['127.0.0.1:%d' % self.server.server_address[1]]
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['errors'], 0)
+        self.assert_(stats['mean_time'] > 0)
+
+    def test_fetch_many__errors_and_retries(self):
+        from ebdata.retrieval.retrievers import RetrievalError
+        retriever = self._make_retriever()
+        flaky, broken = retriever.fetch_many([self.base + '/flaky',
+                                              self.base + '/broken'])
+        self.assertEqual(flaky.content, 'content of /flaky')
+        self.assertEqual(flaky.error, None)
+        self.assertEqual(_StandInHandler.requests.count('/flaky'), 2)
+        self.assert_(isinstance(broken.error, RetrievalError))
+        self.assertEqual(_StandInHandler.requests.count('/broken'),
+                         retriever.max_attempts)
+
+    def test_fetch_many__unchanged(self):
+        retriever = self._make_retriever()
+        uri = self.base + '/etag'
+        first, = retriever.fetch_many([uri])
+        self.assertEqual(first.content, 'tagged')
+        self.assertEqual(first.unchanged, False)
+        second, = retriever.fetch_many([uri])
+        self.assertEqual(second.unchanged, True)
+        self.assertEqual(second.content, None)
+
+    @mock.patch('ebdata.retrieval.retrievers.time.sleep')
+    def test_retry_backoff(self, mock_sleep):
+        from ebdata.retrieval.retrievers import RetrievalError
+        retriever = self._make_retriever()
+        retriever.retry_backoff = 0.5
+        self.assertRaises(RetrievalError, retriever.fetch_data,
+                          self.base + '/broken')
+        self.assertEqual(mock_sleep.call_args_list,
+                         [((0.5,), {}), ((1.0,), {})])
+
+
 class TestCreateNewsitem(django.test.TestCase):
 
     # Use hardcoded path so I don't have to make this into an app
@@ -202,3 +419,42 @@ class TestCreateNewsitem(django.test.TestCase):
         self.assertEqual(item.title, 'Kurtzman')
 
 
+
+    def test_create_or_update_many(self):
+        from ebpub.db.models import NewsItem
+        scraper = self._make_scraper()
+        schema = self._get_schema()
+        existing = scraper.create_newsitem({'attr1': 'old'},
+                                           title=u'Existing',
+                                           item_date=datetime.date(2012, 2, 1),
+                                           location_name='123 Anywhere',
+                                           schema=schema)
+        scraper.num_added = 0
+        records = []
+        for i in range(5):
+            records.append((None, {'attr1': 'value %d' % i},
+                            {'title': u'Bulk %d' % i,
+                             'item_date': datetime.date(2012, 3, 1),
+                             'location_name': 'Potrzebie',
+                             'schema': schema}))
+        # A duplicate of an earlier new record, and an update.
+        records.append(records[0])
+        records.append((existing, {'attr1': 'new'}, {'title': u'Changed'}))
+
+        items = scraper.create_or_update_many(records, chunk_size=3)
+        self.assertEqual(len(items), 7)
+        self.assertEqual(scraper.num_added, 5)
+        self.assertEqual(scraper.num_changed, 1)
+        self.assertEqual(scraper.num_skipped, 1)
+        self.assert_(items[5] is items[0])
+        self.assertEqual(items[6].id, existing.id)
+
+        saved = NewsItem.objects.filter(title__startswith=u'Bulk').order_by('title')
+        self.assertEqual([item.id for item in items[:5]],
+                         [item.id for item in saved])
+        self.assertEqual([item.attributes['attr1'] for item in saved],
+                         ['value %d' % i for i in range(5)])
+        self.assert_(saved[0].last_modification is not None)
+        existing = NewsItem.objects.get(id=existing.id)
+        self.assertEqual(existing.title, u'Changed')
+        self.assertEqual(existing.attributes['attr1'], 'new')
@@ -62,7 +62,10 @@ class RssScraper(RssListDetailScraper, NewsItemListDetailScraper):
 
     def existing_record(self, record):
         url = record.get('id', '') or record.link
-        qs = list(NewsItem.objects.filter(schema__id=self.schema.id, url=url))
+        if self.existing_record_index is not None:
+            qs = self.existing_record_index.get({'url': url})
+        else:
+            qs = list(NewsItem.objects.filter(schema__id=self.schema.id, url=url))
         if not qs:
             return None
 
@@ -70,6 +73,9 @@ class RssScraper(RssListDetailScraper, NewsItemListDetailScraper):
             self.logger.warn("Multiple entries matched url %r and schema %r. Expected unique! Using first one." % (url, qs[0].schema.slug))
         return qs[0]
 
+    def existing_record_index_fields(self):
+        return ('url',)
+
     def clean_list_record(self, record):
         record.title = convert_entities(record['title'])
         record.description = convert_entities(record['description'])
@@ -22,7 +22,8 @@
 from django.contrib.gis.geos import Point
 from ebpub.utils.geodjango import get_default_bounds
 from ebpub.db.models import Schema, SchemaField, NewsItem, Lookup
-from ebpub.geocoder.reverse import reverse_geocode
+from ebpub.geocoder.reverse import reverse_geocode, reverse_geocode_many
+from ebpub.geocoder.reverse import ReverseGeocodeError
 from httplib2 import Http
 from lxml import etree
 import datetime
@@ -156,11 +157,52 @@ class GeoReportV2Scraper(object):
         if response.fromcache:
             log.info("Requests from this time period are unchanged since last update (cached)")
         else:
+            location_names = self._reverse_geocode_requests(reqs)
             for req in reqs:
-                self._update_service_request(req)
+                self._update_service_request(req, location_names)
         return len(list(reqs))
 
-    def _update_service_request(self, sreq):
+    def _get_point(self, sreq):
+        try:
+            return Point(float(sreq.find('long').text),
+                         float(sreq.find('lat').text),
+                         srid=4326)
+        except:
+            return None
+
+    def _reverse_geocode_requests(self, reqs):
+        """Reverse-geocode, in one batch, all requests that have
+        a valid location but no address.
+        Returns a dict mapping service_request_id to location name.
+        """
+        ids, points = [], []
+        for sreq in reqs:
+            if self._get_request_field(sreq, 'address'):
+                continue
+            service_request_id = self._get_request_field(sreq, 'service_request_id')
+            point = self._get_point(sreq)
+            if not service_request_id or point is None:
+                continue
+            if self.bounds is not None and not self.bounds.intersects(point):
+                continue
+            ids.append(service_request_id)
+            points.append(point)
+        location_names = {}
+        if points:
+            for service_request_id, result in zip(ids, reverse_geocode_many(points)):
+                if isinstance(result, ReverseGeocodeError):
+                    log.debug("Failed to reverse geocode item %s" % service_request_id)
+                else:
+                    block, distance = result
+                    location_names[service_request_id] = block.pretty_name
+        return location_names
+
+    def _update_service_request(self, sreq, location_names=None):
+        """
+        If ``location_names`` is given, it should be a dict of
+        already reverse-geocoded names as returned by
+        _reverse_geocode_requests().
+        """
         service_request_id = self._get_request_field(sreq, 'service_request_id')
 
         if not service_request_id:
@@ -169,11 +211,8 @@ class GeoReportV2Scraper(object):
 
 
         # pull out the location first, if we can't do this, we don't want it.
-        try:
-            point = Point(float(sreq.find('long').text), 
-                          float(sreq.find('lat').text),
-                          srid=4326)
-        except: 
+        point = self._get_point(sreq)
+        if point is None:
             log.debug("Skipping request with invalid location (%s)" % service_request_id)
             return
         if self.bounds is not None:
@@ -194,7 +233,9 @@ class GeoReportV2Scraper(object):
         ni.location = point
         ni.location_name = self._get_request_field(sreq, 'address')
         # try to reverse geocde this point
-        if not ni.location_name:
+        if not ni.location_name and location_names is not None:
+            ni.location_name = location_names.get(service_request_id, ni.location_name)
+        elif not ni.location_name:
             try:
                 block, distance = reverse_geocode(ni.location)
                 ni.location_name = block.pretty_name
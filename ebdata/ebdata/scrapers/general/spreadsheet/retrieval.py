@@ -241,7 +241,10 @@ class SpreadsheetScraper(NewsItemListDetailScraper):
 
         if not query_args:
             return None
-        qs = list(NewsItem.objects.filter(schema__id=self.schema.id, **query_args))
+        if self.existing_record_index is not None:
+            qs = self.existing_record_index.get(query_args)
+        else:
+            qs = list(NewsItem.objects.filter(schema__id=self.schema.id, **query_args))
         if not qs:
             return None
         if len(qs) > 1:
@@ -249,6 +252,20 @@ class SpreadsheetScraper(NewsItemListDetailScraper):
         return qs[0]
 
 
+    def existing_record_index_fields(self):
+        """
+        Lets update() look up existing records in memory, using
+        the same fields as existing_record().
+        """
+        from ebpub.db.models import NewsItem
+        unique_fields = self.unique_fields or get_default_unique_field_names()
+        known = set([f.name for f in NewsItem._meta.fields])
+        if [f for f in unique_fields if f not in known]:
+            # Can't index those; existing_record() will query instead.
+            return None
+        return unique_fields
+
+
     def clean_list_record(self, list_record):
         """
         Given a dict, prepare it for saving as a newsitem.
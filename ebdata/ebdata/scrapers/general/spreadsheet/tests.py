@@ -200,6 +200,101 @@ class TestCsvScraper(django.test.TestCase):
         finally:
             ni.delete()
 
+    def test_existing_record__index(self):
+        from ebdata.retrieval.scrapers.newsitem_list_detail import ExistingRecordIndex
+        from ebpub.db.models import NewsItem
+        scraper = self._make_scraper()
+        schema = self._get_schema()
+        record = {'title': 't1', 'location_name': 'ln1', 'description': 'd1',
+                  'schema': schema,
+                  }
+        ni = NewsItem.objects.create(**record)
+        self.assertEqual(scraper.existing_record_index_fields(),
+                         ['description', 'location', 'location_name',
+                          'location_object', 'title', 'url'])
+        scraper.unique_fields = ('title', 'location_name')
+        scraper.existing_record_index = ExistingRecordIndex(
+            schema, scraper.existing_record_index_fields())
+        # One query to load the index, one to fetch the match.
+        with self.assertNumQueries(2):
+            self.assertEqual(scraper.existing_record(record), ni)
+        # No queries for a miss.
+        with self.assertNumQueries(0):
+            self.assertEqual(scraper.existing_record(dict(record, title='t2')), None)
+        # Only non-empty fields are used.
+        with self.assertNumQueries(1):
+            self.assertEqual(scraper.existing_record(dict(record, title='')), ni)
+
+        # Newly saved items are added to the index.
+        ni2 = scraper.create_or_update(None, {}, title=u't2', location_name=u'ln1',
+                                       item_date=ni.item_date, schema=schema)
+        self.assertEqual(scraper.existing_record(dict(record, title='t2')), ni2)
+        # ... and updated ones re-indexed.
+        scraper.create_or_update(ni2, {}, title=u't3')
+        self.assertEqual(scraper.existing_record(dict(record, title='t2')), None)
+        self.assertEqual(scraper.existing_record(dict(record, title='t3')), ni2)
+
+    def test_existing_record__index__text_and_geometry(self):
+        from ebdata.retrieval.scrapers.newsitem_list_detail import ExistingRecordIndex
+        from ebpub.db.models import NewsItem
+        schema = self._get_schema()
+        record = {'title': 't1', 'description': u'd\xe9scription',
+                  'location': 'POINT (1 2)', 'schema': schema,
+                  }
+        ni = NewsItem.objects.create(**record)
+        index = ExistingRecordIndex(schema, ['description', 'location', 'title'])
+        # Geometries are only compared in SQL.
+        self.assertEqual(index.index_names, ('description', 'title'))
+        args = {'title': 't1', 'description': u'd\xe9scription', 'location': 'POINT (1 2)'}
+        with self.assertNumQueries(2):
+            self.assertEqual(index.get(args), [ni])
+        self.assertEqual(index.get(dict(args, location='POINT (2 1)')), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(index.get(dict(args, description=u'other')), [])
+        # Descriptions are held as hashes, not the full text.
+        self.assertEqual(index._rows[ni.id]['description'],
+                         index._normalize('description', u'd\xe9scription'))
+        self.assertEqual(len(index._rows[ni.id]['description']), 32)
+
+        # Nothing to index with only a geometry.
+        only_geom = ExistingRecordIndex(schema, ['location'])
+        self.assertEqual(only_geom.index_names, ())
+        self.assertEqual(only_geom.get({'location': 'POINT (1 2)'}), [ni])
+
+    def test_existing_record__index__window(self):
+        import datetime
+        from ebdata.retrieval.scrapers.newsitem_list_detail import ExistingRecordIndex
+        from ebpub.db.models import NewsItem
+        schema = self._get_schema()
+        old = NewsItem.objects.create(schema=schema, title=u'old',
+                                      item_date=datetime.date(2011, 1, 1))
+        new = NewsItem.objects.create(schema=schema, title=u'new',
+                                      item_date=datetime.date(2012, 1, 1))
+        index = ExistingRecordIndex(schema, ['title'],
+                                    min_date=datetime.date(2011, 6, 1))
+        with self.assertNumQueries(2):
+            self.assertEqual(index.get({'title': u'new'}), [new])
+        # Only recent items are loaded...
+        self.assertEqual(index._rows.keys(), [new.id])
+        # ... but older ones are still found, with one query.
+        with self.assertNumQueries(1):
+            self.assertEqual(index.get({'title': u'old'}), [old])
+        with self.assertNumQueries(1):
+            self.assertEqual(index.get({'title': u'neither'}), [])
+
+    def test_update__builds_index(self):
+        scraper = self._make_scraper()
+        indexes = []
+        def list_pages():
+            indexes.append(scraper.existing_record_index)
+            return []
+        scraper.list_pages = list_pages
+        scraper.update()
+        self.assertEqual(len(indexes), 1)
+        self.assertNotEqual(indexes[0], None)
+        self.assertNotEqual(indexes[0].min_date, None)
+        self.assertEqual(scraper.existing_record_index, None)
+
 
 def suite():
     import doctest
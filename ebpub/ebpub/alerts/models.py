@@ -49,6 +49,9 @@ class EmailAlert(models.Model):
     signup_date = models.DateTimeField()
     cancel_date = models.DateTimeField(blank=True, null=True)
     is_active = models.BooleanField()
+    last_sent_date = models.DateField(blank=True, null=True,
+        help_text="The last day covered by the most recent alert sent (or found to "
+        "have no news). Used to avoid sending the same alert twice.")
 
     objects = models.Manager()
     active_objects = ActiveAlertsManager()
@@ -16,136 +16,468 @@
 #   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+"""
+Sends email alerts.
+
+Alerts that would get the same news -- the same Location, or the same
+block and radius, and the same set of Schemas -- are grouped.  The
+news for all the groups is found with one query, joining the recently
+published NewsItems to all the alerts' areas, and each group's email
+is rendered just once; only the email address and unsubscribe link
+differ between subscribers.  Messages
+are sent by one or more worker threads, each reusing one connection
+to the mail server.
+
+Each alert's ``last_sent_date`` is updated as soon as it's sent (or
+found to have no news), so if a run is interrupted, running it again
+the same day will pick up where it left off.
+"""
+
 from django.conf import settings
 from django.core.mail import get_connection, EmailMultiAlternatives
+from django.db import connection
 from django.template.loader import render_to_string
+from django.utils.html import escape
 from ebpub.alerts.models import EmailAlert
 from ebpub.db.models import NewsItem
 from ebpub.db.utils import populate_attributes_if_needed
 from ebpub.db.utils import make_search_buffer
 from ebpub.streets.models import Block
 import datetime
+import logging
+import Queue
+import threading
+
+logger = logging.getLogger('ebpub.alerts.sending')
+
+# Stand-ins for the parts of a message that differ per subscriber.
+EMAIL_ADDRESS_PLACEHOLDER = u'EMAIL-ADDRESS-PLACEHOLDER'
+UNSUBSCRIBE_URL_PLACEHOLDER = u'UNSUBSCRIBE-URL-PLACEHOLDER'
 
 class NoNews(Exception):
     pass
 
-def email_text_for_place(alert, place, place_name, place_url,
-                         news_groups, date, frequency):
+def render_email(place, place_name, place_url, news_groups, date,
+                 frequency, radius=None):
     """
-    Returns a tuple of (text, html) for the given args. `text` is the text-only
-    e-mail, and `html` is the HTML version.
+    Returns a tuple of (text, html) for the given args, with
+    placeholders for the subscriber's email address and unsubscribe
+    URL; see :py:func:`personalize_email`.
     """
     domain = settings.EB_DOMAIN
     context = {
         'place': place,
         'is_block': isinstance(place, Block),
-        'block_radius': isinstance(place, Block) and alert.radius or None,
+        'block_radius': isinstance(place, Block) and radius or None,
         'domain': domain,
-        'email_address': alert.user.email,
+        'email_address': EMAIL_ADDRESS_PLACEHOLDER,
         'place_name': place_name,
         'place_url': place_url,
         'news_groups': news_groups,
         'date': date,
         'frequency': frequency,
-        'unsubscribe_url': alert.unsubscribe_url(),
+        'unsubscribe_url': UNSUBSCRIBE_URL_PLACEHOLDER,
     }
     return render_to_string('alerts/email.txt', context), render_to_string('alerts/email.html', context)
 
-def email_for_subscription(alert, start_date, frequency):
+def personalize_email(alert, text, html):
     """
-    Returns a (place_name, text, html) tuple for the given EmailAlert
-    object and date.
+    Fills in the placeholders in (text, html) from
+    :py:func:`render_email` for the given EmailAlert.
     """
-    start_datetime = datetime.datetime(start_date.year, start_date.month, start_date.day)
-    yesterday = datetime.date.today() - datetime.timedelta(days=1)
-    end_datetime = datetime.datetime.combine(yesterday, datetime.time(23, 59, 59, 9999)) # the end of yesterday
+    email, url = alert.user.email, alert.unsubscribe_url()
+    text = text.replace(EMAIL_ADDRESS_PLACEHOLDER, email)
+    text = text.replace(UNSUBSCRIBE_URL_PLACEHOLDER, url)
+    html = html.replace(EMAIL_ADDRESS_PLACEHOLDER, escape(email))
+    html = html.replace(UNSUBSCRIBE_URL_PLACEHOLDER, escape(url))
+    return text, html
 
-    from ebpub.utils.view_utils import get_schema_manager_for_user
-    manager = get_schema_manager_for_user(alert.user)
-    allowed_schemas = manager.allowed_schema_ids()
-    qs = NewsItem.objects.select_related().filter(schema__id__in=allowed_schemas)
+def email_text_for_place(alert, place, place_name, place_url,
+                         news_groups, date, frequency):
+    """
+    Returns a tuple of (text, html) for the given args. `text` is the text-only
+    e-mail, and `html` is the HTML version.
+    """
+    text, html = render_email(place, place_name, place_url, news_groups,
+                              date, frequency, alert.radius)
+    return personalize_email(alert, text, html)
+
+def alert_schema_ids(alert, allowed_schema_ids):
+    """
+    Returns a frozenset of the ids of the Schemas that the EmailAlert
+    should include, out of ``allowed_schema_ids``.
+    """
+    allowed = frozenset(allowed_schema_ids)
+    ids = frozenset([int(i) for i in alert.schemas.split(',') if i.strip()])
     if alert.include_new_schemas:
         # We saved an opt-out list.
-        if alert.schemas:
-            qs = qs.exclude(schema__id__in=alert.schemas.split(','))
-    else:
+        return allowed - ids
+    elif ids:
         # We saved an opt-in list.
-        if alert.schemas:
-            qs = qs.filter(schema__id__in=alert.schemas.split(','))
+        return allowed & ids
+    return allowed
 
+def place_key(alert):
+    """
+    Alerts with the same key are for the same place.
+    Returns None if the alert has no place.
+    """
     if alert.block_center:
-        place = alert._get_block()
-        place_name, place_url = place.pretty_name, place.url()
-        search_buffer = make_search_buffer(place.geom.centroid, alert.radius)
-        qs = qs.filter(location__bboverlaps=search_buffer)
+        return ('block', alert.block_center.x, alert.block_center.y, alert.radius)
+    elif alert.location_id:
+        return ('location', alert.location_id)
+    return None
+
+def alert_period(start_date):
+    """
+    Returns the (start, end) datetimes of the news to send, from the
+    start of ``start_date`` to the end of yesterday.
+    """
+    start_datetime = datetime.datetime(start_date.year, start_date.month, start_date.day)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    end_datetime = datetime.datetime.combine(yesterday, datetime.time(23, 59, 59, 9999)) # the end of yesterday
+    return start_datetime, end_datetime
 
+def alert_place(alert, blocks=None):
+    """
+    Returns a (place, place_name, place_url, area) tuple for the
+    EmailAlert, where ``area`` is either a search buffer geometry or
+    a Location id; see :py:func:`match_alert_areas`.
+
+    ``blocks`` is an optional dict for caching Blocks by center point.
+    """
+    if alert.block_center:
+        center = (alert.block_center.x, alert.block_center.y)
+        if blocks is None:
+            blocks = {}
+        if center not in blocks:
+            blocks[center] = alert._get_block()
+        place = blocks[center]
+        area = make_search_buffer(place.geom.centroid, alert.radius)
+        return place, place.pretty_name, place.url(), area
     elif alert.location:
-        place_name, place_url = alert.location.name, alert.location.url()
         place = alert.location
-        qs = qs.filter(newsitemlocation__location__id=alert.location.id)
-
-    # Order by schema__id to group schemas together.
-    news_qs = qs.filter(schema__is_event=False,
-                        pub_date__range=(start_datetime, end_datetime),
-                        ).order_by('-schema__importance', 'schema__id', '-item_date', '-id')
-    events_qs = qs.filter(schema__is_event=True,
-                         pub_date__range=(start_datetime, end_datetime),
-                         ).order_by('-schema__importance', 'schema__id', 'item_date', 'id')
-
-    news_list = list(news_qs)
-    events_list = list(events_qs)
-    if not (news_list or events_list):
+        return place, place.name, place.url(), place.id
+    raise ValueError("Alert %s has no location or block" % alert.id)
+
+def match_alert_areas(areas, start_datetime, end_datetime, schema_ids):
+    """
+    Finds the NewsItems of the given Schemas published between
+    start_datetime and end_datetime that are in each of the areas,
+    with one query no matter how many areas there are.
+
+    ``areas`` is a dict mapping keys to either search buffer
+    geometries (as from make_search_buffer()), which match NewsItems
+    whose location overlaps their bounding box, or Location ids,
+    which match NewsItems in that Location.
+
+    Returns a dict mapping keys to lists of (NewsItem id, Schema id)
+    pairs; keys with no matches are left out.
+    """
+    keys = areas.keys()
+    buffer_rows, buffer_params = [], []
+    location_rows, location_params = [], []
+    for i, key in enumerate(keys):
+        area = areas[key]
+        if isinstance(area, (int, long)):
+            location_rows.append('(%s, %s)')
+            location_params.extend([i, area])
+        else:
+            buffer_rows.append('(%s, ST_GeomFromText(%s, %s))')
+            buffer_params.extend([i, area.wkt, area.srid or 4326])
+    schema_ids = list(schema_ids)
+    if not (schema_ids and keys):
+        return {}
+    condition = ('ni.pub_date BETWEEN %%s AND %%s AND ni.schema_id IN (%s)'
+                 % ', '.join(['%s'] * len(schema_ids)))
+    condition_params = [start_datetime, end_datetime] + schema_ids
+    queries, params = [], []
+    if buffer_rows:
+        queries.append(
+            """SELECT a.idx, ni.id, ni.schema_id
+            FROM db_newsitem ni, (VALUES %s) AS a(idx, geom)
+            WHERE ni.location && a.geom AND %s""" % (', '.join(buffer_rows), condition))
+        params.extend(buffer_params + condition_params)
+    if location_rows:
+        queries.append(
+            """SELECT a.idx, ni.id, ni.schema_id
+            FROM db_newsitem ni
+            INNER JOIN db_newsitemlocation nil ON nil.news_item_id = ni.id
+            INNER JOIN (VALUES %s) AS a(idx, location_id) ON nil.location_id = a.location_id
+            WHERE %s""" % (', '.join(location_rows), condition))
+        params.extend(location_params + condition_params)
+    cursor = connection.cursor()
+    cursor.execute(' UNION ALL '.join(queries), params)
+    matches = {}
+    for idx, newsitem_id, schema_id in cursor.fetchall():
+        matches.setdefault(keys[idx], []).append((newsitem_id, schema_id))
+    return matches
+
+def load_newsitems(newsitem_ids):
+    """
+    Returns a dict of NewsItems by id, with their Schemas and
+    Attributes loaded as needed for the email templates.
+    """
+    newsitems = list(NewsItem.objects.select_related().filter(id__in=newsitem_ids))
+    schemas_used = set([ni.schema for ni in newsitems])
+    populate_attributes_if_needed(newsitems, list(schemas_used))
+    return dict([(ni.id, ni) for ni in newsitems])
+
+def render_news(place, place_name, place_url, newsitems, start_date,
+                frequency, radius=None):
+    """
+    Returns a (text, html) tuple listing the given NewsItems, with
+    placeholders for the subscriber; see :py:func:`personalize_email`.
+
+    Raises NoNews if there's nothing to send.
+    """
+    if not newsitems:
         raise NoNews
-    schemas_used = set([ni.schema for ni in news_list + events_list])
-    populate_attributes_if_needed(news_list, list(schemas_used))
-    populate_attributes_if_needed(events_list, list(schemas_used))
+    # Group schemas together.
+    news_list = sorted([ni for ni in newsitems if not ni.schema.is_event],
+                       key=lambda ni: (-ni.schema.importance, ni.schema_id,
+                                       -ni.item_date.toordinal(), -ni.id))
+    events_list = sorted([ni for ni in newsitems if ni.schema.is_event],
+                         key=lambda ni: (-ni.schema.importance, ni.schema_id,
+                                         ni.item_date, ni.id))
     newsitem_groups = ({'title': 'Recent', 'newsitems': news_list},
                        {'title': 'Upcoming', 'newsitems': events_list})
-    text, html = email_text_for_place(alert, place, place_name, place_url, newsitem_groups, start_date, frequency)
+    return render_email(place, place_name, place_url, newsitem_groups,
+                        start_date, frequency, radius)
+
+def email_for_group(alert, schema_ids, start_date, frequency):
+    """
+    Returns a (place_name, text, html) tuple for the EmailAlert's
+    place and the given Schema ids and date, with placeholders
+    for the subscriber; see :py:func:`personalize_email`.
+
+    Raises NoNews if there's nothing to send.
+    """
+    place, place_name, place_url, area = alert_place(alert)
+    start_datetime, end_datetime = alert_period(start_date)
+    matches = match_alert_areas({0: area}, start_datetime, end_datetime, schema_ids)
+    newsitems = load_newsitems([ni_id for (ni_id, schema_id) in matches.get(0, [])])
+    text, html = render_news(place, place_name, place_url, newsitems.values(),
+                             start_date, frequency, alert.radius)
     return place_name, text, html
 
-def send_all(frequency, verbose=False):
+def email_for_subscription(alert, start_date, frequency):
+    """
+    Returns a (place_name, text, html) tuple for the given EmailAlert
+    object and date.
+    """
+    from ebpub.utils.view_utils import get_schema_manager_for_user
+    manager = get_schema_manager_for_user(alert.user)
+    schema_ids = alert_schema_ids(alert, manager.allowed_schema_ids())
+    place_name, text, html = email_for_group(alert, schema_ids, start_date, frequency)
+    text, html = personalize_email(alert, text, html)
+    return place_name, text, html
+
+
+class MessageSender(object):
+    """
+    Sends email messages in ``workers`` threads, each of which reuses
+    one mail server connection until it gets an error.
+
+    Call send() for each message, collect the outcomes from results()
+    as you go, and call close() when done.
+    """
+
+    def __init__(self, workers=1):
+        self._queue = Queue.Queue(maxsize=max(1, workers) * 20)
+        self._results = Queue.Queue()
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def send(self, key, message):
+        """
+        Queues an EmailMessage for sending. ``key`` identifies
+        it in results().
+        """
+        self._queue.put((key, message))
+
+    def results(self):
+        """
+        Returns a list of (key, error) pairs for the messages finished
+        since the last call, where ``error`` is None if it was sent.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        """
+        Waits for all queued messages to be sent.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        conn = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            key, message = item
+            try:
+                if conn is None:
+                    conn = get_connection()  # Use default settings.
+                    conn.open()
+                conn.send_messages([message])
+            except Exception, e:
+                self._results.put((key, e))
+                # It may be broken; start a new one next time.
+                try:
+                    if conn is not None:
+                        conn.close()
+                except Exception:
+                    pass
+                conn = None
+            else:
+                self._results.put((key, None))
+        if conn is not None:
+            conn.close()
+
+
+def send_all(frequency, verbose=False, jobs=1):
     """
     Sends an e-mail to all alert subscribers in the system with data
-    with the given frequency (in days).
+    with the given frequency (in days), using ``jobs`` threads to send.
+
+    Alerts that have already been sent today (for the period ending
+    yesterday) are skipped, so it's safe to run this again after
+    an interrupted run.  But don't call send_all(frequency) more often
+    than ``frequency`` days for other reasons, or subscribers will get
+    overlapping news.
 
-    Note that it does not keep track of already-sent messages, so take
-    care not to call send_all(frequency) more often than ``frequency`` days.
+    Returns the number of messages sent.
     """
-    conn = get_connection() # Use default settings.
-    count = 0
     start_date = datetime.date.today() - datetime.timedelta(days=frequency)
-    for alert in EmailAlert.active_objects.filter(frequency=frequency):
+    end_date = datetime.date.today() - datetime.timedelta(days=1)
+    alerts = EmailAlert.active_objects.filter(frequency=frequency)
+    alerts = list(alerts.exclude(last_sent_date__gte=end_date).select_related('location'))
+
+    from ebpub.accounts.models import User
+    from ebpub.utils.view_utils import get_schema_manager_for_user
+    users = User.objects.in_bulk(set([alert.user_id for alert in alerts]))
+    groups = {}
+    group_keys = []
+    for alert in alerts:
+        alert._user_cache = users.get(alert.user_id)
+        if alert.user is None:
+            logger.warn("No user %s for alert %s, skipping" % (alert.user_id, alert.id))
+            continue
+        pkey = place_key(alert)
+        if pkey is None:
+            logger.warn("Alert %s has no location or block, skipping" % alert.id)
+            continue
+        manager = get_schema_manager_for_user(alert.user)
+        key = (pkey, alert_schema_ids(alert, manager.allowed_schema_ids()))
+        if key not in groups:
+            groups[key] = []
+            group_keys.append(key)
+        groups[key].append(alert)
+
+    # Find the news for all the places at once.
+    places, areas, blocks = {}, {}, {}
+    all_schema_ids = set()
+    for key in group_keys:
+        pkey, schema_ids = key
+        all_schema_ids.update(schema_ids)
+        if pkey in places:
+            continue
         try:
-            place_name, text_content, html_content = email_for_subscription(alert, start_date, frequency)
-        except NoNews:
+            place, place_name, place_url, area = alert_place(groups[key][0], blocks)
+        except Block.DoesNotExist, e:
+            logger.error("Skipping alerts for %s: %s" % (pkey, e))
             continue
-        subject = 'Update: %s' % place_name
-        message = EmailMultiAlternatives(subject, text_content, settings.GENERIC_EMAIL_SENDER,
-            [alert.user.email], connection=conn)
-        message.attach_alternative(html_content, 'text/html')
-        message.send()
-        if verbose:
-            print "Sent to %s" % alert.user.email
-        count += 1
-    return count
+        places[pkey] = (place, place_name, place_url)
+        areas[pkey] = area
+    start_datetime, end_datetime = alert_period(start_date)
+    matches = match_alert_areas(areas, start_datetime, end_datetime, all_schema_ids)
+    newsitems = load_newsitems(set([ni_id for pairs in matches.values()
+                                    for (ni_id, schema_id) in pairs]))
+
+    by_id = dict([(alert.id, alert) for alert in alerts])
+    counts = {'sent': 0, 'failed': 0}
+    def mark_done(alert_ids):
+        if alert_ids:
+            EmailAlert.objects.filter(id__in=alert_ids).update(last_sent_date=end_date)
+    def record(results):
+        sent = []
+        for alert_id, error in results:
+            email = by_id[alert_id].user.email
+            if error is None:
+                sent.append(alert_id)
+                if verbose:
+                    print "Sent to %s" % email
+            else:
+                counts['failed'] += 1
+                logger.error("Failed sending alert %s to %s: %s" % (alert_id, email, error))
+        mark_done(sent)
+        counts['sent'] += len(sent)
+
+    sender = MessageSender(jobs)
+    try:
+        for key in group_keys:
+            pkey, schema_ids = key
+            group = groups[key]
+            if pkey not in places:
+                continue
+            place, place_name, place_url = places[pkey]
+            group_items = [newsitems[ni_id] for (ni_id, schema_id) in matches.get(pkey, ())
+                           if schema_id in schema_ids and ni_id in newsitems]
+            try:
+                text, html = render_news(place, place_name, place_url, group_items,
+                                         start_date, frequency, group[0].radius)
+            except NoNews:
+                mark_done([alert.id for alert in group])
+                continue
+            subject = 'Update: %s' % place_name
+            for alert in group:
+                text_content, html_content = personalize_email(alert, text, html)
+                message = EmailMultiAlternatives(subject, text_content, settings.GENERIC_EMAIL_SENDER,
+                    [alert.user.email])
+                message.attach_alternative(html_content, 'text/html')
+                sender.send(alert.id, message)
+            record(sender.results())
+    finally:
+        sender.close()
+        record(sender.results())
+    if counts['failed']:
+        logger.error("Failed to send %d messages" % counts['failed'])
+    return counts['sent']
 
 def main(argv=None):
+    import sys
     if argv is None:
-        import sys
         argv = sys.argv[1:]
     from optparse import OptionParser
     freq_choices = {'daily': 1, 'weekly': 7}
     usage = """usage: %prog [options]\nSends OpenBlock email alerts.
 
-Warning, the system does not keep track of which alerts you've already sent.
-Eg. you should run this script with --frequency='daily' exactly once per day,
-NOT more, or you will send duplicate email.
+Each alert is sent at most once per day; if a run is interrupted,
+running it again the same day sends only the alerts not yet sent.
+But you should run this script with --frequency='daily' once per day,
+and --frequency='weekly' once per week, or subscribers will get
+overlapping news.
 """
     optparser = OptionParser(usage=usage)
     optparser.add_option('-f', '--frequency', type="choice",
                          choices=freq_choices.keys(),
                          help='Which email alerts to send (choices: %s)' % ', '.join(freq_choices.keys()))
+    optparser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                         help='Number of messages to send at once. Default %default.')
     optparser.add_option('-v', '--verbose', action='store_true')
     opts, args = optparser.parse_args(argv)
     try:
@@ -154,6 +486,5 @@ NOT more, or you will send duplicate email.
         sys.stderr.write("Error: You must choose a valid frequency.\n\n")
         optparser.print_help()
         return 1
-    count = send_all(frequency, opts.verbose)
+    count = send_all(frequency, opts.verbose, opts.jobs)
     print "Sent %d messages for %s subscriptions" % (count, opts.frequency)
-
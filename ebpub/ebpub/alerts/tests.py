@@ -0,0 +1,119 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.contrib.gis import geos
+from django.core import mail
+from django.test import TestCase
+from ebpub.accounts.models import User
+from ebpub.alerts import sending
+from ebpub.alerts.models import EmailAlert
+from ebpub.db.models import NewsItem
+import datetime
+import mock
+
+class TestSendAll(TestCase):
+
+    # Puts items 2 and 3 in Location 3000.
+    fixtures = ('test-locationdetail-views.json',)
+
+    def setUp(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        self.yesterday = yesterday
+        NewsItem.objects.all().update(
+            pub_date=datetime.datetime.combine(yesterday, datetime.time(12, 0)))
+        self.alerts = []
+        for email, location_id, schemas in (('a@example.com', 3000, ''),
+                                             ('b@example.com', 3000, ''),
+                                             ('c@example.com', 2000, '999')):
+            user = User.objects.create_user(email=email)
+            # c@example.com opted in to a Schema that doesn't exist.
+            self.alerts.append(EmailAlert.objects.create(
+                    user_id=user.id, location_id=location_id, frequency=1,
+                    include_new_schemas=(not schemas), schemas=schemas,
+                    signup_date=datetime.datetime.now(), is_active=True))
+
+    def _check_sent(self, emails):
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]), sorted(emails))
+        alerts = dict([(alert.user.email, alert) for alert in self.alerts])
+        for message in mail.outbox:
+            alert = alerts[message.to[0]]
+            self.assertEqual(message.subject, 'Update: Hood 2')
+            self.assert_('crime title 3' in message.body)
+            self.assert_(message.to[0] in message.body)
+            self.assert_(alert.unsubscribe_url() in message.body)
+            self.failIf(sending.EMAIL_ADDRESS_PLACEHOLDER in message.body)
+            html = message.alternatives[0][0]
+            self.assert_(message.to[0] in html)
+            self.assert_(alert.unsubscribe_url() in html)
+
+    def test_send_all(self):
+        with mock.patch('ebpub.alerts.sending.render_email', wraps=sending.render_email) as mock_render:
+            self.assertEqual(sending.send_all(1), 2)
+            # Rendered once for both alerts on Location 3000.
+            self.assertEqual(mock_render.call_count, 1)
+        self._check_sent(['a@example.com', 'b@example.com'])
+        # All marked done, including the one with no news.
+        self.assertEqual(EmailAlert.objects.filter(last_sent_date=self.yesterday).count(), 3)
+        # So running again sends nothing.
+        self.assertEqual(sending.send_all(1), 0)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_match_alert_areas(self):
+        start, end = sending.alert_period(self.yesterday)
+        point = geos.Point(-87.79773, 41.984502, srid=4326)
+        areas = {'hood-2': 3000,
+                 'near': point.buffer(0.001),
+                 'far': geos.Point(0, 0, srid=4326).buffer(0.001)}
+        with self.assertNumQueries(1):
+            matches = sending.match_alert_areas(areas, start, end, [1])
+        self.assertEqual(sorted(matches['hood-2']), [(2, 1), (3, 1)])
+        self.assert_((1, 1) in matches['near'])
+        self.failIf('far' in matches)
+        # Only the given schemas.
+        self.assertEqual(sending.match_alert_areas(areas, start, end, [999]), {})
+
+    def test_send_all__one_match_query(self):
+        # One more alert on a new place doesn't need another news query.
+        user = User.objects.create_user(email='d@example.com')
+        EmailAlert.objects.create(
+            user_id=user.id, location_id=2000, frequency=1,
+            include_new_schemas=True, schemas='',
+            signup_date=datetime.datetime.now(), is_active=True)
+        with mock.patch('ebpub.alerts.sending.match_alert_areas',
+                        wraps=sending.match_alert_areas) as mock_match:
+            self.assertEqual(sending.send_all(1), 3)
+            self.assertEqual(mock_match.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_send_all__jobs(self):
+        self.assertEqual(sending.send_all(1, jobs=3), 2)
+        self._check_sent(['a@example.com', 'b@example.com'])
+
+    def test_send_all__resume(self):
+        EmailAlert.objects.filter(id=self.alerts[0].id).update(last_sent_date=self.yesterday)
+        self.assertEqual(sending.send_all(1), 1)
+        self._check_sent(['b@example.com'])
+
+    def test_send_all__failure(self):
+        # Failed messages aren't marked as sent, so they're retried next time.
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=IOError('oops')):
+            self.assertEqual(sending.send_all(1), 0)
+        self.assertEqual(EmailAlert.objects.filter(last_sent_date=None).count(), 2)
+        self.assertEqual(sending.send_all(1), 2)
+        self._check_sent(['a@example.com', 'b@example.com'])
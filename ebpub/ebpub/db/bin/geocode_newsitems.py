@@ -22,23 +22,32 @@ attempts to geocode them based on their ``location_name``.
 
 Optionally provide a list of ``Schema.slug`` values to only geocode
 items of that schema.
-"""
 
+Locations are geocoded in batches (see ``--batch-size``) using
+:py:meth:`ebpub.geocoder.base.Geocoder.geocode_many`, and NewsItems
+with the same ``location_name`` are updated together.
+"""
 
 from ebpub.db.models import NewsItem
 from ebpub.geocoder import SmartGeocoder, GeocodingException, AmbiguousResult, InvalidBlockButValidStreet
 from ebpub.geocoder.parser.parsing import ParsingError
+import datetime
 
-def geocode(*schemas):
+DEFAULT_BATCH_SIZE = 200
+
+def geocode(*schemas, **kwargs):
     """
     Geocode NewsItems with null locations.
 
     If ``schemas`` are provided, only geocode NewsItems with that particular
     schema slug(s).
+
+    Pass ``batch_size`` to control how many NewsItems are geocoded at once.
     """
+    batch_size = kwargs.get('batch_size') or DEFAULT_BATCH_SIZE
     geocoder = SmartGeocoder()
     qs = NewsItem.objects.filter(location__isnull=True).order_by('-id')
-    if schemas is not None:
+    if schemas:
         print "Geocoding %s..." % ', '.join(schemas)
         qs = qs.filter(schema__slug__in=schemas)
     else:
@@ -50,32 +59,42 @@ def geocode(*schemas):
     parsing_error_count = 0
     invalid_block_count = 0
 
-    for ni in qs.iterator():
-        loc_name = ni.location_name
-        try:
-            add = geocoder.geocode(loc_name)
-        except InvalidBlockButValidStreet:
-            print '      invalid block but valid street: %s' % loc_name
-            invalid_block_count += 1
-        except AmbiguousResult:
-            print '      ambiguous: %s' % loc_name
-            ambiguous_count += 1
-        except GeocodingException:
-            print '      not found: %s' % loc_name
-            not_found_count += 1
-        except ParsingError:
-            print '      parse error: %s' % loc_name
-            parsing_error_count += 1
-        except:
-            raise
-        else:
-            ni.location = add['point']
-            ni.save()
-            print '%s (%s)' % (loc_name, ni.item_url())
-            geocoded_count += 1
-    else:
+    # Fetch just the ids up front, since geocoded items drop out of qs.
+    items = list(qs.values_list('id', 'location_name'))
+    if not items:
         print "No NewsItems with null locations found"
 
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        ids_by_name = {}
+        for ni_id, loc_name in batch:
+            ids_by_name.setdefault(loc_name, []).append(ni_id)
+        loc_names = ids_by_name.keys()
+        results = geocoder.geocode_many(loc_names)
+        now = datetime.datetime.now()
+        for loc_name, add in zip(loc_names, results):
+            ids = ids_by_name[loc_name]
+            if isinstance(add, InvalidBlockButValidStreet):
+                print '      invalid block but valid street: %s' % loc_name
+                invalid_block_count += len(ids)
+            elif isinstance(add, AmbiguousResult):
+                print '      ambiguous: %s' % loc_name
+                ambiguous_count += len(ids)
+            elif isinstance(add, GeocodingException):
+                print '      not found: %s' % loc_name
+                not_found_count += len(ids)
+            elif isinstance(add, ParsingError):
+                print '      parse error: %s' % loc_name
+                parsing_error_count += len(ids)
+            elif add['point'] is None:
+                print '      not found: %s' % loc_name
+                not_found_count += len(ids)
+            else:
+                NewsItem.objects.filter(id__in=ids).update(
+                    location=add['point'], last_modification=now)
+                print '%s (%d items)' % (loc_name, len(ids))
+                geocoded_count += len(ids)
+
     print "------------------------------------------------------------------"
     print "Geocoded:       %s" % geocoded_count
     print "Not found:      %s" % not_found_count
@@ -83,14 +102,20 @@ def geocode(*schemas):
     print "Parse errors:   %s" % parsing_error_count
     print "Invalid blocks: %s" % invalid_block_count
 
-def main():
+def main(argv=None):
     import sys
-    try:
-        schema_slug = sys.argv[1]
-    except IndexError:
-        geocode()
-    else:
-        geocode(schema_slug)
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='''usage: %prog [options] [schema ...]
+
+Geocodes NewsItems that have no location, based on their location_name.
+''')
+    optparser.add_option('-b', '--batch-size', action='store', type='int',
+                         default=DEFAULT_BATCH_SIZE,
+                         help='Geocode this many NewsItems at a time. Default %default.')
+    opts, args = optparser.parse_args(argv)
+    geocode(batch_size=opts.batch_size, *args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Script to rebuild the
+:py:class:`NewsItemLookup <ebpub.db.models.NewsItemLookup>` table,
+which indexes many-to-many lookup attribute values, for the given
+schema (default: all schemas).
+
+Database triggers normally keep it up to date, and the migration
+that added it fills it in; so you should only need this if the
+triggers were disabled, eg. during a bulk load.
+"""
+
+from django.db import connection, transaction
+from ebpub.db.models import Schema, SchemaField
+from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
+import logging
+
+logger = logging.getLogger('ebpub.db.bin.rebuild_newsitem_lookups')
+
+
+def rebuild_newsitem_lookups(schema_field):
+    """
+    Recreates the NewsItemLookups for one many-to-many lookup
+    SchemaField.  Returns the number of rows created.
+    """
+    cursor = connection.cursor()
+    # This database function is created by migration 0032.
+    cursor.execute("SELECT rebuild_newsitem_lookups(%s)", (schema_field.id,))
+    num = cursor.fetchone()[0]
+    transaction.commit_unless_managed()
+    logger.info('%s: %d lookup values' % (schema_field, num))
+    return num
+
+
+def rebuild_all(schema_slug=None):
+    fields = SchemaField.objects.filter(is_lookup=True).select_related('schema')
+    if schema_slug is not None:
+        fields = fields.filter(schema__slug=schema_slug)
+    total = 0
+    for sf in fields:
+        if sf.is_many_to_many_lookup():
+            total += rebuild_newsitem_lookups(sf)
+    logger.info('Rebuilt %d lookup values' % total)
+    return total
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='''usage: %prog [options] [schema]
+
+Rebuilds the index of many-to-many lookup values for the given schema
+slug (default: all schemas).
+''')
+    add_verbosity_options(optparser)
+    opts, args = optparser.parse_args(argv)
+    setup_logging_from_opts(opts, logger)
+    schema_slug = None
+    if args:
+        schema_slug = args[0]
+        if not Schema.objects.filter(slug=schema_slug).count():
+            optparser.error('No schema with slug %r' % schema_slug)
+    rebuild_all(schema_slug)
+
+if __name__ == "__main__":
+    main()
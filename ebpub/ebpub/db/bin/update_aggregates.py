@@ -21,112 +21,240 @@
 Script to populate :ref:`aggregates`.
 Typically run without arguments.  The ``--reset`` option will delete
 all aggregates first.
+
+The ``--incremental`` option only recounts the buckets (days,
+locations, lookups) that were touched since the last run, as recorded
+by database triggers in the
+:py:class:`AggregateChange <ebpub.db.models.AggregateChange>` log.
+It falls back to a full update for schemas that have never been
+aggregated, or that have more pending changes than ``--max-changes``.
+
+Schemas are independent, so ``--jobs N`` can update N of them at once
+in separate processes.  A failure in one schema is reported at the end
+and doesn't stop the others.
 """
 
 from django.db import connection, transaction
 from ebpub.db import constants
-from ebpub.db.models import Schema, SchemaField, NewsItem, AggregateAll, AggregateDay, AggregateLocationDay, AggregateLocation, AggregateFieldLookup
-from ebpub.utils.dates import today
+from ebpub.db.models import Schema, SchemaField, NewsItem, AggregateAll, AggregateDay, AggregateLocationDay, AggregateLocation, AggregateFieldLookup, AggregateChange
+from ebpub.db.models import AggregateLocationFieldLookup
+from ebpub.utils.dates import today, parse_date
 from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
+from StringIO import StringIO
+import itertools
 import logging
+import multiprocessing
+import sys
+import time
+import traceback
 
 logger = logging.getLogger('ebpub.db.bin.update_aggregates')
 
-def smart_update(cursor, new_values, table_name, field_names, comparable_fields,
-                 where, pk_name='id', dry_run=False):
-    # new_values is a list of dictionaries, each with a value for each field in field_names.
+# Above this many changed buckets, --incremental does a full update instead.
+DEFAULT_MAX_CHANGES = 5000
 
-    # Run a query to determine the current values in the DB.
-    where = where.items()
-    cursor.execute("""
-        SELECT %s, %s
-        FROM %s
-        WHERE %s""" % (pk_name, ','.join(field_names), table_name,
-            ' AND '.join(['%s=%%s' % k for k, v in where])), tuple([v for k, v in where]))
-    old_values = dict([(tuple(row[1:len(comparable_fields)+1]), dict(zip((pk_name,)+field_names, row))) for row in cursor.fetchall()])
-    for new_value in new_values:
-        key = tuple([new_value[i] for i in comparable_fields])
-        try:
-            old_value = old_values.pop(key)
-        except KeyError:
-            logger.debug(
-                "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ', '.join(field_names + tuple([i[0] for i in where])), ', '.join([str(new_value[i]) for i in field_names] + [str(i[1]) for i in where])))
-            if not dry_run:
-                cursor.execute("INSERT INTO %s (%s) VALUES (%s)" % \
-                    (table_name, ', '.join(field_names + tuple([i[0] for i in where])), ','.join(['%s' for _ in tuple(field_names) + tuple(where)])),
-                    tuple([new_value[i] for i in field_names] + [i[1] for i in where]))
-        else:
-            for k, v in new_value.items():
-                if old_value[k] != v:
-                    logger.debug(
-                        "UPDATE %s SET %s WHERE %s=%s" % (table_name, ', '.join(['%s=%s' % (k, v) for k, v in new_value.items()]), pk_name, old_value[pk_name]))
-                    if not dry_run:
-                        new_value_tuple = new_value.items()
-                        cursor.execute("UPDATE %s SET %s WHERE %s=%%s" % \
-                            (table_name, ', '.join(['%s=%%s' % k for k, v in new_value_tuple]), pk_name),
-                            tuple([v for k, v in new_value_tuple] + [old_value[pk_name]]))
-                    break
-    for old_value in old_values.values():
-        logger.debug("DELETE FROM %s WHERE %s = %s" % (table_name, pk_name, old_value[pk_name]))
-        if not dry_run:
-            cursor.execute("DELETE FROM %s WHERE %s = %%s" % (table_name, pk_name), (old_value[pk_name],))
+# How many buckets to recount per query in incremental mode.
+CHUNK_SIZE = 500
 
-def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
+# Staging table used by smart_update().
+SMART_UPDATE_TABLE = 'tmp_smart_update'
+
+def smart_update(cursor, new_values, table_name, field_names, comparable_fields,
+                 where, pk_name='id', dry_run=False, extra_where=None):
     """
-    Updates all Aggregate* tables for the given schema_id/slug,
-    deleting/updating the existing records if necessary.
+    Makes the rows of ``table_name`` that match ``where`` (a dictionary
+    of column name -> value) match ``new_values``, a list of
+    dictionaries each with a value for each field in ``field_names``.
 
-    If dry_run is True, then the records won't be updated -- only the SQL
-    will be output.
+    Rows are matched up by ``comparable_fields``; existing rows with
+    no match in ``new_values`` are deleted, new ones are inserted, and
+    the rest are updated if any field differs.
 
-    If reset is True, then all aggregates for this schema will be deleted before
-    updating.
+    ``extra_where`` is an optional (sql, params) tuple that further
+    limits which existing rows are considered; rows outside it are
+    left alone.
+
+    This is done set-based: ``new_values`` are COPYed into a temporary
+    table, and the differences applied with one INSERT, UPDATE and
+    DELETE statement each.
+
+    Returns a (num_inserted, num_updated, num_deleted) tuple.  If
+    ``dry_run`` is True, nothing is changed and the counts are what
+    would have been changed.
     """
-    logger.info('... %s' % schema_id_or_slug)
-    if not str(schema_id_or_slug).isdigit():
-        schema_id = Schema.objects.get(slug=schema_id_or_slug).id
+    where = where.items()
+    where_sql = ['t.%s = %%s' % k for k, v in where]
+    where_params = [v for k, v in where]
+    if extra_where is not None:
+        where_sql.append(extra_where[0])
+        where_params.extend(extra_where[1])
+    where_sql = ' AND '.join(where_sql)
+    # Columns of the staging table get a prefix, so that extra_where's
+    # unqualified column names unambiguously refer to table_name.
+    staging_fields = ['new_%s' % f for f in field_names]
+    match_sql = ' AND '.join(['t.%s = n.new_%s' % (f, f) for f in comparable_fields]) or 'true'
+    other_fields = [f for f in field_names if f not in comparable_fields]
+    differ_sql = ' OR '.join(['t.%s IS DISTINCT FROM n.new_%s' % (f, f) for f in other_fields]) or 'false'
+
+    cursor.execute("DROP TABLE IF EXISTS %s" % SMART_UPDATE_TABLE)
+    cursor.execute("CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WHERE false" % (
+            SMART_UPDATE_TABLE,
+            ', '.join(['%s AS new_%s' % (f, f) for f in field_names]),
+            table_name))
+    _copy_rows(cursor, SMART_UPDATE_TABLE, staging_fields,
+               [[value[f] for f in field_names] for value in new_values])
+    if len(new_values) > CHUNK_SIZE:
+        # Give the planner a chance to pick a sensible join.
+        cursor.execute("ANALYZE %s" % SMART_UPDATE_TABLE)
+
+    delete_where = """%s AND NOT EXISTS (
+            SELECT 1 FROM %s n WHERE %s)""" % (where_sql, SMART_UPDATE_TABLE, match_sql)
+    update_where = """%s AND %s AND (%s)""" % (where_sql, match_sql, differ_sql)
+    insert_where = """NOT EXISTS (
+            SELECT 1 FROM %s t WHERE %s AND %s)""" % (table_name, where_sql, match_sql)
+
+    if dry_run:
+        cursor.execute("SELECT COUNT(*) FROM %s t WHERE %s" % (table_name, delete_where),
+                       where_params)
+        num_deleted = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM %s t, %s n WHERE %s" % (
+                table_name, SMART_UPDATE_TABLE, update_where), where_params)
+        num_updated = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM %s n WHERE %s" % (
+                SMART_UPDATE_TABLE, insert_where), where_params)
+        num_inserted = cursor.fetchone()[0]
+        logger.info("Dry run: %s would get %d inserts, %d updates, %d deletes"
+                    % (table_name, num_inserted, num_updated, num_deleted))
     else:
-        schema_id = schema_id_or_slug
-    cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s t WHERE %s" % (table_name, delete_where),
+                       where_params)
+        num_deleted = cursor.rowcount
+        if other_fields:
+            cursor.execute("UPDATE %s t SET %s FROM %s n WHERE %s" % (
+                    table_name,
+                    ', '.join(['%s = n.new_%s' % (f, f) for f in other_fields]),
+                    SMART_UPDATE_TABLE, update_where),
+                           where_params)
+            num_updated = cursor.rowcount
+        else:
+            num_updated = 0
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s n WHERE %s" % (
+                table_name,
+                ', '.join(field_names + tuple([k for k, v in where])),
+                ', '.join(['n.%s' % f for f in staging_fields] + ['%s'] * len(where)),
+                SMART_UPDATE_TABLE, insert_where),
+                       [v for k, v in where] + where_params)
+        num_inserted = cursor.rowcount
+        logger.debug("%s: %d inserts, %d updates, %d deletes"
+                     % (table_name, num_inserted, num_updated, num_deleted))
+    cursor.execute("DROP TABLE %s" % SMART_UPDATE_TABLE)
+    return (num_inserted, num_updated, num_deleted)
 
-    if reset and not dry_run:
-        for aggmodel in (AggregateAll, AggregateDay, AggregateLocation,
-                         AggregateLocationDay, AggregateFieldLookup):
-            logger.info('... deleting all %s for schema %s' % (aggmodel.__name__, schema_id_or_slug))
-            aggmodel.objects.filter(schema__id=schema_id).delete()
+def _copy_value(value):
+    # Text representation of a value for COPY ... FROM.
+    if value is None:
+        return r'\N'
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return value.encode('utf8')
+
+def _copy_rows(cursor, table_name, columns, rows):
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join([_copy_value(v) for v in row]))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_from(data, table_name, columns=columns)
 
-    # AggregateAll
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = sorted(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def _placeholders(values, width=1):
+    if width == 1:
+        return ','.join(['%s'] * len(values))
+    return ','.join(['(%s)' % ','.join(['%s'] * width)] * len(values))
+
+
+def update_aggregate_all(cursor, schema_id, dry_run=False):
     cursor.execute("SELECT COUNT(*) FROM db_newsitem WHERE schema_id = %s", (schema_id,))
     new_values = [{'total': row[0]} for row in cursor.fetchall()]
     smart_update(cursor, new_values, AggregateAll._meta.db_table, ('total',),
                  (), {'schema_id': schema_id}, dry_run=dry_run)
 
-    # AggregateDay
-    cursor.execute("""
-        SELECT item_date, COUNT(*)
-        FROM db_newsitem
-        WHERE schema_id = %s
-        GROUP BY 1""", (schema_id,))
-    new_values = [{'date_part': row[0], 'total': row[1]} for row in cursor.fetchall()]
-    smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
-                 ('date_part',), {'schema_id': schema_id}, dry_run=dry_run,
-                 )
+def update_aggregate_day(cursor, schema_id, dry_run=False, dates=None):
+    """
+    Recount AggregateDay for the given schema; if ``dates`` is given,
+    only for those dates.
+    """
+    if dates is None:
+        cursor.execute("""
+            SELECT item_date, COUNT(*)
+            FROM db_newsitem
+            WHERE schema_id = %s
+            GROUP BY 1""", (schema_id,))
+        new_values = [{'date_part': row[0], 'total': row[1]} for row in cursor.fetchall()]
+        smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
+                     ('date_part',), {'schema_id': schema_id}, dry_run=dry_run,
+                     )
+        return
+    for chunk in _chunks(dates):
+        cursor.execute("""
+            SELECT item_date, COUNT(*)
+            FROM db_newsitem
+            WHERE schema_id = %%s
+                AND item_date IN (%s)
+            GROUP BY 1""" % _placeholders(chunk), (schema_id,) + tuple(chunk))
+        new_values = [{'date_part': row[0], 'total': row[1]} for row in cursor.fetchall()]
+        smart_update(cursor, new_values, AggregateDay._meta.db_table, ('date_part', 'total'),
+                     ('date_part',), {'schema_id': schema_id}, dry_run=dry_run,
+                     extra_where=('date_part IN (%s)' % _placeholders(chunk), chunk))
 
-    # AggregateLocationDay
-    cursor.execute("""
+def update_aggregate_location_day(cursor, schema_id, dry_run=False, dates=None,
+                                  location_days=None):
+    """
+    Recount AggregateLocationDay for the given schema.
+
+    If neither ``dates`` nor ``location_days`` is given, recounts
+    everything.  Otherwise recounts all Locations on each of ``dates``,
+    and each (location_id, date) pair in ``location_days``.
+    """
+    field_names = ('location_id', 'date_part', 'location_type_id', 'total')
+    comparable_fields = ('location_id', 'date_part', 'location_type_id')
+    sql = """
         SELECT nl.location_id, ni.item_date, loc.location_type_id, COUNT(*)
         FROM db_newsitemlocation nl, db_newsitem ni, db_location loc
         WHERE nl.news_item_id = ni.id
-            AND ni.schema_id = %s
+            AND ni.schema_id = %%s
             AND nl.location_id = loc.id
-        GROUP BY 1, 2, 3""", (schema_id,))
-    new_values = [{'location_id': row[0], 'date_part': row[1], 'location_type_id': row[2], 'total': row[3]} for row in cursor.fetchall()]
-    smart_update(cursor, new_values, AggregateLocationDay._meta.db_table, ('location_id', 'date_part', 'location_type_id', 'total'),
-                 ('location_id', 'date_part', 'location_type_id'),
-                 {'schema_id': schema_id}, dry_run=dry_run,
-                 )
+            %s
+        GROUP BY 1, 2, 3"""
+
+    def _update(condition='', params=(), extra_where=None):
+        cursor.execute(sql % condition, (schema_id,) + tuple(params))
+        new_values = [{'location_id': row[0], 'date_part': row[1], 'location_type_id': row[2], 'total': row[3]} for row in cursor.fetchall()]
+        smart_update(cursor, new_values, AggregateLocationDay._meta.db_table,
+                     field_names, comparable_fields,
+                     {'schema_id': schema_id}, dry_run=dry_run,
+                     extra_where=extra_where)
+
+    if dates is None and location_days is None:
+        _update()
+        return
+    for chunk in _chunks(dates or ()):
+        in_sql = _placeholders(chunk)
+        _update('AND ni.item_date IN (%s)' % in_sql, chunk,
+                ('date_part IN (%s)' % in_sql, chunk))
+    for chunk in _chunks(location_days or ()):
+        in_sql = _placeholders(chunk, width=2)
+        params = list(itertools.chain(*chunk))
+        _update('AND (nl.location_id, ni.item_date) IN (%s)' % in_sql, params,
+                ('(location_id, date_part) IN (%s)' % in_sql, params))
 
-    # AggregateLocation
+def update_aggregate_location(cursor, schema_id, dry_run=False):
     # This query is a bit clever -- we just sum up the totals created in a
     # previous aggregate. It's a helpful optimization, because otherwise
     # the location query is way too slow.
@@ -139,46 +267,54 @@ def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
     try:
         end_date = cursor.fetchone()[0]
     except TypeError: # if cursor.fetchone() is None, there are no records.
-        pass
-    else:
-        # Note that BETWEEN is inclusive on both ends, so to get
-        # AggregateLocationDays for eg. 30 days, we'd need a timedelta of 29
-        start_date = end_date - constants.DAYS_AGGREGATE_TIMEDELTA
-        cursor.execute("""
-            SELECT location_id, location_type_id, SUM(total)
-            FROM %s
-            WHERE schema_id = %%s
-                AND date_part BETWEEN %%s AND %%s
-            GROUP BY 1, 2""" % AggregateLocationDay._meta.db_table,
-                (schema_id, start_date, end_date))
-        new_values = [{'location_id': row[0], 'location_type_id': row[1], 'total': row[2]} for row in cursor.fetchall()]
-        smart_update(cursor, new_values, AggregateLocation._meta.db_table,
-                     ('location_id', 'location_type_id', 'total'),
-                     ('location_id', 'location_type_id'), {'schema_id': schema_id},
-                     dry_run=dry_run,
-                     )
+        return
+    # Note that BETWEEN is inclusive on both ends, so to get
+    # AggregateLocationDays for eg. 30 days, we'd need a timedelta of 29
+    start_date = end_date - constants.DAYS_AGGREGATE_TIMEDELTA
+    cursor.execute("""
+        SELECT location_id, location_type_id, SUM(total)
+        FROM %s
+        WHERE schema_id = %%s
+            AND date_part BETWEEN %%s AND %%s
+        GROUP BY 1, 2""" % AggregateLocationDay._meta.db_table,
+            (schema_id, start_date, end_date))
+    new_values = [{'location_id': row[0], 'location_type_id': row[1], 'total': row[2]} for row in cursor.fetchall()]
+    smart_update(cursor, new_values, AggregateLocation._meta.db_table,
+                 ('location_id', 'location_type_id', 'total'),
+                 ('location_id', 'location_type_id'), {'schema_id': schema_id},
+                 dry_run=dry_run,
+                 )
 
-    for sf in SchemaField.objects.filter(schema__id=schema_id, is_filter=True, is_lookup=True):
-        try:
-            end_date = NewsItem.objects.filter(schema__id=schema_id, item_date__lte=today()).values_list('item_date', flat=True).order_by('-item_date')[0]
-        except IndexError:
-            continue # There have been no NewsItems in the given date range.
-        # Note BETWEEN is inclusive on both ends.
-        start_date = end_date - constants.DAYS_AGGREGATE_TIMEDELTA
+def _get_lookup_date_range(schema_id):
+    # The range of item_dates counted by AggregateFieldLookup, or
+    # (None, None) if there have been no NewsItems up to today.
+    try:
+        end_date = NewsItem.objects.filter(schema__id=schema_id, item_date__lte=today()).values_list('item_date', flat=True).order_by('-item_date')[0]
+    except IndexError:
+        return (None, None)
+    # Note BETWEEN is inclusive on both ends.
+    start_date = end_date - constants.DAYS_AGGREGATE_TIMEDELTA
+    return (start_date, end_date)
 
+def update_aggregate_field_lookups(cursor, schema_id, dry_run=False):
+    start_date, end_date = _get_lookup_date_range(schema_id)
+    if end_date is None:
+        return # There have been no NewsItems in the given date range.
+    for sf in SchemaField.objects.filter(schema__id=schema_id, is_filter=True, is_lookup=True):
         if sf.is_many_to_many_lookup():
             # AggregateFieldLookup
+            # Every Lookup gets a row, even if its count is zero.
             cursor.execute("""
-                SELECT id, (
-                    SELECT COUNT(*) FROM db_attribute a, db_newsitem ni
-                    WHERE a.news_item_id = ni.id
-                        AND a.schema_id = %%s
-                        AND ni.schema_id = %%s
-                        AND a.%s ~ ('[[:<:]]' || db_lookup.id || '[[:>:]]')
-                        AND ni.item_date BETWEEN %%s AND %%s
-                )
-                FROM db_lookup
-                WHERE schema_field_id = %%s""" % sf.real_name, (schema_id, schema_id, start_date, end_date, sf.id))
+                SELECT l.id, COUNT(ni.id)
+                FROM db_lookup l
+                LEFT JOIN db_newsitemlookup nl
+                    ON nl.lookup_id = l.id AND nl.schema_field_id = %s
+                LEFT JOIN db_newsitem ni
+                    ON ni.id = nl.news_item_id
+                        AND ni.schema_id = %s
+                        AND ni.item_date BETWEEN %s AND %s
+                WHERE l.schema_field_id = %s
+                GROUP BY 1""", (sf.id, schema_id, start_date, end_date, sf.id))
             new_values = [{'lookup_id': row[0], 'total': row[1]} for row in cursor.fetchall()]
             smart_update(cursor, new_values, AggregateFieldLookup._meta.db_table,
                          ('lookup_id', 'total'), ('lookup_id',),
@@ -202,17 +338,346 @@ def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
                          {'schema_id': schema_id, 'schema_field_id': sf.id},
                          dry_run=dry_run)
 
+def update_aggregate_location_field_lookups(cursor, schema_id, dry_run=False,
+                                            location_ids=None):
+    """
+    Recount AggregateLocationFieldLookup for the charted lookup fields
+    of the given schema; if ``location_ids`` is given, only for those
+    Locations.
+    """
+    field_names = ('location_id', 'location_type_id', 'lookup_id', 'total')
+    comparable_fields = ('location_id', 'location_type_id', 'lookup_id')
+    for sf in SchemaField.objects.filter(schema__id=schema_id, is_lookup=True, is_charted=True):
+        if sf.is_many_to_many_lookup():
+            sql = """
+                SELECT nl.location_id, loc.location_type_id, l.id, COUNT(*)
+                FROM db_newsitemlocation nl, db_newsitem ni, db_location loc, db_newsitemlookup lk, db_lookup l
+                WHERE nl.news_item_id = ni.id
+                    AND lk.news_item_id = ni.id
+                    AND nl.location_id = loc.id
+                    AND lk.schema_field_id = %%s
+                    AND ni.schema_id = %%s
+                    AND l.schema_field_id = %%s
+                    AND lk.lookup_id = l.id
+                    %(condition)s
+                GROUP BY 1, 2, 3"""
+            sql_params = (sf.id, schema_id, sf.id)
+        else:
+            sql = """
+                SELECT nl.location_id, loc.location_type_id, l.id, COUNT(*)
+                FROM db_newsitemlocation nl, db_newsitem ni, db_location loc, db_attribute a, db_lookup l
+                WHERE nl.news_item_id = ni.id
+                    AND a.news_item_id = ni.id
+                    AND nl.location_id = loc.id
+                    AND a.schema_id = %%s
+                    AND ni.schema_id = %%s
+                    AND l.schema_field_id = %%s
+                    AND a.%(column)s = l.id
+                    %(condition)s
+                GROUP BY 1, 2, 3"""
+            sql_params = (schema_id, schema_id, sf.id)
+
+        def _update(condition='', params=(), extra_where=None):
+            cursor.execute(sql % {'column': sf.real_name, 'condition': condition},
+                           sql_params + tuple(params))
+            new_values = [{'location_id': row[0], 'location_type_id': row[1], 'lookup_id': row[2], 'total': row[3]} for row in cursor.fetchall()]
+            smart_update(cursor, new_values, AggregateLocationFieldLookup._meta.db_table,
+                         field_names, comparable_fields,
+                         {'schema_id': schema_id, 'schema_field_id': sf.id},
+                         dry_run=dry_run, extra_where=extra_where)
+
+        if location_ids is None:
+            _update()
+            continue
+        for chunk in _chunks(location_ids):
+            in_sql = _placeholders(chunk)
+            _update('AND nl.location_id IN (%s)' % in_sql, chunk,
+                    ('location_id IN (%s)' % in_sql, chunk))
+
+
+def _get_schema_id(schema_id_or_slug):
+    if not str(schema_id_or_slug).isdigit():
+        return Schema.objects.get(slug=schema_id_or_slug).id
+    return int(schema_id_or_slug)
+
+def _get_max_change_id(cursor, schema_id):
+    cursor.execute("SELECT MAX(id) FROM %s WHERE schema_id = %%s"
+                   % AggregateChange._meta.db_table, (schema_id,))
+    return cursor.fetchone()[0]
+
+def _consume_changes(cursor, schema_id, max_id, dry_run=False):
+    # Forget logged changes that we've now accounted for.
+    # Anything logged after we started has a higher id and is kept
+    # for the next run.
+    if max_id is None or dry_run:
+        return
+    cursor.execute("DELETE FROM %s WHERE schema_id = %%s AND id <= %%s"
+                   % AggregateChange._meta.db_table, (schema_id, max_id))
+
+
+def update_aggregates(schema_id_or_slug, dry_run=False,  reset=False):
+    """
+    Updates all Aggregate* tables for the given schema_id/slug,
+    deleting/updating the existing records if necessary.
+
+    If dry_run is True, then the records won't be updated -- only the
+    number of inserts, updates and deletes will be logged.
+
+    If reset is True, then all aggregates for this schema will be deleted before
+    updating.
+    """
+    logger.info('... %s' % schema_id_or_slug)
+    schema_id = _get_schema_id(schema_id_or_slug)
+    cursor = connection.cursor()
+    max_change_id = _get_max_change_id(cursor, schema_id)
+
+    if reset and not dry_run:
+        for aggmodel in (AggregateAll, AggregateDay, AggregateLocation,
+                         AggregateLocationDay, AggregateFieldLookup,
+                         AggregateLocationFieldLookup):
+            logger.info('... deleting all %s for schema %s' % (aggmodel.__name__, schema_id_or_slug))
+            aggmodel.objects.filter(schema__id=schema_id).delete()
+
+    update_aggregate_all(cursor, schema_id, dry_run=dry_run)
+    update_aggregate_day(cursor, schema_id, dry_run=dry_run)
+    update_aggregate_location_day(cursor, schema_id, dry_run=dry_run)
+    update_aggregate_location(cursor, schema_id, dry_run=dry_run)
+    update_aggregate_field_lookups(cursor, schema_id, dry_run=dry_run)
+    update_aggregate_location_field_lookups(cursor, schema_id, dry_run=dry_run)
+
+    # A full update accounts for everything in the change log so far.
+    _consume_changes(cursor, schema_id, max_change_id, dry_run=dry_run)
+    transaction.commit_unless_managed()
+
+
+class ChangedBuckets(object):
+    """
+    The aggregate buckets of one schema that need recounting.
+    """
+
+    def __init__(self):
+        self.max_change_id = None
+        # Dates on which any bucket may have changed.
+        self.dates = set()
+        # (location_id, date) pairs whose counts may have changed.
+        self.location_days = set()
+        # Dates on which only Attribute values (ie. lookups) changed.
+        self.lookup_dates = set()
+
+    def __len__(self):
+        return len(self.dates) + len(self.location_days) + len(self.lookup_dates)
+
+    def all_dates(self):
+        return (self.dates | self.lookup_dates |
+                set([d for (loc, d) in self.location_days]))
+
+
+def get_changed_buckets(schema_id, since=None):
+    """
+    Returns a :py:class:`ChangedBuckets` for the given schema, based on
+    the :py:class:`AggregateChange <ebpub.db.models.AggregateChange>`
+    log.
+
+    If ``since`` (a datetime) is given, NewsItems modified since then
+    are also treated as changed.  That's useful if some changes were
+    made without the triggers in place; but it can't know about
+    deleted NewsItems.
+    """
+    cursor = connection.cursor()
+    buckets = ChangedBuckets()
+    buckets.max_change_id = _get_max_change_id(cursor, schema_id)
+    if buckets.max_change_id is not None:
+        cursor.execute("""
+            SELECT DISTINCT date_part, location_id, attributes_only
+            FROM %s
+            WHERE schema_id = %%s
+                AND id <= %%s
+                AND date_part IS NOT NULL""" % AggregateChange._meta.db_table,
+                       (schema_id, buckets.max_change_id))
+        for date_part, location_id, attributes_only in cursor.fetchall():
+            if attributes_only:
+                buckets.lookup_dates.add(date_part)
+            elif location_id is None:
+                buckets.dates.add(date_part)
+            else:
+                buckets.location_days.add((location_id, date_part))
+    if since is not None:
+        cursor.execute("""
+            SELECT DISTINCT item_date
+            FROM db_newsitem
+            WHERE schema_id = %s
+                AND last_modification >= %s""", (schema_id, since))
+        buckets.dates.update([row[0] for row in cursor.fetchall()])
+    # Recounting a whole date covers every location on that date.
+    buckets.location_days = set([(loc, d) for (loc, d) in buckets.location_days
+                                 if d not in buckets.dates])
+    buckets.lookup_dates -= buckets.dates
+    return buckets
+
+
+def get_changed_location_ids(schema_id, buckets):
+    """
+    Returns the set of Location ids whose AggregateLocationFieldLookup
+    counts may be affected by the given :py:class:`ChangedBuckets`:
+    those changed directly, plus those of any NewsItem dated on a
+    changed date.
+    """
+    location_ids = set([loc for (loc, d) in buckets.location_days])
+    cursor = connection.cursor()
+    for chunk in _chunks(buckets.dates | buckets.lookup_dates):
+        cursor.execute("""
+            SELECT DISTINCT nl.location_id
+            FROM db_newsitemlocation nl, db_newsitem ni
+            WHERE nl.news_item_id = ni.id
+                AND ni.schema_id = %%s
+                AND ni.item_date IN (%s)""" % _placeholders(chunk),
+                       (schema_id,) + tuple(chunk))
+        location_ids.update([row[0] for row in cursor.fetchall()])
+    return location_ids
+
+
+def update_aggregates_incremental(schema_id_or_slug, dry_run=False, since=None,
+                                  max_changes=DEFAULT_MAX_CHANGES):
+    """
+    Like :py:func:`update_aggregates`, but only recounts the buckets
+    touched since the last run, as given by :py:func:`get_changed_buckets`.
+
+    Falls back to a full update if the schema has no aggregates yet,
+    or if more than ``max_changes`` buckets have changed.
+
+    AggregateLocationFieldLookup is recounted for the Locations given
+    by :py:func:`get_changed_location_ids`.
+
+    AggregateLocation and AggregateFieldLookup only cover recent
+    dates, so they're only recounted if a change falls in (or after)
+    that window.  Note that the window can also move as future-dated
+    NewsItems become current, so an occasional full update is still a
+    good idea.
+    """
+    logger.info('... %s (incremental)' % schema_id_or_slug)
+    schema_id = _get_schema_id(schema_id_or_slug)
+    if not AggregateAll.objects.filter(schema__id=schema_id).count():
+        logger.info('... no aggregates yet for %s, doing a full update' % schema_id_or_slug)
+        return update_aggregates(schema_id, dry_run=dry_run)
+
+    buckets = get_changed_buckets(schema_id, since=since)
+    if len(buckets) > max_changes:
+        logger.info('... %d changed buckets for %s (more than %d), doing a full update'
+                    % (len(buckets), schema_id_or_slug, max_changes))
+        return update_aggregates(schema_id, dry_run=dry_run)
+
+    cursor = connection.cursor()
+    if buckets:
+        logger.info('... recounting %d changed buckets' % len(buckets))
+        update_aggregate_all(cursor, schema_id, dry_run=dry_run)
+        if buckets.dates or buckets.location_days:
+            update_aggregate_day(cursor, schema_id, dry_run=dry_run,
+                                 dates=buckets.dates)
+            update_aggregate_location_day(cursor, schema_id, dry_run=dry_run,
+                                          dates=buckets.dates,
+                                          location_days=buckets.location_days)
+        update_aggregate_location_field_lookups(
+            cursor, schema_id, dry_run=dry_run,
+            location_ids=get_changed_location_ids(schema_id, buckets))
+        start_date, end_date = _get_lookup_date_range(schema_id)
+        if start_date is None or max(buckets.all_dates()) >= start_date:
+            update_aggregate_location(cursor, schema_id, dry_run=dry_run)
+            update_aggregate_field_lookups(cursor, schema_id, dry_run=dry_run)
+    else:
+        logger.info('... no changes')
+
+    _consume_changes(cursor, schema_id, buckets.max_change_id, dry_run=dry_run)
     transaction.commit_unless_managed()
 
-def update_all_aggregates(dry_run=False, reset=False):
-    for schema in Schema.objects.all():
-        if dry_run:
-            logger.info('Dry run: Updating %s aggregates' % schema.plural_name)
-        elif reset:
-            logger.info('Resetting all %s aggregates' % schema.plural_name)
+
+def _update_one_schema(schema_id, name, dry_run=False, reset=False, incremental=False,
+                       since=None, max_changes=DEFAULT_MAX_CHANGES):
+    # Updates one schema and returns a (name, seconds, error) tuple,
+    # where error is a traceback string or None.  Exceptions are
+    # caught, so that one bad schema doesn't stop the others.
+    if dry_run:
+        logger.info('Dry run: Updating %s aggregates' % name)
+    elif reset:
+        logger.info('Resetting all %s aggregates' % name)
+    else:
+        logger.info('Updating %s aggregates' % name)
+    start = time.time()
+    try:
+        if incremental and not reset:
+            update_aggregates_incremental(schema_id, dry_run=dry_run, since=since,
+                                          max_changes=max_changes)
         else:
-            logger.info('Updating %s aggregates' % schema.plural_name)
-        update_aggregates(schema.id, dry_run=dry_run, reset=reset)
+            update_aggregates(schema_id, dry_run=dry_run, reset=reset)
+    except Exception:
+        logger.exception('Failed updating %s aggregates' % name)
+        transaction.rollback_unless_managed()
+        return (name, time.time() - start, traceback.format_exc())
+    return (name, time.time() - start, None)
+
+def _init_worker():
+    # Each worker process needs its own database connection;
+    # a connection inherited from the parent can't be shared.
+    connection.close()
+
+def _update_one_schema_worker(args):
+    schema_id, name, kwargs = args
+    return _update_one_schema(schema_id, name, **kwargs)
+
+
+def update_all_aggregates(dry_run=False, reset=False, incremental=False,
+                          since=None, max_changes=DEFAULT_MAX_CHANGES, jobs=1):
+    """
+    Updates aggregates for all schemas.  See :py:func:`update_aggregates`
+    and :py:func:`update_aggregates_incremental` for the options.
+
+    If ``jobs`` is greater than 1, schemas are updated in parallel by
+    that many worker processes, each with its own database connection.
+
+    A failure in one schema is logged and doesn't prevent updating the
+    rest.  Returns a list of (schema name, seconds, error) tuples, where
+    error is a traceback string or None; a summary is also logged.
+    """
+    kwargs = dict(dry_run=dry_run, reset=reset, incremental=incremental,
+                  since=since, max_changes=max_changes)
+    schemas = [(s.id, s.plural_name, kwargs) for s in Schema.objects.all()]
+    start = time.time()
+    if jobs > 1 and len(schemas) > 1:
+        # Don't let the workers inherit our connection.
+        connection.close()
+        pool = multiprocessing.Pool(processes=min(jobs, len(schemas)),
+                                    initializer=_init_worker)
+        try:
+            results = list(pool.imap_unordered(_update_one_schema_worker, schemas))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_update_one_schema_worker(args) for args in schemas]
+
+    if not dry_run:
+        # Changes logged for schemas that have since been deleted.
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE schema_id NOT IN (SELECT id FROM %s)"
+                       % (AggregateChange._meta.db_table, Schema._meta.db_table))
+        transaction.commit_unless_managed()
+
+    for name, seconds, error in sorted(results, key=lambda r: -r[1]):
+        logger.info('%s: %s in %.1f seconds' % (name, error and 'FAILED' or 'updated', seconds))
+    failures = [r for r in results if r[2]]
+    logger.info('Updated aggregates for %d schemas in %.1f seconds, %d failed'
+                % (len(results) - len(failures), time.time() - start, len(failures)))
+    if failures:
+        logger.error('Failed to update aggregates for: %s'
+                     % ', '.join([r[0] for r in failures]))
+    return results
+
+def _parse_since(value):
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return parse_date(value, format, return_datetime=True)
+        except ValueError:
+            continue
+    raise ValueError("Couldn't parse date %r, expected YYYY-MM-DD [HH:MM[:SS]]" % value)
 
 def main(argv=None):
     import sys
@@ -225,6 +690,16 @@ Updates aggregate statistics for the given schema (default: all schemas).
 ''')
     optparser.add_option('-r', '--reset', action='store_true',
                          help='Delete all aggregates before updating.')
+    optparser.add_option('-i', '--incremental', action='store_true',
+                         help='Only recount aggregates affected by changes since the last run.')
+    optparser.add_option('--since', action='store', default=None,
+                         help='With --incremental, also recount for NewsItems modified since this date (YYYY-MM-DD [HH:MM[:SS]]).')
+    optparser.add_option('--max-changes', action='store', type='int',
+                         default=DEFAULT_MAX_CHANGES,
+                         help='With --incremental, do a full update of any schema with more than this many changed buckets. Default %default.')
+
+    optparser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                         help='Update this many schemas in parallel. Default %default.')
 
     add_verbosity_options(optparser)
 
@@ -236,10 +711,25 @@ Updates aggregate statistics for the given schema (default: all schemas).
 
     setup_logging_from_opts(opts, logger)
 
-    if args:
+    since = None
+    if opts.since:
+        try:
+            since = _parse_since(opts.since)
+        except ValueError, e:
+            optparser.error(str(e))
+
+    if opts.incremental and not opts.reset:
+        if args:
+            return update_aggregates_incremental(*args, dry_run=opts.dry_run, since=since,
+                                                 max_changes=opts.max_changes)
+    elif args:
         return update_aggregates(*args, reset=opts.reset, dry_run=opts.dry_run)
-    else:
-        return update_all_aggregates(reset=opts.reset, dry_run=opts.dry_run)
+    results = update_all_aggregates(reset=opts.reset, dry_run=opts.dry_run,
+                                    incremental=opts.incremental, since=since,
+                                    max_changes=opts.max_changes, jobs=opts.jobs)
+    if [r for r in results if r[2]]:
+        # Non-zero exit status, so cron etc. will notice.
+        return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -51,3 +51,29 @@ BLOCK_URL_REGEX = r'(\d{1,6})-(\d{1,6})([nsew]{1,2})?(?:-([nsew]{0,2}))?'
 
 # How long the Schema managers should cache allowed_schema_ids()
 ALLOWED_IDS_CACHE_TIME = 60 * 10
+
+# How long each process may cache SchemaFields; see
+# ebpub.db.models.cached_schema_fields().
+SCHEMA_FIELDS_CACHE_TIME = 60 * 10
+
+# How often, in seconds, each process checks whether SchemaFields
+# have been changed by another process.
+SCHEMA_FIELDS_CHECK_INTERVAL = 1
+
+# How long each process may cache the names of Locations, Places,
+# their synonyms and Suburbs; see ebdata.nlp.gazetteer.
+GAZETTEER_CACHE_TIME = 60 * 60
+
+# How often, in seconds, each process checks whether any of those
+# have been changed by another process.
+GAZETTEER_CHECK_INTERVAL = 1
+
+# NewsItem.last_modification is set by Django, but AggregateChanges
+# are timestamped by the database, in the same or a later transaction;
+# allow this much difference when comparing them.
+AGGREGATE_CHANGE_CLOCK_SLACK = datetime.timedelta(minutes=10)
+
+# PostgreSQL text search configuration used by NewsItemQuerySet.search().
+# This must match the one used by the db_newsitem search_vector trigger
+# (see migration 0033).
+FULL_TEXT_SEARCH_CONFIG = 'pg_catalog.english'
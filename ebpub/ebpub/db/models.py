@@ -273,6 +273,12 @@ You'll want to do this on a regular basis, depending on how often you update
 your data. **Some parts of the site (such as charts) will not be visible** until
 you populate the aggregates.
 
+On large sites, a full update can take a long time.  The
+``--incremental`` option only recounts the days, locations and lookups
+that have changed since the last run; database triggers keep track of
+those changes in the :py:class:`AggregateChange` table.  You might run
+it every few minutes, and a full update nightly.
+
 .. _future_events:
 
 Event-like News Types
@@ -431,6 +437,7 @@ from .fields import OpenblockImageField
 import datetime
 import logging
 import re
+import time
 
 logger = logging.getLogger('ebpub.db.models')
 
@@ -464,10 +471,90 @@ def field_mapping(schema_id_list):
         }
     """
     result = {}
-    for sf in SchemaField.objects.filter(schema__id__in=(schema_id_list)).values('schema', 'name', 'real_name'):
-        result.setdefault(sf['schema'], {})[sf['name']] = sf['real_name']
+    for schema_id, fields in cached_schema_fields(schema_id_list).items():
+        result[schema_id] = dict([(sf.name, sf.real_name) for sf in fields])
+    return result
+
+
+# Process-wide cache of SchemaFields by schema id; see cached_schema_fields().
+_schema_fields_cache = {}
+_schema_fields_cache_state = {'generation': None, 'expires': 0, 'next_check': 0}
+_schema_fields_generation_key = 'schema_fields_generation'
+
+def cached_schema_fields(schema_id_list):
+    """
+    Given a list of schema IDs, returns a dictionary mapping
+    schema_ids to lists of their SchemaFields (with their Schemas),
+    ordered by display_order.  Schemas with no SchemaFields are omitted.
+
+    This is cached in each process for up to
+    ``constants.SCHEMA_FIELDS_CACHE_TIME`` seconds.  Saving or
+    deleting any Schema or SchemaField clears the cache in the current
+    process, and in other processes too within a second or so, if
+    they share a cache backend (eg. memcached).
+
+    The SchemaFields are shared, so don't modify them.
+    """
+    state = _schema_fields_cache_state
+    now = time.time()
+    if now >= state['next_check']:
+        state['next_check'] = now + constants.SCHEMA_FIELDS_CHECK_INTERVAL
+        generation = cache.get(_schema_fields_generation_key)
+        if generation != state['generation'] or now >= state['expires']:
+            _schema_fields_cache.clear()
+            state['generation'] = generation
+            state['expires'] = now + constants.SCHEMA_FIELDS_CACHE_TIME
+    schema_id_list = set(schema_id_list)
+    missing = [i for i in schema_id_list if i not in _schema_fields_cache]
+    if missing:
+        fetched = dict([(i, []) for i in missing])
+        fields = SchemaField.objects.filter(schema__id__in=missing)
+        for sf in fields.select_related('schema').order_by('display_order'):
+            fetched[sf.schema_id].append(sf)
+        _schema_fields_cache.update(fetched)
+    result = {}
+    for schema_id in schema_id_list:
+        fields = _schema_fields_cache.get(schema_id)
+        if fields:
+            result[schema_id] = list(fields)
     return result
 
+def clear_schema_fields_cache(sender=None, **kwargs):
+    """
+    Clears the cache used by cached_schema_fields().
+    """
+    _schema_fields_cache.clear()
+    _schema_fields_cache_state['next_check'] = 0
+    cache.set(_schema_fields_generation_key, time.time(),
+              constants.SCHEMA_FIELDS_CACHE_TIME)
+
+
+# Changed whenever a name the gazetteer (ebdata.nlp.gazetteer) loads
+# might have changed: 'local' for this process, and a timestamp in
+# the shared cache for all processes.
+_gazetteer_generation = {'local': 0}
+gazetteer_generation_key = 'gazetteer_generation'
+
+def gazetteer_generation(check_shared=True):
+    """
+    Returns a value that changes whenever a Location, Place, one of
+    their synonyms or types, or a Suburb is saved or deleted.
+    Saves in other processes are only noticed if ``check_shared``
+    is True and they share a cache backend.
+    """
+    shared = None
+    if check_shared:
+        shared = cache.get(gazetteer_generation_key)
+    return (_gazetteer_generation['local'], shared)
+
+def bump_gazetteer_generation(sender=None, **kwargs):
+    """
+    Signal handler that tells every process's gazetteer to reload.
+    """
+    _gazetteer_generation['local'] += 1
+    cache.set(gazetteer_generation_key, time.time(),
+              constants.GAZETTEER_CACHE_TIME)
+
 
 class SchemaQuerySet(models.query.GeoQuerySet):
 
@@ -1134,13 +1221,14 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
             for value in att_value:
                 if not str(value).isdigit():
                     raise ValueError('Only integer strings allowed for att_value in many-to-many SchemaFields; got %r' % value)
-            # We have to use a regular expression search to look for
-            # all rows with the given att_value *somewhere* in the
-            # column. The [[:<:]] thing is a word boundary, and the
-            # (?:) groups the possible values to distinguish them from
-            # the word boundary part of the regex.
-            pattern = '[[:<:]](?:%s)[[:>:]]' % '|'.join([str(val) for val in att_value])
-            clone = clone.extra(where=("db_attribute.%s ~ '%s'" % (real_name, pattern),))
+            # The values are in a comma-separated string in the
+            # attribute column; search the indexed NewsItemLookup table
+            # instead.
+            clone = clone.extra(where=("""db_newsitem.id IN (
+                SELECT news_item_id FROM db_newsitemlookup
+                WHERE schema_field_id = %%s AND lookup_id IN (%s))"""
+                                       % ','.join(['%s' for val in att_value]),),
+                                params=[schema_field.id] + [int(val) for val in att_value])
 
         elif None in att_value:
             if att_value != [None]:
@@ -1169,35 +1257,19 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
         """
         real_name = "db_attribute." + str(schema_field.real_name)
         if schema_field.is_many_to_many_lookup():
-            # First prepare a subquery to get a *single* count of
-            # attribute rows that match each relevant m2m lookup
-            # value.  It's very important to get a single row here or
-            # else we get a DataBaseError with "more than one row
-            # returned by a subquery used as an expression". (Bug #146)
-            clone = self.prepare_attribute_qs()
-            clone = clone.filter(schema__id=schema_field.schema_id)
-            # This is a regex search for the lookup id.
-            clone = clone.extra(where=[real_name + " ~ ('[[:<:]]' || db_lookup.id || '[[:>:]]')"])
-            # We want to count the current queryset and get a single
-            # row for injecting into the subsequent Lookup query, but
-            # we don't want Django's aggregation support to
-            # automatically group by fields that aren't relevant and
-            # would cause multiple rows as a result. So we call
-            # `values()' on a field that we're already filtering by,
-            # in this case, schema, as essentially a harmless identify
-            # function.
-            # See http://docs.djangoproject.com/en/dev/topics/db/aggregation/#values
-            clone = clone.values('schema')
-
-            # Fix #146: Having any `ORDER BY foo` in this subquery causes
-            # Django to also add a `GROUP BY foo`, which potentially
-            # returns multiple rows. So, remove the ordering.
-            clone = clone.order_by()
-            clone = clone.annotate(count=Count('schema'))
-            # Unusual: We don't run the clone query, we just stuff its SQL
-            # into our Lookup qs.
-            qs = Lookup.objects.filter(schema_field__id=schema_field.id)
-            qs = qs.extra(select={'lookup_id': 'id', 'item_count': clone.values('count').query})
+            # Counts of NewsItemLookup rows matching each relevant
+            # Lookup; like the int case, but joined to NewsItemLookup
+            # rather than the comma-separated attribute column.
+            lookup_id = NewsItemLookup._meta.db_table + '.lookup_id'
+            qs = self.extra(
+                select={'lookup_id': lookup_id},
+                tables=(NewsItemLookup._meta.db_table,),
+                where=('%s.news_item_id = db_newsitem.id' % NewsItemLookup._meta.db_table,
+                       '%s.schema_field_id = %%s' % NewsItemLookup._meta.db_table,
+                       '%s IN (SELECT id FROM db_lookup WHERE schema_field_id = %%s)' % lookup_id),
+                params=(schema_field.id, schema_field.id))
+            qs.query.group_by = [lookup_id]
+            qs = qs.values('lookup_id').annotate(item_count=Count('id'))
         else:
             # Counts of attribute rows matching each relevant Lookup.
             # Much easier when is_many_to_many_lookup == False :-)
@@ -1217,6 +1289,11 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
         """
         Returns a QuerySet of NewsItems whose attribute for
         a given schema field matches a text search query.
+
+        This is a case-insensitive substring match; it can use
+        trigram indexes if the pg_trgm extension was available when
+        migration 0033 was run.  For word searches of NewsItem titles
+        and descriptions, see :py:meth:`search`.
         """
         clone = self.prepare_attribute_qs()
         query = query.lower()
@@ -1225,6 +1302,40 @@ class NewsItemQuerySet(models.query.GeoQuerySet):
                             params=("%%%s%%" % query,))
         return clone
 
+    def search(self, query, ranked=True):
+        """
+        Returns a QuerySet of NewsItems whose title or description
+        matches all the words in a text search query, using the
+        full-text index on those fields.  Each NewsItem gets a
+        ``search_rank`` attribute; title matches rank higher than
+        description matches.
+
+        If ``ranked`` is True, results are ordered by descending
+        ``search_rank``, then by descending item_date.
+
+        If settings.EBPUB_FULL_TEXT_SEARCH is False, falls back to
+        a case-insensitive substring match of the whole query, and
+        ``search_rank`` is always 0.
+        """
+        clone = self._clone()
+        if getattr(settings, 'EBPUB_FULL_TEXT_SEARCH', True):
+            tsquery = 'plainto_tsquery(%s::regconfig, %s)'
+            tsquery_params = (constants.FULL_TEXT_SEARCH_CONFIG, query)
+            clone = clone.extra(
+                select={'search_rank': 'ts_rank(db_newsitem.search_vector, %s)' % tsquery},
+                select_params=tsquery_params,
+                where=('db_newsitem.search_vector @@ %s' % tsquery,),
+                params=tsquery_params)
+        else:
+            pattern = '%%%s%%' % query
+            clone = clone.extra(
+                select={'search_rank': '0'},
+                where=('(db_newsitem.title ILIKE %s OR db_newsitem.description ILIKE %s)',),
+                params=(pattern, pattern))
+        if ranked:
+            clone = clone.order_by('-search_rank', '-item_date')
+        return clone
+
     def by_request(self, request):
         """
         Returns a QuerySet that does additional request-specific
@@ -1260,6 +1371,12 @@ class NewsItemManager(models.GeoManager):
         """
         return self.get_query_set().text_search(*args, **kwargs)
 
+    def search(self, *args, **kwargs):
+        """
+        See :py:meth:`NewsItemQuerySet.search`
+        """
+        return self.get_query_set().search(*args, **kwargs)
+
     def date_counts(self, *args, **kwargs):
         """
         See :py:meth:`NewsItemQuerySet.date_counts`
@@ -1380,18 +1497,41 @@ class NewsItem(models.Model):
         Return a list of AttributeForTemplate objects for this NewsItem. The
         objects are ordered by SchemaField.display_order.
         """
-        fields = SchemaField.objects.filter(schema__id=self.schema_id).select_related().order_by('display_order')
+        fields = cached_schema_fields([self.schema_id]).get(self.schema_id)
         if not fields:
             return []
         if not self.attributes:
             logger.warn("%s has fields in its schema, but no attributes!" % self)
             # Hopefully we can cope with an empty dict.
             #return []
-        return [AttributeForTemplate(f, self.attributes) for f in fields]
+        # Fetch all of the Lookups at once, unless they've already been
+        # fetched eg. by ebpub.db.utils.populate_attributes().
+        lookup_ids = set()
+        for f in fields:
+            if f.is_lookup:
+                lookup_ids.update(_lookup_ids(self.attributes.get(f.name)))
+        lookups = lookup_ids and Lookup.objects.in_bulk(list(lookup_ids)) or {}
+        return [AttributeForTemplate(f, self.attributes, lookups) for f in fields]
+
+
+def _lookup_ids(raw_value):
+    # Lookup IDs from a raw lookup attribute value, which is an int,
+    # or (for many-to-many lookups) a comma-separated string of ints.
+    # Empty for values that are Lookups already.
+    if isinstance(raw_value, (int, long)):
+        return [raw_value]
+    if isinstance(raw_value, basestring):
+        try:
+            return [int(i) for i in raw_value.split(',') if i]
+        except ValueError:
+            return []
+    return []
 
 
 class AttributeForTemplate(object):
-    def __init__(self, schema_field, attribute_row):
+    def __init__(self, schema_field, attribute_row, lookups=None):
+        # ``lookups``, if given, is a dict of Lookups by id that
+        # includes this attribute's values.
         self.sf = schema_field
         if not schema_field.name in attribute_row:
             logger.warn("Attribute row %s is missing field %s" %
@@ -1407,7 +1547,7 @@ class AttributeForTemplate(object):
                 self.values = [self.raw_value]
             elif (isinstance(self.raw_value, list) and self.raw_value
                   and isinstance(self.raw_value[0], Lookup)):
-                self.values = self.raw_values
+                self.values = self.raw_value
             elif self.raw_value is None or self.raw_value == '':
                 self.values = []
             elif self.sf.is_many_to_many_lookup():
@@ -1416,8 +1556,11 @@ class AttributeForTemplate(object):
                 except ValueError:
                     self.values = []
                 else:
-                    lookups = Lookup.objects.in_bulk(id_values)
+                    if lookups is None:
+                        lookups = Lookup.objects.in_bulk(id_values)
                     self.values = [lookups[i] for i in id_values if i in lookups]
+            elif lookups is not None and self.raw_value in lookups:
+                self.values = [lookups[self.raw_value]]
             else:
                 self.values = [Lookup.objects.get(id=self.raw_value)]
         else:
@@ -1724,6 +1867,30 @@ class NewsItemLocation(models.Model):
         return u'%s - %s' % (self.news_item, self.location)
 
 
+class NewsItemLookup(models.Model):
+    """
+    Many-to-many lookup attribute values, one row per NewsItem and
+    Lookup, so they can be searched with an index instead of by regex
+    over the comma-separated string in the :py:class:`Attribute` table.
+
+    Normally you don't have to worry about creating NewsItemLookups:
+    there are database triggers that update this table whenever an
+    Attribute row or a SchemaField is saved.  To rebuild it, use
+    :py:mod:`rebuild_newsitem_lookups <ebpub.db.bin.rebuild_newsitem_lookups>`.
+    """
+    news_item = models.ForeignKey(NewsItem)
+    schema_field = models.ForeignKey(SchemaField)
+    # Deliberately not a ForeignKey: Attributes may be loaded before
+    # the Lookups they refer to, eg. from fixtures.
+    lookup_id = models.IntegerField(db_index=True)
+
+    class Meta:
+        unique_together = (('news_item', 'schema_field', 'lookup_id'),)
+
+    def __unicode__(self):
+        return u'%s - %s' % (self.news_item_id, self.lookup_id)
+
+
 #############################################################################
 # Aggregates.
 
@@ -1772,6 +1939,44 @@ class AggregateFieldLookup(AggregateBaseClass):
     lookup = models.ForeignKey(Lookup)
 
 
+class AggregateLocationFieldLookup(AggregateBaseClass):
+    """Total items in the schema in location with schema_field's value = lookup,
+    over all time.  Only kept for charted lookup fields.
+    """
+    location_type = models.ForeignKey(LocationType)
+    location = models.ForeignKey(Location)
+    schema_field = models.ForeignKey(SchemaField)
+    lookup = models.ForeignKey(Lookup)
+
+
+class AggregateChange(models.Model):
+    """
+    Log of aggregate buckets touched since the last incremental run of
+    :py:mod:`update_aggregates <ebpub.db.bin.update_aggregates>`.
+
+    Rows are written by database triggers on db_newsitem,
+    db_newsitemlocation and db_attribute, and are consumed (deleted) by
+    ``update_aggregates --incremental``. You shouldn't need to create
+    these yourself.
+    """
+    # These are deliberately not ForeignKeys: rows get logged by
+    # triggers while the related NewsItems, Locations and even Schemas
+    # are being deleted.
+    schema_id = models.IntegerField(db_index=True)
+    date_part = models.DateField(null=True,
+                                 help_text="item_date of the changed NewsItem.")
+    location_id = models.IntegerField(
+        null=True,
+        help_text="Set if only this Location's buckets were affected; null means all Locations for the date.")
+    attributes_only = models.BooleanField(
+        default=False,
+        help_text="True if only Attribute values changed, ie. only lookup aggregates are affected.")
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return u'Change to schema %s on %s' % (self.schema_id, self.date_part)
+
+
 class SearchSpecialCase(models.Model):
     """
     Used as a fallback for location searches that don't match
@@ -1867,3 +2072,13 @@ def clear_allowed_schema_ids_cache(sender, **kwargs):
 post_update.connect(clear_allowed_schema_ids_cache, sender=Schema)
 post_save.connect(clear_allowed_schema_ids_cache, sender=Schema)
 post_delete.connect(clear_allowed_schema_ids_cache, sender=Schema)
+
+post_update.connect(clear_schema_fields_cache, sender=Schema)
+post_save.connect(clear_schema_fields_cache, sender=Schema)
+post_delete.connect(clear_schema_fields_cache, sender=Schema)
+post_save.connect(clear_schema_fields_cache, sender=SchemaField)
+post_delete.connect(clear_schema_fields_cache, sender=SchemaField)
+
+for _model in (Location, LocationSynonym, LocationType):
+    post_save.connect(bump_gazetteer_generation, sender=_model)
+    post_delete.connect(bump_gazetteer_generation, sender=_model)
@@ -282,6 +282,34 @@ class TextSearchFilter(AttributeFilter):
     def validate(self):
         return {}
 
+
+class SearchFilter(NewsitemFilter):
+
+    """Does a full-text search of NewsItem titles and descriptions.
+    See :py:meth:`ebpub.db.models.NewsItemQuerySet.search`.
+    """
+
+    _sort_value = 1000.0
+    slug = 'search'
+    label = u'Search'
+    argname = 'search'
+
+    def __init__(self, request, context, queryset, *args, **kwargs):
+        NewsitemFilter.__init__(self, request, context, queryset, *args, **kwargs)
+        if not args:
+            raise FilterError('Search requires search terms')
+        self.query = u' '.join(args)
+        self.short_value = self.query
+        self.value = self.query
+        self.query_param_value = self.query
+
+    def apply(self):
+        # Views do their own ordering.
+        self.qs = self.qs.search(self.query, ranked=False)
+
+    def validate(self):
+        return {}
+
 class BoolFilter(AttributeFilter):
 
     """
@@ -836,6 +864,11 @@ class FilterChain(SortedDict):
                                                          schema=self.schema)
             self.replace(schemafield, search_string)
 
+        # Full-text search of titles and descriptions.
+        search_terms = pop_key('search')
+        if search_terms:
+            self.replace('search', *search_terms)
+
         # All remaining args.
         for argname in params.keys():
 
@@ -966,6 +999,9 @@ class FilterChain(SortedDict):
         if key == 'id':
             val = IdFilter(self.request, self.context, self.qs, ids=values)
 
+        elif key == 'search':
+            val = SearchFilter(self.request, self.context, self.qs, *values)
+
         elif isinstance(values[0], models.Location):
             val = LocationFilter(self.request, self.context, self.qs, location=values[0])
             key = val.slug
@@ -217,6 +217,51 @@ class DatabaseExtensionsTestCase(TestCase):
         self.assertEqual(top_lookups[1]['lookup'].slug, u'tag-2')
 
 
+    def test_cached_schema_fields(self):
+        from ebpub.db.models import SchemaField, cached_schema_fields
+        ni = NewsItem.objects.get(id=1)
+        # Loading fixtures cleared the cache.
+        with self.assertNumQueries(1):
+            fields = cached_schema_fields([ni.schema_id])[ni.schema_id]
+        self.assertEqual([f.display_order for f in fields],
+                         sorted([f.display_order for f in fields]))
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_schema_fields([ni.schema_id])[ni.schema_id],
+                             fields)
+            self.assertEqual(cached_schema_fields([ni.schema_id, 9999]).keys(),
+                             [ni.schema_id])
+            fields[0].schema.slug
+
+        # Changes are noticed.
+        sf = SchemaField.objects.get(name='beat')
+        sf.pretty_name = 'Police Beat'
+        sf.save()
+        fields = cached_schema_fields([ni.schema_id])[ni.schema_id]
+        self.assertIn('Police Beat', [f.pretty_name for f in fields])
+        sf.delete()
+        fields = cached_schema_fields([ni.schema_id])[ni.schema_id]
+        self.assertNotIn('beat', [f.name for f in fields])
+
+    def test_attributes_for_template__num_queries(self):
+        ni = NewsItem.objects.get(id=1)
+        ni.attributes_for_template()  # Warm the SchemaField cache.
+        ni = NewsItem.objects.get(id=1)
+        # One query for attributes, and one for all the Lookups.
+        with self.assertNumQueries(2):
+            attrs = ni.attributes_for_template()
+        by_name = dict([(a.sf.name, a) for a in attrs])
+        self.assertEqual(by_name['beat'].values[0].slug, u'beat-214')
+        self.assertEqual(by_name['case_number'].values, [u'case number 1'])
+
+        # No queries at all if attributes and Lookups are preloaded.
+        from ebpub.db.utils import populate_attributes
+        ni2 = NewsItem.objects.get(id=1)
+        populate_attributes([ni2])
+        with self.assertNumQueries(0):
+            attrs2 = ni2.attributes_for_template()
+        for attr, attr2 in zip(attrs, attrs2):
+            self.assertEqual(attr.values, attr2.values)
+
     def test_allowed_schema_ids(self):
         from ebpub.db.models import Schema
         self.assertIn(1, Schema.objects.allowed_schema_ids())
@@ -276,3 +321,71 @@ class DatabaseExtensionsTestCase(TestCase):
         self.assertEqual(qs.count(), 1)
         qs = by_attribute(sf, ['999'], is_lookup=True)
         self.assertEqual(qs.count(), 0)
+
+    def test_newsitem_lookups_kept_in_sync(self):
+        from ebpub.db.models import NewsItemLookup, SchemaField
+        sf = SchemaField.objects.get(name='tag')
+        def lookup_ids(item_id):
+            return sorted(NewsItemLookup.objects.filter(
+                    news_item__id=item_id, schema_field=sf).values_list('lookup_id', flat=True))
+        # Filled in by triggers as the fixture was loaded.
+        self.assertEqual(lookup_ids(1), [71, 72, 73])
+        self.assertEqual(lookup_ids(3), [71])
+        item = NewsItem.objects.get(id=3)
+        item.attributes['tag'] = '72,73'
+        self.assertEqual(lookup_ids(3), [72, 73])
+        self.assertEqual(NewsItem.objects.by_attribute(sf, ['3'], is_lookup=True).count(), 2)
+        Attribute.objects.filter(news_item__id=3).delete()
+        self.assertEqual(lookup_ids(3), [])
+
+    def test_search(self):
+        # Matches all the words, in title or description, with stemming.
+        self.assertEqual(sorted(NewsItem.objects.search('crimes', ranked=False).values_list('id', flat=True)),
+                         [1, 2, 3])
+        self.assertEqual(list(NewsItem.objects.search('crime location 32').values_list('id', flat=True)),
+                         [3])
+        self.assertEqual(NewsItem.objects.search('crime arson').count(), 0)
+        # The index is kept up to date.
+        item = NewsItem.objects.get(id=2)
+        item.description = u'Arson in location 77.'
+        item.save()
+        self.assertEqual(list(NewsItem.objects.search('arson').values_list('id', flat=True)),
+                         [2])
+        # Title matches rank higher.
+        item = NewsItem.objects.get(id=1)
+        item.title = u'Arson'
+        item.save()
+        results = list(NewsItem.objects.search('arson'))
+        self.assertEqual([ni.id for ni in results], [1, 2])
+        self.assert_(results[0].search_rank > results[1].search_rank)
+
+    def test_search__only_reindexed_when_text_changes(self):
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute("UPDATE db_newsitem SET search_vector = to_tsvector('zebra') WHERE id = 3")
+        # Updates that don't change the text keep the old vector...
+        NewsItem.objects.filter(id=3).update(location_name=u'Somewhere else')
+        self.assertEqual(list(NewsItem.objects.search('zebra').values_list('id', flat=True)),
+                         [3])
+        # ... and setting it to NULL rebuilds it.
+        cursor.execute("UPDATE db_newsitem SET search_vector = NULL WHERE id = 3")
+        self.assertEqual(NewsItem.objects.search('zebra').count(), 0)
+        self.assertEqual(list(NewsItem.objects.search('crime location 32').values_list('id', flat=True)),
+                         [3])
+
+    def test_search__fallback(self):
+        with self.settings(EBPUB_FULL_TEXT_SEARCH=False):
+            self.assertEqual(list(NewsItem.objects.search('CRIME TITLE 2').values_list('id', flat=True)),
+                             [2])
+            # No stemming.
+            self.assertEqual(NewsItem.objects.search('crimes').count(), 0)
+            self.assertEqual(NewsItem.objects.search('location 32')[0].search_rank, 0)
+
+    def test_rebuild_newsitem_lookups(self):
+        from ebpub.db.bin.rebuild_newsitem_lookups import rebuild_all
+        from ebpub.db.models import NewsItemLookup
+        before = sorted(NewsItemLookup.objects.values_list('news_item', 'schema_field', 'lookup_id'))
+        NewsItemLookup.objects.all().delete()
+        self.assertEqual(rebuild_all(), len(before))
+        self.assertEqual(sorted(NewsItemLookup.objects.values_list('news_item', 'schema_field', 'lookup_id')),
+                         before)
@@ -451,6 +451,22 @@ class TestTextFilter(TestCase):
         self.assertEqual(self.mock_qs.text_search.call_count, 1)
 
 
+class TestSearchFilter(TestCase):
+
+    def test_filter__errors(self):
+        from ebpub.db.schemafilters import SearchFilter
+        self.assertRaises(FilterError, SearchFilter, None, {}, mock.Mock())
+
+    def test_filter__ok(self):
+        from ebpub.db.schemafilters import SearchFilter
+        mock_qs = mock.Mock()
+        filt = SearchFilter(None, {}, mock_qs, 'hello', 'goodbye')
+        self.assertEqual(filt.validate(), {})
+        self.assertEqual(filt.get_query_params(), {'search': u'hello goodbye'})
+        filt.apply()
+        mock_qs.search.assert_called_once_with(u'hello goodbye', ranked=False)
+
+
 class TestFilterChain(TestCase):
 
     def test_empty(self):
@@ -773,6 +789,14 @@ class TestUrlNormalization(TestCase):
         expected = filter_reverse('crime', [('by-status', 'hello goodbye')])
         self.assertEqual(chain.make_url(), expected)
 
+    def test_make_url__search_query(self):
+        url = urlresolvers.reverse('ebpub-schema-filter', args=['crime'])
+        url += '?search=hello+goodbye'
+        chain = self._make_chain(url)
+        self.assertEqual(chain['search'].query, u'hello goodbye')
+        expected = filter_reverse('crime', [('search', 'hello goodbye')])
+        self.assertEqual(chain.make_url(), expected)
+
     def test_make_url__preserves_other_query_params_sorted(self):
         url = filter_reverse('crime', [('start_date', '2011-04-05'),
                                        ('end_date', '2011-04-06')])
@@ -0,0 +1,202 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Unit tests for db.bin.update_aggregates.
+"""
+
+from ebpub.db.bin import update_aggregates as ua
+from ebpub.db.models import AggregateAll, AggregateDay, AggregateLocation
+from ebpub.db.models import AggregateLocationDay, AggregateFieldLookup
+from ebpub.db.models import AggregateLocationFieldLookup
+from ebpub.db.models import AggregateChange, NewsItem, SchemaField
+from ebpub.utils.django_testcase_backports import TestCase
+import datetime
+import mock
+
+
+def _snapshot(schema_id):
+    result = {}
+    for model, fields in (
+        (AggregateAll, ('total',)),
+        (AggregateDay, ('date_part', 'total')),
+        (AggregateLocationDay, ('location', 'date_part', 'total')),
+        (AggregateLocation, ('location', 'total')),
+        (AggregateFieldLookup, ('schema_field', 'lookup', 'total')),
+        (AggregateLocationFieldLookup, ('location', 'schema_field', 'lookup', 'total'))):
+        result[model.__name__] = sorted(
+            model.objects.filter(schema__id=schema_id).values_list(*fields))
+    return result
+
+
+class TestIncrementalUpdate(TestCase):
+
+    fixtures = ('crimes.json',)
+
+    schema_id = 1
+
+    def _change_some_items(self):
+        item = NewsItem.objects.get(id=1)
+        item.item_date = datetime.date(2006, 11, 8)
+        item.save()
+        NewsItem.objects.filter(id=2).delete()
+
+    def test_changes_are_logged(self):
+        ua.update_aggregates(self.schema_id)
+        self.assertEqual(AggregateChange.objects.filter(schema_id=self.schema_id).count(), 0)
+        self._change_some_items()
+        buckets = ua.get_changed_buckets(self.schema_id)
+        self.assertEqual(buckets.dates, set([datetime.date(2006, 9, 26),
+                                             datetime.date(2006, 11, 8)]))
+
+    def test_incremental_matches_full(self):
+        ua.update_aggregates(self.schema_id)
+        self._change_some_items()
+        ua.update_aggregates_incremental(self.schema_id)
+        incremental = _snapshot(self.schema_id)
+        ua.update_aggregates(self.schema_id, reset=True)
+        self.assertEqual(incremental, _snapshot(self.schema_id))
+        self.assertEqual(AggregateChange.objects.filter(schema_id=self.schema_id).count(), 0)
+
+    def test_incremental_dry_run(self):
+        ua.update_aggregates(self.schema_id)
+        before = _snapshot(self.schema_id)
+        self._change_some_items()
+        ua.update_aggregates_incremental(self.schema_id, dry_run=True)
+        self.assertEqual(before, _snapshot(self.schema_id))
+        # Nothing consumed either.
+        self.assertNotEqual(AggregateChange.objects.filter(schema_id=self.schema_id).count(), 0)
+
+    def test_incremental_falls_back_to_full(self):
+        self.assertEqual(AggregateAll.objects.filter(schema__id=self.schema_id).count(), 0)
+        ua.update_aggregates_incremental(self.schema_id)
+        self.assertEqual(AggregateAll.objects.get(schema__id=self.schema_id).total,
+                         NewsItem.objects.filter(schema__id=self.schema_id).count())
+
+    def test_too_many_changes(self):
+        ua.update_aggregates(self.schema_id)
+        self._change_some_items()
+        ua.update_aggregates_incremental(self.schema_id, max_changes=1)
+        full = _snapshot(self.schema_id)
+        ua.update_aggregates(self.schema_id, reset=True)
+        self.assertEqual(full, _snapshot(self.schema_id))
+
+
+class TestLocationFieldLookups(TestCase):
+
+    fixtures = ('crimes.json', 'test-locationdetail-views.json')
+
+    def _live_counts(self, location_id):
+        result = []
+        for sf in SchemaField.objects.filter(schema__id=1, is_lookup=True, is_charted=True):
+            items = NewsItem.objects.filter(newsitemlocation__location__id=location_id)
+            result.extend([(sf.id, v['lookup'].id, v['count'])
+                           for v in items.top_lookups(sf, 100)])
+        return sorted(result)
+
+    def _aggregate_counts(self, location_id):
+        return sorted(AggregateLocationFieldLookup.objects.filter(
+                location__id=location_id).values_list('schema_field', 'lookup', 'total'))
+
+    def test_full_update(self):
+        ua.update_aggregates(1)
+        for location_id in (2000, 3000):
+            self.assertEqual(self._aggregate_counts(location_id),
+                             self._live_counts(location_id))
+        self.assertEqual(self._aggregate_counts(2000),
+                         [(8, 58, 1), (8, 97, 1), (9, 66, 1), (9, 77, 1)])
+
+    def test_incremental_update(self):
+        ua.update_aggregates(1)
+        # Move item 2 from Hood 1 to Hood 2.
+        from ebpub.db.models import NewsItemLocation
+        NewsItemLocation.objects.filter(news_item__id=2).delete()
+        NewsItemLocation.objects.create(news_item_id=2, location_id=3000)
+        buckets = ua.get_changed_buckets(1)
+        self.assertEqual(ua.get_changed_location_ids(1, buckets), set([2000, 3000]))
+        ua.update_aggregates_incremental(1)
+        for location_id in (2000, 3000):
+            self.assertEqual(self._aggregate_counts(location_id),
+                             self._live_counts(location_id))
+
+
+class TestSmartUpdate(TestCase):
+
+    fixtures = ('crimes.json',)
+
+    def _day_totals(self):
+        return sorted(AggregateDay.objects.filter(schema__id=1).values_list('date_part', 'total'))
+
+    def _smart_update(self, new_values, **kwargs):
+        from django.db import connection
+        return ua.smart_update(connection.cursor(), new_values,
+                               AggregateDay._meta.db_table, ('date_part', 'total'),
+                               ('date_part',), {'schema_id': 1}, **kwargs)
+
+    def test_insert_update_delete(self):
+        d1, d2, d3 = [datetime.date(2012, 1, i) for i in (1, 2, 3)]
+        self.assertEqual(self._smart_update([{'date_part': d1, 'total': 1},
+                                             {'date_part': d2, 'total': 2}]),
+                         (2, 0, 0))
+        self.assertEqual(self._day_totals(), [(d1, 1), (d2, 2)])
+        self.assertEqual(self._smart_update([{'date_part': d2, 'total': 5},
+                                             {'date_part': d3, 'total': 3}]),
+                         (1, 1, 1))
+        self.assertEqual(self._day_totals(), [(d2, 5), (d3, 3)])
+        # Unchanged rows are left alone.
+        self.assertEqual(self._smart_update([{'date_part': d2, 'total': 5},
+                                             {'date_part': d3, 'total': 3}]),
+                         (0, 0, 0))
+
+    def test_extra_where(self):
+        d1, d2 = datetime.date(2012, 1, 1), datetime.date(2012, 1, 2)
+        self._smart_update([{'date_part': d1, 'total': 1},
+                            {'date_part': d2, 'total': 2}])
+        # Rows outside extra_where aren't deleted.
+        self.assertEqual(self._smart_update([{'date_part': d2, 'total': 4}],
+                                            extra_where=('date_part IN (%s)', [d2])),
+                         (0, 1, 0))
+        self.assertEqual(self._day_totals(), [(d1, 1), (d2, 4)])
+
+    def test_dry_run(self):
+        d1 = datetime.date(2012, 1, 1)
+        self.assertEqual(self._smart_update([{'date_part': d1, 'total': 1}], dry_run=True),
+                         (1, 0, 0))
+        self.assertEqual(self._day_totals(), [])
+
+
+class TestUpdateAll(TestCase):
+
+    fixtures = ('crimes.json',)
+
+    def test_failure_isolation(self):
+        from ebpub.db.models import Schema
+        schemas = list(Schema.objects.all())
+        bad_id = schemas[0].id
+        real_update = ua.update_aggregates
+        def update(schema_id, **kwargs):
+            if schema_id == bad_id:
+                raise ValueError('oops')
+            return real_update(schema_id, **kwargs)
+        with mock.patch.object(ua, 'update_aggregates', update):
+            results = ua.update_all_aggregates()
+        self.assertEqual(len(results), len(schemas))
+        failed = [name for (name, seconds, error) in results if error]
+        self.assertEqual(failed, [schemas[0].plural_name])
+        for schema in schemas[1:]:
+            self.assertEqual(AggregateAll.objects.filter(schema=schema).count(), 1)
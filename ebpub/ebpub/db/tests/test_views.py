@@ -213,6 +213,132 @@ class TestAjaxViews(BaseTestCase):
         self.assertEqual(len(items['features']), 3)
 
 
+class TestAggregatedPlaceViews(BaseTestCase):
+
+    # crimes.json has the charted lookups, and
+    # test-locationdetail-views.json puts its items in Locations.
+    fixtures = ('crimes.json', 'test-locationdetail-views.json')
+
+    def setUp(self):
+        super(TestAggregatedPlaceViews, self).setUp()
+        from ebpub.db.bin.update_aggregates import update_aggregates
+        update_aggregates(1)
+
+    def _get_date_chart(self):
+        url = urlresolvers.reverse('ajax-place-date-chart') + '?s=1&pid=l:2000'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.context['date_chart']
+
+    @mock.patch('ebpub.db.views.today')
+    def test_date_chart_from_aggregates(self, mock_today):
+        mock_today.return_value = datetime.date(2006, 11, 10)
+        chart = self._get_date_chart()
+        self.assertEqual(chart['total_count'], 1)
+        self.assertEqual(chart['dates'][-1],
+                         {'date': datetime.date(2006, 11, 8), 'count': 1})
+        # Prove it's read from the aggregates.
+        models.AggregateLocationDay.objects.filter(
+            location__id=2000, date_part=datetime.date(2006, 11, 8)).update(total=5)
+        self.assertEqual(self._get_date_chart()['total_count'], 5)
+
+    @mock.patch('ebpub.db.views.today')
+    def test_date_chart_with_pending_changes(self, mock_today):
+        mock_today.return_value = datetime.date(2006, 11, 10)
+        models.AggregateLocationDay.objects.filter(
+            location__id=2000, date_part=datetime.date(2006, 11, 8)).update(total=5)
+        # Changes since the last update_aggregates mean a live count.
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=2000, date_part=datetime.date(2006, 11, 8))
+        self.assertEqual(self._get_date_chart()['total_count'], 1)
+
+    def test_lookup_chart_from_aggregates(self):
+        sf = models.SchemaField.objects.get(id=8)
+        live = models.NewsItem.objects.filter(
+            newsitemlocation__location__id=2000).top_lookups(sf, 10)
+        url = urlresolvers.reverse('ajax-place-lookup-chart') + '?sf=8&pid=l:2000'
+        with mock.patch('ebpub.db.models.NewsItemQuerySet.top_lookups') as mock_top:
+            response = self.client.get(url)
+            self.assertEqual(mock_top.call_count, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_count'], 2)
+        self.assertEqual(sorted([(v['lookup'].id, v['count']) for v in response.context['lookup']['top_values']]),
+                         sorted([(v['lookup'].id, v['count']) for v in live]))
+
+    def test_current_aggregate_schema_ids(self):
+        from ebpub.db.views import get_current_aggregate_schema_ids
+        location = models.Location.objects.get(id=2000)
+        self.assertEqual(get_current_aggregate_schema_ids([1], location), set([1]))
+        # A change to an item in this location.
+        models.NewsItem.objects.get(id=2).save()
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=None, date_part=datetime.date(2006, 11, 8))
+        self.assertEqual(get_current_aggregate_schema_ids([1], location), set())
+        # Changes outside the given dates don't matter.
+        self.assertEqual(get_current_aggregate_schema_ids(
+                [1], location, datetime.date(2007, 1, 1), datetime.date(2007, 2, 1)),
+                         set([1]))
+
+    def test_current_aggregate_schema_ids__location_change(self):
+        from ebpub.db.views import get_current_aggregate_schema_ids
+        location = models.Location.objects.get(id=2000)
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=2000, date_part=datetime.date(2006, 11, 8))
+        self.assertEqual(get_current_aggregate_schema_ids([1], location), set())
+
+    def test_current_aggregate_schema_ids__attributes_only(self):
+        from ebpub.db.views import get_current_aggregate_schema_ids
+        location = models.Location.objects.get(id=2000)
+        models.NewsItem.objects.get(id=2).save()
+        models.AggregateChange.objects.filter(attributes_only=False).delete()
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=None, date_part=datetime.date(2006, 11, 8),
+            attributes_only=True)
+        # Date counts aren't affected, lookup counts may be.
+        self.assertEqual(get_current_aggregate_schema_ids([1], location), set([1]))
+        self.assertEqual(get_current_aggregate_schema_ids([1], location, lookups=True),
+                         set())
+
+    def test_aggregates_used_after_change_elsewhere(self):
+        from ebpub.db.views import get_current_aggregate_schema_ids
+        location = models.Location.objects.get(id=2000)
+        # A new item, somewhere else.
+        from django.contrib.gis.geos import Point
+        item = models.NewsItem.objects.get(id=3)
+        item.id = None
+        item.location = Point(0, 0)
+        item.save()
+        models.NewsItemLocation.objects.get_or_create(news_item=item, location_id=3000)
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=None, date_part=item.item_date)
+        models.AggregateChange.objects.create(
+            schema_id=1, location_id=None, date_part=item.item_date,
+            attributes_only=True)
+        self.assertEqual(get_current_aggregate_schema_ids([1], location), set([1]))
+        self.assertEqual(get_current_aggregate_schema_ids([1], location, lookups=True),
+                         set([1]))
+        url = urlresolvers.reverse('ajax-place-lookup-chart') + '?sf=8&pid=l:2000'
+        with mock.patch('ebpub.db.models.NewsItemQuerySet.top_lookups') as mock_top:
+            response = self.client.get(url)
+            self.assertEqual(mock_top.call_count, 0)
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch('ebpub.db.views.today')
+    def test_overview(self, mock_today):
+        url = urlresolvers.reverse('ebpub-location-overview',
+                                   args=['neighborhoods', 'hood-1'])
+        mock_today.return_value = datetime.date(2006, 11, 10)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item.id for item in response.context['schema_groups'][0]['latest_newsitems']],
+                         [2, 1])
+        # Nothing in the last 90 days, according to the aggregates.
+        mock_today.return_value = datetime.date(2012, 1, 1)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['schema_groups'][0]['latest_newsitems'], [])
+
+
 class TestSchemaFilterView(BaseTestCase):
 
     fixtures = ('test-schemafilter-views.json',)
@@ -21,7 +21,6 @@ from django.http import Http404
 from django.shortcuts import get_object_or_404
 from ebpub.db.models import AttributeDict
 from ebpub.db.models import Location
-from ebpub.db.models import field_mapping
 from ebpub.streets.models import Block
 from ebpub.streets.models import City
 from ebpub.metros.allmetros import get_metro
@@ -55,38 +54,50 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
 
     Note that the list is edited in place; there is no return value.
     """
-    from ebpub.db.models import Attribute, Lookup, SchemaField
-    # To accomplish this, we determine which NewsItems in ni_list require
-    # attribute prepopulation, and run a single DB query that loads all of the
-    # attributes. Another way to do this would be to load all of the attributes
-    # when loading the NewsItems in the first place (via a JOIN), but we want
-    # to avoid joining such large tables.
-
     preload_schema_ids = set([s.id for s in schema_list if s.uses_attributes_in_list])
     if not preload_schema_ids:
         return
     preloaded_nis = [ni for ni in newsitem_list if ni.schema_id in preload_schema_ids]
-    if not preloaded_nis:
+    populate_attributes(preloaded_nis)
+
+def populate_attributes(newsitem_list):
+    """
+    Like populate_attributes_if_needed(), but populates the
+    attributes of all the given NewsItems regardless of their
+    schemas' uses_attributes_in_list.
+
+    Useful for code that will look at the attributes of every item,
+    eg. the API; a list of any length costs at most two queries,
+    given cached SchemaFields.
+    """
+    from ebpub.db.models import Attribute, Lookup, cached_schema_fields
+    # To accomplish this, we run a single DB query that loads all of the
+    # attributes. Another way to do this would be to load all of the attributes
+    # when loading the NewsItems in the first place (via a JOIN), but we want
+    # to avoid joining such large tables.
+    if not newsitem_list:
         return
+    schema_ids = set([ni.schema_id for ni in newsitem_list])
     # fmap is a mapping like:
     # {schema_id: {'fields': [(name, real_name)], 'lookups': [real_name1, real_name2]}}
     fmap = {}
     attribute_columns_to_select = set(['news_item'])
 
-    for sf in SchemaField.objects.filter(schema__id__in=[s.id for s in schema_list]).values('schema', 'name', 'real_name', 'is_lookup'):
-        fmap.setdefault(sf['schema'], {'fields': [], 'lookups': []})['fields'].append((sf['name'], sf['real_name']))
-        if sf['is_lookup']:
-            fmap[sf['schema']]['lookups'].append(sf['real_name'])
-        attribute_columns_to_select.add(str(sf['real_name']))
-
-    att_dict = dict([(i['news_item'], i) for i in Attribute.objects.filter(news_item__id__in=[ni.id for ni in preloaded_nis]).values(*list(attribute_columns_to_select))])
+    for schema_id, fields in cached_schema_fields(schema_ids).items():
+        for sf in fields:
+            fmap.setdefault(schema_id, {'fields': [], 'lookups': []})['fields'].append((sf.name, sf.real_name))
+            if sf.is_lookup:
+                fmap[schema_id]['lookups'].append(sf.real_name)
+            attribute_columns_to_select.add(str(sf.real_name))
 
     if not fmap:
         return
 
+    att_dict = dict([(i['news_item'], i) for i in Attribute.objects.filter(news_item__id__in=[ni.id for ni in newsitem_list]).values(*list(attribute_columns_to_select))])
+
     # Determine which Lookup objects need to be retrieved.
     lookup_ids = set()
-    for ni in preloaded_nis:
+    for ni in newsitem_list:
         # Fix for #38: not all Schemas have SchemaFields, can be 100% vanilla.
         if not ni.schema_id in fmap:
             continue
@@ -104,22 +115,25 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
             else:
                 lookup_ids.add(value)
 
-    # Retrieve only the Lookups that are referenced in preloaded_nis.
+    # Retrieve only the Lookups that are referenced in newsitem_list.
     lookup_ids = [i for i in lookup_ids if i]
     if lookup_ids:
         lookup_objs = Lookup.objects.in_bulk(lookup_ids)
     else:
         lookup_objs = {}
 
-    # Cache attribute values for each NewsItem in preloaded_nis.
-    for ni in preloaded_nis:
+    # Cache attribute values for each NewsItem in newsitem_list.
+    for ni in newsitem_list:
         # Fix for #38: Schemas may not have any SchemaFields, and thus
         # the ni will have no attributes, and the schema won't be in
         # fmap, and that's OK.
-        if not ni.id in att_dict:
-            continue
         if not ni.schema_id in fmap:
             continue
+        select_dict = dict(fmap[ni.schema_id]['fields'])
+        ni._attributes_cache = AttributeDict(ni.id, ni.schema_id, select_dict)
+        ni._attributes_cache.cached = True
+        if not ni.id in att_dict:
+            continue
 
         att = att_dict[ni.id]
         att_values = {}
@@ -134,9 +148,6 @@ def populate_attributes_if_needed(newsitem_list, schema_list,
                 else: # Many-to-many lookups are comma-separated strings.
                     value = [lookup_objs[int(i)] for i in value.split(',') if i]
             att_values[field_name] = value
-        select_dict = field_mapping([ni.schema_id]).get(ni.schema_id, {})
-        ni._attributes_cache = AttributeDict(ni.id, ni.schema_id, select_dict)
-        ni._attributes_cache.cached = True
         ni._attributes_cache.update(att_values)
 
 def populate_schema(newsitem_list, schema):
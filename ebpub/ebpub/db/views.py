@@ -20,7 +20,7 @@ from django.conf import settings
 from django.contrib.gis.shortcuts import render_to_kml
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Q
+from django.db.models import Min, Q, Sum
 from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect, HttpResponsePermanentRedirect
@@ -34,9 +34,11 @@ from ebpub.constants import HIDE_ADS_COOKIE_NAME
 from ebpub.db import breadcrumbs
 from ebpub.db import constants
 from ebpub.db.models import AggregateDay, AggregateLocation, AggregateFieldLookup
+from ebpub.db.models import AggregateAll, AggregateChange, AggregateLocationDay, AggregateLocationFieldLookup
 from ebpub.db.models import NewsItem, Schema, SchemaField, LocationType, Location, SearchSpecialCase
 from ebpub.db.schemafilters import FilterError
 from ebpub.db.schemafilters import FilterChain
+from ebpub.db.schemafilters import LocationFilter
 from ebpub.db.schemafilters import BadAddressException
 from ebpub.db.schemafilters import BadDateException
 
@@ -54,6 +56,7 @@ from ebpub.utils.dates import daterange, today
 from ebpub.utils.view_utils import eb_render
 from ebpub.utils.view_utils import get_schema_manager
 from ebpub.utils.view_utils import paginate
+from ebpub.utils.view_utils import paginate_by_request
 
 import datetime
 import hashlib
@@ -63,6 +66,11 @@ import re
 
 logger = logging.getLogger('ebpub.db.views')
 
+# NewsItem list orderings. These are also used as keys for pagination,
+# so must end with a unique field; see paginate_by_request().
+NEWS_ORDERING = ('-item_date', '-pub_date', '-id')
+EVENT_ORDERING = ('item_date', 'pub_date', 'id')
+
 ################################
 # HELPER FUNCTIONS (NOT VIEWS) #
 ################################
@@ -115,6 +123,83 @@ def get_date_chart(schemas, start_date, end_date, counts):
     return result
 
 
+def get_aggregate_location(filters):
+    """
+    If the FilterChain ``filters`` is just a Location (plus, optionally,
+    a schema and a date range), returns the Location, whose counts
+    can be read from the aggregate tables.  Otherwise returns None,
+    eg. for a block radius.
+    """
+    location_filter = filters.get('location')
+    if not isinstance(location_filter, LocationFilter):
+        return None
+    if set(filters.keys()) - set(['schema', 'location', 'date']):
+        return None
+    return location_filter.location_object
+
+def get_current_aggregate_schema_ids(schema_ids, location, start_date=None, end_date=None,
+                                     lookups=False):
+    """
+    Returns the set of ``schema_ids`` whose aggregates for ``location``
+    are up to date: they have been computed, and no changes that
+    could affect that location (between ``start_date`` and
+    ``end_date`` inclusive, if given) have been logged since.
+
+    Changes logged for all locations (eg. every new NewsItem) only
+    count if a NewsItem of that schema in ``location`` has been
+    modified since they were logged.  Changes to only Attribute values
+    are ignored unless ``lookups`` is True, ie. the lookup aggregates
+    are needed.  Editing the Attributes of an older NewsItem without
+    saving the NewsItem itself isn't noticed, so those aggregates may
+    be stale until the next ``update_aggregates``, like AggregateDay.
+    """
+    current = set(AggregateAll.objects.filter(schema__id__in=schema_ids).values_list('schema_id', flat=True))
+    if not current:
+        return current
+    changes = AggregateChange.objects.filter(schema_id__in=current)
+    changes = changes.filter(Q(location_id__isnull=True) | Q(location_id=location.id))
+    if not lookups:
+        changes = changes.filter(attributes_only=False)
+    if start_date is not None:
+        changes = changes.filter(date_part__gte=start_date)
+    if end_date is not None:
+        changes = changes.filter(date_part__lte=end_date)
+    changes = changes.values('schema_id', 'location_id').annotate(first=Min('created')).order_by()
+    stale = set()
+    since = {}
+    for change in changes:
+        if change['location_id'] is None:
+            since[change['schema_id']] = change['first']
+        else:
+            stale.add(change['schema_id'])
+    since = [(schema_id, first) for (schema_id, first) in since.items()
+             if schema_id not in stale]
+    if since:
+        modified = Q()
+        for schema_id, first in since:
+            modified |= Q(schema__id=schema_id,
+                          last_modification__gte=first - constants.AGGREGATE_CHANGE_CLOCK_SLACK)
+        items = NewsItem.objects.filter(modified, newsitemlocation__location__id=location.id)
+        if start_date is not None:
+            items = items.filter(item_date__gte=start_date)
+        if end_date is not None:
+            items = items.filter(item_date__lte=end_date)
+        stale.update(items.order_by().values_list('schema', flat=True).distinct())
+    return current - stale
+
+def get_location_top_lookups(schema_field, location, count):
+    """
+    Like :py:meth:`NewsItemQuerySet.top_lookups
+    <ebpub.db.models.NewsItemQuerySet.top_lookups>` for all
+    NewsItems in ``location``, but read from
+    AggregateLocationFieldLookup.
+    """
+    aggs = AggregateLocationFieldLookup.objects.filter(
+        schema_field__id=schema_field.id, location__id=location.id, total__gt=0)
+    aggs = aggs.select_related('lookup').order_by('-total', 'lookup__id')[:count]
+    return [{'lookup': agg.lookup, 'count': agg.total} for agg in aggs]
+
+
 def block_bbox(block, radius):
     """
     Given a :py:class:`ebpub.streets.models.Block`, and an integer ``radius``,
@@ -149,9 +234,20 @@ def ajax_place_lookup_chart(request):
         raise Http404('Invalid SchemaField')
     filters = FilterChain(request=request, schema=sf.schema)
     filters.add_by_place_id(request.GET.get('pid', ''))
-    qs = filters.apply()
-    total_count = qs.count()
-    top_values = qs.top_lookups(sf, 10)
+    top_values = None
+    location = get_aggregate_location(filters)
+    if sf.is_charted and location is not None and \
+            get_current_aggregate_schema_ids([sf.schema_id], location, lookups=True):
+        top_values = get_location_top_lookups(sf, location, 10)
+    if top_values:
+        total_count = AggregateLocationDay.objects.filter(
+            schema__id=sf.schema_id, location__id=location.id).aggregate(
+            total=Sum('total'))['total'] or 0
+    else:
+        # Not aggregated, or maybe not yet; count live.
+        qs = filters.apply()
+        total_count = qs.count()
+        top_values = qs.top_lookups(sf, 10)
     return render_to_response('db/snippets/lookup_chart.html', {
         'lookup': {'sf': sf, 'top_values': top_values},
         'total_count': total_count,
@@ -174,7 +270,17 @@ def ajax_place_date_chart(request):
         raise Http404('Invalid Schema')
     filters = FilterChain(request=request, schema=schema)
     filters.add_by_place_id(request.GET.get('pid', ''))
-    qs = filters.apply()
+    location = get_aggregate_location(filters)
+    if location is not None and not get_current_aggregate_schema_ids([schema.id], location):
+        location = None
+    if location is not None:
+        # Just a Location, so AggregateLocationDay has the same counts.
+        qs = AggregateLocationDay.objects.filter(
+            schema__id=schema.id, location__id=location.id, total__gt=0)
+        date_field = 'date_part'
+    else:
+        qs = filters.apply()
+        date_field = 'item_date'
 
     # These charts are used on eg. the place overview page; there,
     # they should be smaller than the ones on the schema_detail view;
@@ -183,25 +289,28 @@ def ajax_place_date_chart(request):
     if schema.is_event:
         # Soonest span that includes some.
         try:
-            qs = qs.filter(item_date__gte=today()).order_by('item_date', 'pub_date', 'id')
-            first_item = qs.values('item_date')[0]
-            start_date = first_item['item_date']
+            qs = qs.filter(**{date_field + '__gte': today()}).order_by(date_field)
+            start_date = qs.values_list(date_field, flat=True)[0]
         except IndexError:  # No matching items.
             start_date = today()
         end_date = today() + date_span
     else:
         # Most recent span that includes some.
         try:
-            qs = qs.filter(item_date__lte=today()).order_by('-item_date', '-pub_date', '-id')
-            last_item = qs.values('item_date')[0]
-            end_date = last_item['item_date']
+            qs = qs.filter(**{date_field + '__lte': today()}).order_by('-' + date_field)
+            end_date = qs.values_list(date_field, flat=True)[0]
         except IndexError:  # No matching items.
             end_date = today()
         start_date = end_date - date_span
 
     filters.add('date', start_date, end_date)
-    counts = filters.apply().date_counts()
-    date_chart = get_date_chart([schema], start_date, end_date, {schema.id: counts})[0]
+    if location is not None:
+        date_chart = get_date_chart_agg_model([schema], start_date, end_date,
+                                              AggregateLocationDay,
+                                              {'location__id': location.id})[0]
+    else:
+        counts = filters.apply().date_counts()
+        date_chart = get_date_chart([schema], start_date, end_date, {schema.id: counts})[0]
     return render_to_response('db/snippets/date_chart.html', {
         'schema': schema,
         'date_chart': date_chart,
@@ -799,10 +908,8 @@ def schema_filter(request, slug):
     # Make the queryset, with default date filtering if needed.
     qs, start_date, end_date = _default_date_filtering(filterchain)
 
-    if s.is_event:
-        qs = qs.order_by('item_date', 'id')
-    else:
-        qs = qs.order_by('-item_date', '-id')
+    ordering = s.is_event and EVENT_ORDERING or NEWS_ORDERING
+    qs = qs.order_by(*ordering)
 
     context['newsitem_qs'] = qs
 
@@ -837,12 +944,11 @@ def schema_filter(request, slug):
 
     # Pagination.
     try:
-        page = int(request.GET.get('page', '1'))
+        ni_list, pagination = paginate_by_request(request, qs, ordering)
     except ValueError:
         raise Http404('Invalid page')
-    ni_list, has_previous, has_next, idx_start, idx_end = paginate(qs, page=page)
-    if page > 1 and not ni_list:
-        raise Http404('No objects on page %s' % page)
+    if pagination['has_previous'] and not ni_list:
+        raise Http404('No objects on this page')
 
     populate_schema(ni_list, s)
     populate_attributes_if_needed(ni_list, [s])
@@ -888,18 +994,9 @@ def schema_filter(request, slug):
             logger.exception("Unhandled exception making large_map_url")
             pass
 
+    context.update(pagination)
     context.update({
         'newsitem_list': ni_list,
-
-        # Pagination stuff
-        'has_next': has_next,
-        'has_previous': has_previous,
-        'page_number': page,
-        'previous_page_number': page - 1,
-        'next_page_number': page + 1,
-        'page_start_index': idx_start + 1,
-        'page_end_index': idx_end,
-        # End pagination.
         'lookup_list': lookup_list,
         'boolean_lookup_list': boolean_lookup_list,
         'search_list': search_list,
@@ -1095,32 +1192,26 @@ def _news_context(request, context, max_items, show_upcoming=False, **filterargs
     if show_upcoming:
         # Events, from earliest to latest
         s_list = schema_manager.filter(is_event=True)
-        order_by = ('item_date_date', '-pub_date')
+        ordering = EVENT_ORDERING
         date_limit = Q(item_date__gte=today())
     else:
         # News, from newest to oldest
         s_list = schema_manager.filter(is_event=False)
-        order_by = ('-item_date_date', '-pub_date')
+        ordering = NEWS_ORDERING
         date_limit = Q(item_date__lte=today())
 
     filterchain.add('schema', list(s_list))
     newsitem_qs = filterchain.apply().select_related().filter(date_limit)
-    # TODO: can this really only be done via extra()?
-    newsitem_qs = newsitem_qs.extra(
-        select={'item_date_date': 'date(db_newsitem.item_date)'},
-        order_by=order_by + ('-schema__importance', 'schema'),
-    )
-
-    try:
-        page = int(request.GET.get('page', 1))
-    except ValueError:
-        return HttpResponse('Invalid Page %r' % page, status=400)
+    newsitem_qs = newsitem_qs.order_by(*ordering)
 
     # We're done filtering, so go ahead and do the query, to
     # avoid running it multiple times,
     # per http://docs.djangoproject.com/en/dev/topics/db/optimization
-    ni_list, has_previous, has_next, idx_start, idx_end = paginate(
-        newsitem_qs, page=page, pagesize=max_items)
+    try:
+        ni_list, pagination = paginate_by_request(
+            request, newsitem_qs, ordering, pagesize=max_items)
+    except ValueError:
+        raise Http404('Invalid page')
     schemas_used = list(set([ni.schema for ni in ni_list]))
     s_list = s_list.filter(is_special_report=False, allow_charting=True).order_by('plural_name')
     populate_attributes_if_needed(ni_list, schemas_used)
@@ -1129,17 +1220,9 @@ def _news_context(request, context, max_items, show_upcoming=False, **filterargs
     if not request.user.is_anonymous():
         hidden_schema_list = [o.schema for o in HiddenSchema.objects.filter(user_id=request.user.id)]
 
+    context.update(pagination)
     context.update({
         'newsitem_list': ni_list,
-        # Pagination stuff
-        'has_next': has_next,
-        'has_previous': has_previous,
-        'page_number': page,
-        'previous_page_number': page - 1,
-        'next_page_number': page + 1,
-        'page_start_index': idx_start + 1,
-        'page_end_index': idx_end,
-        # End pagination.
         'hidden_schema_list': hidden_schema_list,
         'filters': filterchain,
         'show_upcoming': show_upcoming,
@@ -1268,15 +1351,33 @@ def place_detail_overview(request, *args, **kwargs):
 
     # Distinguish between past news and upcoming events.
     # With some preliminary date limiting too.
+    news_start, news_end = today() - datetime.timedelta(days=90), today()
     filterchain_news = filterchain.copy()
-    filterchain_news.add('date',
-                         today() - datetime.timedelta(days=90),
-                         today())
+    filterchain_news.add('date', news_start, news_end)
 
+    events_start, events_end = today(), today() + datetime.timedelta(days=60)
     filterchain_events = filterchain.copy()
-    filterchain_events.add('date',
-                           today(),
-                           today() + datetime.timedelta(days=60))
+    filterchain_events.add('date', events_start, events_end)
+
+    # For a Location, skip querying schemas that the (up-to-date)
+    # aggregates say have nothing in their date range.
+    empty_schema_ids = set()
+    location = get_aggregate_location(filterchain)
+    if location is not None:
+        current = get_current_aggregate_schema_ids(schema_list.keys(), location,
+                                                   news_start, events_end)
+        if current:
+            aggs = AggregateLocationDay.objects.filter(
+                schema__id__in=current, location__id=location.id, total__gt=0,
+                date_part__range=(news_start, events_end))
+            nonempty = set()
+            for schema_id, date_part in aggs.values_list('schema_id', 'date_part'):
+                if schema_id in eventish_schema_list:
+                    if events_start <= date_part <= events_end:
+                        nonempty.add(schema_id)
+                elif news_start <= date_part <= news_end:
+                    nonempty.add(schema_id)
+            empty_schema_ids = current - nonempty
 
     # Ordering by ID ensures consistency across page views.
     newsitem_qs = filterchain_news.apply().order_by('-item_date', '-id')
@@ -1295,13 +1396,14 @@ def place_detail_overview(request, *args, **kwargs):
     # Now retrieve newsitems per schema.
     schema_groups, all_newsitems = [], []
     for schema in schema_list.values():
-        if schema.id in newsish_schema_list:
-            newsitems = newsitem_qs.filter(schema__id=schema.id)
+        if schema.id in empty_schema_ids:
+            newsitems = []
+        elif schema.id in newsish_schema_list:
+            newsitems = list(newsitem_qs.filter(schema__id=schema.id)[:schema.number_in_overview])
         elif schema.id in eventish_schema_list:
-            newsitems = events_qs.filter(schema__id=schema.id)
+            newsitems = list(events_qs.filter(schema__id=schema.id)[:schema.number_in_overview])
         else:
             raise RuntimeError("should never get here")
-        newsitems = list(newsitems[:s.number_in_overview])
         populate_schema(newsitems, schema)
         schema_groups.append({
             'schema': schema,
@@ -93,7 +93,6 @@ class Address(dict):
         """
         Builds an Address object from a GeocoderCache result object.
         """
-        #  This should probably use the normal Django cache, see ticket #163
         fields = {
             'address': cached.address,
             'city': cached.city,
@@ -127,7 +126,14 @@ class Geocoder(object):
         _do_geocode(self, location_string)
             Actually performs the geocoding. The base class implementation of
             geocode() calls this behind the scenes.
+
+    Subclasses may also override _address_string() so that
+    geocode_many() can look up candidate blocks in bulk.
     """
+
+    # A BlockPrefetch, only set during geocode_many().
+    _prefetched = None
+
     def __init__(self, use_cache=True):
         self.use_cache = use_cache
 
@@ -136,52 +142,146 @@ class Geocoder(object):
         Geocodes the given location, handling caching behind the scenes.
         """
         location = normalize(location)
-        result, cache_hit = None, False
 
         # Get the result (an Address instance), either from the cache or by
         # calling _do_geocode().
-        # TODO: Why does this not use the normal Django caching
-        # framework?
         # Defer import to avoid cyclical imports.
-        from ebpub.geocoder.models import GeocoderCache
+        from ebpub.geocoder import caching
         if self.use_cache:
-            try:
-                cached = GeocoderCache.objects.filter(normalized_location=location)[0]
-            except IndexError:
-                pass
-            else:
-                logger.debug('GeocoderCache HIT for %r' % location)
-                result = Address.from_cache(cached)
-                cache_hit = True
+            cached = caching.lookup(location)
+            if isinstance(cached, caching.NegativeResult):
+                cached.reraise()
+            elif cached is not None:
+                logger.debug('geocoded: %r to %s' % (location, cached))
+                return cached
+        return self._geocode_uncached(location)
+
+    def geocode_many(self, locations):
+        """
+        Geocodes a list of location strings.
+
+        Returns a list of the same length and order, where each item
+        is either an Address, or the GeocodingException or
+        ParsingError that geocode() would have raised for that
+        location.  Other exceptions are raised as usual.
 
-        if result is None:
+        Duplicate locations (after normalization) are only geocoded
+        once, and share a result.  Candidate blocks for all the
+        addresses are fetched up front with a few bulk queries.
+        """
+        from ebpub.geocoder import caching
+        normalized = [normalize(location) for location in locations]
+        results = {}
+        to_geocode = []
+        for location in normalized:
+            if location in results:
+                continue
+            results[location] = None
+            if self.use_cache:
+                cached = caching.lookup(location)
+                if isinstance(cached, caching.NegativeResult):
+                    results[location] = cached.exception()
+                    continue
+                elif cached is not None:
+                    results[location] = cached
+                    continue
+            to_geocode.append(location)
+
+        if to_geocode:
+            self._prefetched = self.prefetch(to_geocode)
+            try:
+                for location in to_geocode:
+                    try:
+                        results[location] = self._geocode_uncached(location)
+                    except (GeocodingException, ParsingError), e:
+                        results[location] = e
+            finally:
+                self._prefetched = None
+        return [results[location] for location in normalized]
+
+    def prefetch(self, locations):
+        """
+        Returns a BlockPrefetch for the addresses among the given
+        normalized location strings, or None if there are none.
+        """
+        parsed = []
+        for location in locations:
+            address_string = self._address_string(location)
+            if address_string is None:
+                continue
             try:
-                result = self._do_geocode(location)
-            except AmbiguousResult, e:
-                # If multiple results were found, check whether they have the
-                # same point. If they all have the same point, don't raise the
-                # AmbiguousResult exception -- just return the first one.
-                # 
-                # An edge case is if result['point'] is None. This could happen
-                # if the geocoder found locations, not points. In that case,
-                # just raise the AmbiguousResult.
-                result = e.choices[0]
-                if result['point'] is None:
+                parsed.extend(parse(address_string))
+            except ParsingError:
+                # _do_geocode() will raise it again.
+                continue
+        if not parsed:
+            return None
+        return BlockPrefetch(parsed)
+
+    def _address_string(self, location_string):
+        """
+        Returns the string that _do_geocode() would parse as an
+        address, or None if it wouldn't.
+        """
+        return None
+
+    def _geocode_uncached(self, location):
+        from ebpub.geocoder import caching
+        try:
+            result = self._do_geocode(location)
+        except (DoesNotExist, ParsingError), e:
+            if self.use_cache:
+                caching.store_negative(location, e)
+            raise
+        except AmbiguousResult, e:
+            # If multiple results were found, check whether they have the
+            # same point. If they all have the same point, don't raise the
+            # AmbiguousResult exception -- just return the first one.
+            # 
+            # An edge case is if result['point'] is None. This could happen
+            # if the geocoder found locations, not points. In that case,
+            # just raise the AmbiguousResult.
+            result = e.choices[0]
+            if result['point'] is None:
+                raise
+            for i in e.choices[1:]:
+                if i['point'] != result['point']:
                     raise
-                for i in e.choices[1:]:
-                    if i['point'] != result['point']:
-                        raise
-                logger.debug('Got ambiguous results but all had same point, '
-                             'returning the first')
-        # Save the result to the cache if it wasn't in there already.
-        if not cache_hit and self.use_cache:
+            logger.debug('Got ambiguous results but all had same point, '
+                         'returning the first')
+        # Save the result to the cache.
+        if self.use_cache:
             logger.debug('caching result for %r' % location)
-            GeocoderCache.populate(location, result)
+            caching.store(location, result)
 
         logger.debug('geocoded: %r to %s' % (location, result))
         return result
 
 
+class BlockPrefetch(object):
+    """
+    Street misspellings and Blocks for a batch of parsed addresses,
+    fetched in bulk so AddressGeocoder can match each address in
+    memory instead of querying for every candidate.
+    """
+
+    def __init__(self, parsed_locations):
+        # Defer import to avoid cyclical import.
+        from ebpub.streets.models import Block, StreetMisspelling
+        streets = set([loc['street'] for loc in parsed_locations if loc['street']])
+        self.misspellings = {}
+        if streets:
+            self.misspellings = dict(
+                StreetMisspelling.objects.filter(incorrect__in=streets).values_list(
+                    'incorrect', 'correct'))
+        streets.update(self.misspellings.values())
+        self.blocks = Block.objects.blocks_by_street(
+            [street.upper() for street in streets])
+
+    def blocks_on_street(self, street):
+        return self.blocks.get(street.upper(), [])
+
+
 class AddressGeocoder(Geocoder):
     """
     Treats the location_string as an address and looks for a matching Block.
@@ -208,16 +308,20 @@ class AddressGeocoder(Geocoder):
             if not loc_results and loc['street']:
                 logger.debug('AddressGeocoder: checking for alternate spellings of %r'
                              % loc['street'])
-                try:
-                    misspelling = StreetMisspelling.objects.get(incorrect=loc['street'])
+                if self._prefetched is not None:
+                    correct = self._prefetched.misspellings.get(loc['street'])
+                else:
+                    try:
+                        correct = StreetMisspelling.objects.get(incorrect=loc['street']).correct
+                    except StreetMisspelling.DoesNotExist:
+                        correct = None
+                if correct is None:
+                    logger.debug(' ... no StreetMisspellings found.')
+                else:
                     # TODO: stash away the original 'street' value for
                     # possible disambiguation later? ticket #295
-                    loc['street'] = misspelling.correct
+                    loc['street'] = correct
                     logger.debug(' ... corrected to %r' % loc['street'])
-                except StreetMisspelling.DoesNotExist:
-                    logger.debug(' ... no StreetMisspellings found.')
-                    pass
-                else:
                     loc_results = self._db_lookup(loc)
                 # Next, try removing the street suffix, in case an incorrect
                 # one was given.
@@ -228,14 +332,7 @@ class AddressGeocoder(Geocoder):
                 # Next, try looking for the street, in case the street
                 # (without any suffix) exists but the address doesn't.
                 if not loc_results and loc['number']:
-                    kwargs = {'street': loc['street']}
-                    sided_filters = []
-                    if loc['city']:
-                        city_filter = Q(left_city=loc['city']) | Q(right_city=loc['city'])
-                        sided_filters.append(city_filter)
-                    # Defer this to avoid import cycle.
-                    from ebpub.streets.models import Block
-                    b_list = Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
+                    b_list = self._blocks_on_street(loc['street'], loc['city'])
                     if b_list:
                         # We got some blocks with the bare street name.
                         # Might be InvalidBlockButValidStreet, but we don't
@@ -262,14 +359,42 @@ class AddressGeocoder(Geocoder):
             raise AmbiguousResult(all_results)
 
 
+    def _address_string(self, location_string):
+        return location_string
+
+    def _blocks_on_street(self, street, city):
+        """
+        All blocks with the given street name (and city, if any),
+        ordered by predir and number.
+        """
+        if self._prefetched is not None:
+            b_list = [b for b in self._prefetched.blocks_on_street(street)
+                      if b.street == street and
+                      (not city or city in (b.left_city, b.right_city))]
+            b_list.sort(key=lambda b: (b.predir, b.from_num, b.to_num))
+            return b_list
+        kwargs = {'street': street}
+        sided_filters = []
+        if city:
+            city_filter = Q(left_city=city) | Q(right_city=city)
+            sided_filters.append(city_filter)
+        # Defer this to avoid import cycle.
+        from ebpub.streets.models import Block
+        return Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
+
     def _db_lookup(self, location):
         """
         Given a location dict as returned by parse(), looks up the address in
         the DB. Always returns a list of Address dictionaries (or an empty list
         if no results are found).
+
+        During geocode_many(), the prefetched blocks are searched instead.
         """
         if not location['number']:
             return []
+        candidates = None
+        if self._prefetched is not None:
+            candidates = self._prefetched.blocks_on_street(location['street'])
 
         # Query the blocks database.
         try:
@@ -285,6 +410,7 @@ class AddressGeocoder(Geocoder):
                 city=location['city'],
                 state=location['state'],
                 zipcode=location['zip'],
+                candidates=candidates,
             )
         except:
             # TODO: replace with Block-specific exception?
@@ -318,6 +444,12 @@ class BlockGeocoder(AddressGeocoder):
         new_location_string = ' '.join(m.groups())
         return AddressGeocoder._do_geocode(self, new_location_string)
 
+    def _address_string(self, location_string):
+        m = block_re.search(location_string)
+        if m:
+            return ' '.join(m.groups())
+        return None
+
 
 class IntersectionGeocoder(Geocoder):
     """
@@ -417,8 +549,16 @@ class SmartGeocoder(Geocoder):
         else:
             logger.debug('%r assumed to be an address' % location_string)
             geocoder = AddressGeocoder()
+        geocoder._prefetched = self._prefetched
         return geocoder._do_geocode(location_string)
 
+    def _address_string(self, location_string):
+        if intersection_re.search(location_string):
+            return None
+        elif block_re.search(location_string):
+            return BlockGeocoder()._address_string(location_string)
+        return location_string
+
 
 def full_geocode(query, search_places=True, convert_to_block=True, guess=False,
                  **disambiguation_kwargs):
@@ -0,0 +1,307 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Layered caching of geocoder results.
+
+Lookups try, in order:
+
+1. A bounded in-process LRU cache, keyed by normalized location.
+2. Django's cache backend (``CACHES['default']``), shared between processes.
+3. The persistent :py:class:`ebpub.geocoder.models.GeocoderCache` table.
+
+Failed lookups (``DoesNotExist`` and ``ParsingError``) are cached too,
+with a shorter timeout, but only in the first two tiers.
+
+Tunable via these optional settings:
+
+* ``EBPUB_GEOCODER_LRU_SIZE``: max entries in the in-process cache
+  (0 disables it).
+* ``EBPUB_GEOCODER_CACHE_TTL``: seconds to keep successful results in
+  the in-process and Django caches.
+* ``EBPUB_GEOCODER_NEGATIVE_CACHE_TTL``: seconds to remember failed
+  lookups (0 disables negative caching).
+
+Hit and miss counts are available from :py:func:`get_cache_stats`.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger('ebpub.geocoder.caching')
+
+DEFAULT_LRU_SIZE = 1000
+DEFAULT_CACHE_TTL = 60 * 60 * 24
+DEFAULT_NEGATIVE_CACHE_TTL = 60 * 10
+
+CACHE_KEY_PREFIX = 'ebpub.geocoder:'
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded least-recently-used cache with
+    per-entry expiration.
+
+    Implemented as a dict plus a circular doubly-linked list, since
+    collections.OrderedDict isn't available on python 2.6.
+    """
+
+    # Indexes into the linked-list nodes.
+    PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+    def __init__(self, max_size=DEFAULT_LRU_SIZE, timer=time.time):
+        self.max_size = max_size
+        self._timer = timer
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._map = {}
+        root = self._root = []
+        root[:] = [root, root, None, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, node):
+        prev, next = node[self.PREV], node[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def _append(self, node):
+        # Most recently used goes just before the root.
+        root = self._root
+        last = root[self.PREV]
+        node[self.PREV], node[self.NEXT] = last, root
+        last[self.NEXT] = root[self.PREV] = node
+
+    def get(self, key, default=None):
+        with self._lock:
+            node = self._map.get(key)
+            if node is None:
+                return default
+            if node[self.EXPIRES] is not None and node[self.EXPIRES] <= self._timer():
+                self._unlink(node)
+                del self._map[key]
+                return default
+            self._unlink(node)
+            self._append(node)
+            return node[self.VALUE]
+
+    def set(self, key, value, timeout=None):
+        if self.max_size <= 0:
+            return
+        expires = None
+        if timeout is not None:
+            expires = self._timer() + timeout
+        with self._lock:
+            node = self._map.get(key)
+            if node is not None:
+                self._unlink(node)
+                node[self.VALUE], node[self.EXPIRES] = value, expires
+            else:
+                node = [None, None, key, value, expires]
+                self._map[key] = node
+            self._append(node)
+            while len(self._map) > self.max_size:
+                oldest = self._root[self.NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[self.KEY]]
+
+    def delete(self, key):
+        with self._lock:
+            node = self._map.pop(key, None)
+            if node is not None:
+                self._unlink(node)
+
+
+class CacheStats(object):
+    """
+    Thread-safe hit/miss counters, for monitoring.
+    """
+
+    FIELDS = ('lru_hits', 'shared_hits', 'db_hits', 'negative_hits', 'misses')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict((field, 0) for field in self.FIELDS)
+
+    def incr(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def as_dict(self):
+        with self._lock:
+            counts = self._counts.copy()
+        counts['hits'] = sum(counts[f] for f in self.FIELDS if f != 'misses')
+        total = counts['hits'] + counts['misses']
+        counts['hit_rate'] = float(counts['hits']) / total if total else 0.0
+        return counts
+
+
+_lru = LRUCache(getattr(settings, 'EBPUB_GEOCODER_LRU_SIZE', DEFAULT_LRU_SIZE))
+_stats = CacheStats()
+
+
+def get_cache_stats():
+    """
+    Returns a dict of hit/miss counts since startup (or the last
+    :py:func:`reset_cache_stats`), plus overall ``hits`` and ``hit_rate``.
+    """
+    return _stats.as_dict()
+
+
+def reset_cache_stats():
+    _stats.reset()
+
+
+def clear_local_cache():
+    """
+    Empties the in-process cache (but not Django's cache or the DB table).
+    """
+    _lru.clear()
+
+
+def _cache_ttl():
+    return getattr(settings, 'EBPUB_GEOCODER_CACHE_TTL', DEFAULT_CACHE_TTL)
+
+
+def _negative_cache_ttl():
+    return getattr(settings, 'EBPUB_GEOCODER_NEGATIVE_CACHE_TTL',
+                   DEFAULT_NEGATIVE_CACHE_TTL)
+
+
+def _shared_key(location):
+    # Hashed because memcached doesn't allow spaces or long keys.
+    if isinstance(location, unicode):
+        location = location.encode('utf8')
+    return CACHE_KEY_PREFIX + hashlib.md5(location).hexdigest()
+
+
+class NegativeResult(object):
+    """
+    Stands in for a failed lookup in the caches; remembers
+    which exception to re-raise.
+    """
+
+    def __init__(self, exception):
+        self.exc_class = exception.__class__
+        self.args = exception.args
+
+    def exception(self):
+        return self.exc_class(*self.args)
+
+    def reraise(self):
+        raise self.exception()
+
+
+def lookup(location):
+    """
+    Looks up a normalized location in the cache tiers.
+
+    Returns an Address, or a NegativeResult, or None on a miss.
+    A hit in a slower tier is copied into the faster ones.
+    """
+    result = _lru.get(location)
+    if result is not None:
+        _stats.incr(isinstance(result, NegativeResult) and 'negative_hits' or 'lru_hits')
+        logger.debug('in-process geocoder cache HIT for %r' % location)
+        return _copy(result)
+
+    result = cache.get(_shared_key(location))
+    if result is not None:
+        _stats.incr(isinstance(result, NegativeResult) and 'negative_hits' or 'shared_hits')
+        logger.debug('shared geocoder cache HIT for %r' % location)
+        ttl = isinstance(result, NegativeResult) and _negative_cache_ttl() or _cache_ttl()
+        _lru.set(location, result, ttl)
+        return _copy(result)
+
+    # Defer import to avoid cyclical imports.
+    from ebpub.geocoder.base import Address
+    from ebpub.geocoder.models import GeocoderCache
+    cached = GeocoderCache.objects.filter(normalized_location=location)
+    cached = cached.select_related('block', 'intersection')[:1]
+    if cached:
+        _stats.incr('db_hits')
+        logger.debug('GeocoderCache HIT for %r' % location)
+        result = Address.from_cache(cached[0])
+        _set_fast_tiers(location, result, _cache_ttl())
+        return _copy(result)
+
+    _stats.incr('misses')
+    return None
+
+
+def _copy(result, cache_hit=True):
+    # Callers may modify the Address they get back; don't let that
+    # leak into the in-process cache.  The point is copied too, since
+    # it's mutable; other values (eg. 'block') are shared, and must
+    # not be modified.
+    if isinstance(result, NegativeResult):
+        return result
+    copied = result.__class__(result)
+    if copied.get('point') is not None:
+        copied['point'] = copied['point'].clone()
+    copied._cache_hit = cache_hit
+    return copied
+
+
+def _set_fast_tiers(location, result, ttl):
+    if not ttl:
+        return
+    _lru.set(location, result, ttl)
+    try:
+        cache.set(_shared_key(location), result, ttl)
+    except Exception:
+        # Eg. an unpicklable result; the other tiers still work.
+        logger.exception('Could not store %r in the shared geocoder cache'
+                         % location)
+
+
+def store(location, result):
+    """
+    Stores a successful geocoder result (an Address) in all tiers.
+    The caller keeps ``result``; a copy goes in the in-process cache.
+    """
+    # Defer import to avoid cyclical imports.
+    from ebpub.geocoder.models import GeocoderCache
+    _set_fast_tiers(location, _copy(result, cache_hit=False), _cache_ttl())
+    GeocoderCache.populate(location, result)
+
+
+def store_negative(location, exception):
+    """
+    Remembers that geocoding this location raised ``exception``.
+    """
+    _set_fast_tiers(location, NegativeResult(exception), _negative_cache_ttl())
+
+
+def delete(location):
+    """
+    Removes a location from the in-process and shared caches.
+    """
+    _lru.delete(location)
+    cache.delete(_shared_key(location))
@@ -58,6 +58,17 @@ class GeocoderCache(models.Model):
         obj.save()
 
 
+def clear_geocoder_cache(sender, instance, **kwargs):
+    """
+    Keep the faster cache tiers from serving a deleted GeocoderCache row.
+    """
+    from ebpub.geocoder import caching
+    caching.delete(instance.normalized_location)
+
+from django.db.models.signals import post_delete
+post_delete.connect(clear_geocoder_cache, sender=GeocoderCache)
+
+
 from django.contrib.gis import admin
 
 class GeocoderCacheAdmin(admin.ModelAdmin):
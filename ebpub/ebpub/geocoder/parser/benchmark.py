@@ -0,0 +1,82 @@
+#   Copyright 2012 OpenPlans and contributors
+#
+#   This file is part of ebpub
+#
+#   ebpub is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   ebpub is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compares the speed of :py:func:`parse <ebpub.geocoder.parser.parsing.parse>`
+with the old exhaustive algorithm, ``parse_exhaustive``, using the
+sample addresses from the parser tests.
+
+Usage::
+
+  python -m ebpub.geocoder.parser.benchmark [--sample N]
+
+``--sample N`` uses only every Nth sample address, since the
+exhaustive parser is slow.
+"""
+
+from ebpub.geocoder.parser.parsing import parse, parse_exhaustive, ParsingError
+from ebpub.geocoder.parser.tests import sample_locations
+import time
+
+
+def time_parser(parser, locations):
+    """
+    Parses all the ``locations`` and returns (seconds, results), where
+    results is a list of the parse results (or None for ParsingErrors).
+    """
+    results = []
+    start = time.time()
+    for location in locations:
+        try:
+            results.append(parser(location))
+        except ParsingError:
+            results.append(None)
+    return time.time() - start, results
+
+
+def main(argv=None):
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    from optparse import OptionParser
+    optparser = OptionParser(usage='usage: %prog [options]')
+    optparser.add_option('-s', '--sample', action='store', type='int', default=1,
+                         help='Only use every Nth sample address. Default %default.')
+    opts, args = optparser.parse_args(argv)
+
+    locations = [loc for (types, loc, expected) in sample_locations()][::opts.sample]
+    # Warm up, so building the combinations isn't counted.
+    parse(locations[0])
+
+    exhaustive_time, exhaustive_results = time_parser(parse_exhaustive, locations)
+    compiled_time, compiled_results = time_parser(parse, locations)
+
+    print "Parsed %d addresses" % len(locations)
+    print "parse_exhaustive(): %.3f seconds (%.2f ms each)" % (
+        exhaustive_time, 1000 * exhaustive_time / len(locations))
+    print "parse():            %.3f seconds (%.2f ms each)" % (
+        compiled_time, 1000 * compiled_time / len(locations))
+    print "Speedup: %.1fx" % (exhaustive_time / (compiled_time or 1e-9))
+    if compiled_results != exhaustive_results:
+        print "ERROR: results differ!"
+        return 1
+    print "Results are identical."
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -327,55 +327,124 @@ token_split = re.compile(r"\S+").findall
 # Special case for detecting eg. 'I40', 'I-40'
 interstate_street_re = re.compile(r"^I(-?\s*)(\d{1,3}[A-Z]?)$")
 
+# One bit per token type, for quickly checking which types a token may be.
+TOKEN_TYPE_BITS = dict([(token_type, 1 << i) for i, token_type
+                        in enumerate(Location.location_keys)])
+
+_combinations_by_length = None
+
+def combinations_by_length():
+    """
+    Returns a dictionary mapping number of tokens to a list of
+    (token_types, bits) pairs, where token_types is one of the
+    combinations from :py:func:`address_combinations` (as a tuple) and
+    bits is a tuple of the corresponding ``TOKEN_TYPE_BITS``.
+
+    Within each list, combinations are in the same order as
+    ``address_combinations()``.  Built once, on first use.
+    """
+    global _combinations_by_length
+    if _combinations_by_length is None:
+        result = {}
+        for token_types in address_combinations():
+            bits = tuple([TOKEN_TYPE_BITS[t] for t in token_types])
+            result.setdefault(len(token_types), []).append((tuple(token_types), bits))
+        _combinations_by_length = result
+    return _combinations_by_length
+
+def token_type_mask(token):
+    """
+    Returns a bitmask of the ``TOKEN_TYPE_BITS`` for every type whose
+    regex matches ``token``.
+    """
+    mask = 0
+    for token_type, regex in TOKEN_REGEXES.items():
+        if regex.match(token):
+            mask |= TOKEN_TYPE_BITS[token_type]
+    return mask
+
+def matching_combinations(tokens):
+    """
+    Generator that yields every combination of token types (in
+    ``address_combinations()`` order) that is valid for the given
+    list of tokens.
+
+    Each token is matched against each token type's regex only once;
+    then only combinations of the right length are checked, with
+    bitwise ANDs.
+    """
+    masks = [token_type_mask(token) for token in tokens]
+    for token_types, bits in combinations_by_length().get(len(tokens), ()):
+        for bit, mask in izip(bits, masks):
+            if not bit & mask:
+                break
+        else:
+            yield token_types
+
+def _exhaustive_combinations(tokens):
+    # The original, slower way to find matching combinations: try
+    # every combination, matching each token against its regex.
+    # Kept for testing and benchmarking matching_combinations().
+    len_tokens = len(tokens)
+    for token_types in address_combinations():
+        if len(token_types) == len_tokens:
+            for token, token_type in izip(tokens, token_types):
+                if not TOKEN_REGEXES[token_type].match(token):
+                    break # Token regex didn't match.
+            else:
+                yield tuple(token_types)
+
 def parse(location):
     """
     Given a ``location`` string, return a list of possible valid
     results as ``Location`` instances.
 
     """
+    return _parse(location, matching_combinations)
+
+def parse_exhaustive(location):
+    """
+    Same as :py:func:`parse`, but tries every one of
+    ``address_combinations()``.  Slow; only useful for testing and
+    benchmarking.
+    """
+    return _parse(location, _exhaustive_combinations)
+
+def _parse(location, find_combinations):
     s = strip_unit(normalize(location))
     logger.debug('parse: normalized and stripped %r to %r' % (location, s))
     tokens = token_split(s)
-    len_tokens = len(tokens)
     result_list = []
 
-    for token_types in address_combinations():
-        if len(token_types) == len_tokens:
-            try:
-                for token, token_type in izip(tokens, token_types):
-                    if not TOKEN_REGEXES[token_type].match(token):
-                        raise StopIteration() # Token regex didn't match.
-            except StopIteration:
-                continue
-
-            # If we made it this far, then all of the tokens are valid.
-            # Create the Location object.
-            result = Location()
-            for token, token_type in izip(tokens, token_types):
-                if result[token_type]:
-                    result[token_type] += ' ' + token
-                else:
-                    result[token_type] = token
-
-            if result['street'] and not result['prefix']:
-                # Special case: "I40" -> "Interstate 40"
-                fixed = interstate_street_re.sub(r'\2', result['street'])
-                if fixed != result['street']:
-                    result['street'] = fixed
-                    result['prefix'] = 'INTERSTATE'
-
-            # Standardize all values.
-            for key, value in result.items():
-                if value and key in STANDARDIZERS:
-                    if key == 'street':
-                        if result['prefix']:
-                            # Special case: "US Highway 101", not "US Highway 101st".
-                            continue
-                    result[key] = STANDARDIZERS[key](value)
-                    logger.debug('parse: standardized %r to %r' % (value, result[key]))
-
-            logger.debug('parse: %r gave possible result address %s' % (s, result))
-            result_list.append(result)
+    for token_types in find_combinations(tokens):
+        # If we made it this far, then all of the tokens are valid.
+        # Create the Location object.
+        result = Location()
+        for token, token_type in izip(tokens, token_types):
+            if result[token_type]:
+                result[token_type] += ' ' + token
+            else:
+                result[token_type] = token
+
+        if result['street'] and not result['prefix']:
+            # Special case: "I40" -> "Interstate 40"
+            fixed = interstate_street_re.sub(r'\2', result['street'])
+            if fixed != result['street']:
+                result['street'] = fixed
+                result['prefix'] = 'INTERSTATE'
+
+        # Standardize all values.
+        for key, value in result.items():
+            if value and key in STANDARDIZERS:
+                if key == 'street':
+                    if result['prefix']:
+                        # Special case: "US Highway 101", not "US Highway 101st".
+                        continue
+                result[key] = STANDARDIZERS[key](value)
+                logger.debug('parse: standardized %r to %r' % (value, result[key]))
+
+        logger.debug('parse: %r gave possible result address %s' % (s, result))
+        result_list.append(result)
 
     if not result_list:
         raise ParsingError("Failed to parse location %r" % location)
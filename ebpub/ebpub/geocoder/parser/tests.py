@@ -24,40 +24,51 @@ that auto-generates tests based on some sample data.
 """
 
 from ebpub.geocoder.parser.parsing import parse, address_combinations, ParsingError, Location
+from ebpub.geocoder.parser.parsing import parse_exhaustive, combinations_by_length
+from ebpub.geocoder.parser.parsing import matching_combinations, _exhaustive_combinations
+from ebpub.geocoder.parser.parsing import normalize, strip_unit, token_split
 import unittest
 
+TEST_DATA = (
+    # token type, (one-word sample, two-word sample, three-word sample, ...)
+    ('number', ('228',)),
+    ('pre_dir', ('S',)),
+    ('prefix', ('HIGHWAY', 'US HIGHWAY', 'FARM TO MARKET')),
+    ('street', ('BROADWAY', 'OLD MILL', 'MARTIN LUTHER KING', 'MARTIN LUTHER KING JR', 'DR MARTIN LUTHER KING JR')),
+    ('suffix', ('AVE',)),
+    ('post_dir', ('S',)),
+    ('city', ('CHICAGO', 'SAN FRANCISCO', 'NEW YORK CITY', 'OLD NEW YORK CITY')),
+    ('state', ('IL', 'NEW HAMPSHIRE')),
+    ('zip', ('60604',)),
+)
+
+def sample_locations():
+    """
+    Generator that yields a (token_types, location, expected) tuple
+    for every combination of test data (defined in TEST_DATA).
+    """
+    for token_types in address_combinations():
+        test_input = []
+        expected = Location()
+        for t_type, samples in TEST_DATA:
+            count = token_types.count(t_type)
+            if count:
+                test_input.append(samples[count-1])
+                expected[t_type] = samples[count-1]
+
+        # Take the normalization into account.
+        if expected['state'] == 'NEW HAMPSHIRE':
+            expected['state'] = 'NH'
+
+        yield token_types, ' '.join(test_input), expected
+
 class AutoLocationMetaclass(type):
     """
     Metaclass that adds a test method for every combination of test data
     (defined in TEST_DATA).
     """
     def __new__(cls, name, bases, attrs):
-        TEST_DATA = (
-            # token type, (one-word sample, two-word sample, three-word sample, ...)
-            ('number', ('228',)),
-            ('pre_dir', ('S',)),
-            ('prefix', ('HIGHWAY', 'US HIGHWAY', 'FARM TO MARKET')),
-            ('street', ('BROADWAY', 'OLD MILL', 'MARTIN LUTHER KING', 'MARTIN LUTHER KING JR', 'DR MARTIN LUTHER KING JR')),
-            ('suffix', ('AVE',)),
-            ('post_dir', ('S',)),
-            ('city', ('CHICAGO', 'SAN FRANCISCO', 'NEW YORK CITY', 'OLD NEW YORK CITY')),
-            ('state', ('IL', 'NEW HAMPSHIRE')),
-            ('zip', ('60604',)),
-        )
-        for token_types in address_combinations():
-            test_input = []
-            expected = Location()
-            for t_type, samples in TEST_DATA:
-                count = token_types.count(t_type)
-                if count:
-                    test_input.append(samples[count-1])
-                    expected[t_type] = samples[count-1]
-
-            # Take the normalization into account.
-            if expected['state'] == 'NEW HAMPSHIRE':
-                expected['state'] = 'NH'
-
-            location = ' '.join(test_input)
+        for token_types, location, expected in sample_locations():
             func = lambda self: self.assertParseContains(location, expected)
             func.__doc__ = "generated test: %r" % location
             attrs['test_%s' % '_'.join(token_types)] = func
@@ -338,5 +349,34 @@ class LocationTestCase(unittest.TestCase):
     #     )
 
 
+class MatchingCombinationsTestCase(unittest.TestCase):
+
+    def test_combinations_by_length_order(self):
+        by_length = combinations_by_length()
+        self.assertEqual(sum([len(v) for v in by_length.values()]),
+                         len(list(address_combinations())))
+        for length, combinations in by_length.items():
+            expected = [tuple(c) for c in address_combinations() if len(c) == length]
+            self.assertEqual([c for (c, bits) in combinations], expected)
+
+    def test_same_as_exhaustive(self):
+        # Every 10th sample is plenty, and keeps the test reasonably fast.
+        locations = [loc for (types, loc, expected) in sample_locations()][::10]
+        locations += ['1 Nob Hill', '17 I95 S', '123 NY STATE HIGHWAY 9G',
+                      '2833A-2835A W CHICAGO AVE', 'nothing to see here !!!', '']
+        for location in locations:
+            tokens = token_split(strip_unit(normalize(location)))
+            self.assertEqual(list(matching_combinations(tokens)),
+                             list(_exhaustive_combinations(tokens)),
+                             'Different combinations for %r' % location)
+
+    def test_parse_same_as_exhaustive(self):
+        for location in ('11466 S Saint Louis Ave, Chicago, IL, 60655',
+                         '17 US Hwy 101 Bypass', '123 Main St Bronx'):
+            self.assertEqual(parse(location), parse_exhaustive(location))
+        self.assertRaises(ParsingError, parse, '')
+        self.assertRaises(ParsingError, parse_exhaustive, '')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -16,15 +16,49 @@
 #   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import unittest
-from psycopg2 import Binary
+"""
+Finding the nearest Block to a point.
+
+These work on PostGIS 1.4+, which has no index-assisted
+nearest-neighbor operator, so we search within a small window using
+the spatial index and widen it until something is found.
+"""
+
 from django.contrib.gis.geos import Point
 from django.db import connection
 
+# In degrees for now because transforming to a projected space is
+# too slow for this purpose. TODO: store projected versions of the
+# locations alongside the canonical lng/lat versions.
+MIN_DISTANCE = 0.007
+# Give up if nothing is within this distance, in degrees (very roughly 10 km).
+MAX_DISTANCE = 0.1
+
+# Max number of points per query in reverse_geocode_many().
+BATCH_SIZE = 500
+
 class ReverseGeocodeError(Exception):
     pass
 
-def reverse_geocode(point):
+def _to_point(point):
+    if isinstance(point, basestring):
+        from django.contrib.gis.geos import fromstr
+        point = fromstr(point, srid=4326)
+    elif isinstance(point, tuple) or isinstance(point, list):
+        point = Point(tuple(point))
+    return point
+
+def _search_distances(max_distance):
+    """
+    Widening search windows, MIN_DISTANCE quadrupling up to max_distance.
+    """
+    distance = min(MIN_DISTANCE, max_distance)
+    while distance < max_distance:
+        yield distance
+        distance *= 4
+    yield max_distance
+
+def reverse_geocode(point, max_distance=MAX_DISTANCE):
     """
     Looks up the nearest block to the point.
 
@@ -32,53 +66,71 @@ def reverse_geocode(point):
     WKT string.
 
     Returns (block, distance (in degrees I think??))
+
+    Raises ReverseGeocodeError if there is no block within
+    ``max_distance`` degrees.
+    """
+    result = reverse_geocode_many([point], max_distance)[0]
+    if isinstance(result, ReverseGeocodeError):
+        raise result
+    return result
+
+def reverse_geocode_many(points, max_distance=MAX_DISTANCE):
+    """
+    Looks up the nearest block to each of a list of points, with one
+    query per BATCH_SIZE points (plus one more for each time the
+    search window has to be widened for points that are far from any
+    block).
+
+    Points can be given in any form accepted by reverse_geocode().
+
+    Returns a list of the same length and order, where each item is
+    either a (block, distance) tuple, or a ReverseGeocodeError.
+    """
+    points = [_to_point(point) for point in points]
+    results = [None] * len(points)
+    remaining = range(len(points))
+    for distance in _search_distances(max_distance):
+        for start in range(0, len(remaining), BATCH_SIZE):
+            batch = remaining[start:start + BATCH_SIZE]
+            for i, block_and_distance in _nearest_blocks(points, batch, distance):
+                results[i] = block_and_distance
+        remaining = [i for i in remaining if results[i] is None]
+        if not remaining:
+            break
+    for i in remaining:
+        results[i] = ReverseGeocodeError('No results')
+    return results
+
+def _nearest_blocks(points, indexes, distance):
+    """
+    Yields (index, (block, distance)) for the nearest block within
+    ``distance`` degrees of each of points[index], if there is one.
     """
     # Defer import to avoid cyclical import.
     from ebpub.streets.models import Block
-
-    if isinstance(point, basestring):
-        from django.contrib.gis.geos import fromstr
-        point = fromstr(point, srid=4326)
-    elif isinstance(point, tuple) or isinstance(point, list):
-        point = Point(tuple(point))
-    # In degrees for now because transforming to a projected space is
-    # too slow for this purpose. TODO: store projected versions of the
-    # locations alongside the canonical lng/lat versions.
-    min_distance = 0.007
-    # We use min_distance to cut down on the searchable space, because
-    # the distance query we do next that actually compares distances
-    # between geometries does not use the spatial index. TODO: convert
-    # this to GeoDjango syntax. Should be possible but there are some
-    # subtleties / performance issues with the DB API.
-    cursor = connection.cursor()
-    # Switched to WKT rather than WKB, because constructing WKB as a
-    # string leads to psycopg2 getting confused by '%' as per
-    # http://stackoverflow.com/questions/1734814/why-isnt-psycopg2-executing-any-of-my-sql-functions-indexerror-tuple-index-ou
-    # We could probably do something like
-    # str(Binary(point.wkb)).replace('%', '%%') ... but I don't know
-    # if that could have other problems?
-    # Or maybe a Binary() could be passed as a parameter to cursor.execute().
-    # Anyway, WKT is safe.
-    params = {'field_list': ', '.join([f.column for f in Block._meta.fields]),
-              'pt_wkt': point.wkt,
-              'geom_fieldname': 'geom',
-              'tablename': Block._meta.db_table,
-              'min_distance': min_distance
-              }
+    field_list = ', '.join(['b.%s' % connection.ops.quote_name(f.column)
+                            for f in Block._meta.fields])
+    # The point geometries are passed as WKT parameters. ST_DWithin
+    # uses the spatial index to narrow down the candidates, and
+    # DISTINCT ON picks the closest for each point.
+    values = ', '.join(['(%s, ST_GeomFromText(%s, 4326))'] * len(indexes))
+    params = []
+    for i in indexes:
+        params.extend([i, points[i].wkt])
+    params.append(distance)
     sql = """
-        SELECT %(field_list)s, ST_Distance(ST_GeomFromText('%(pt_wkt)s', 4326), %(geom_fieldname)s) AS "dist"
-        FROM %(tablename)s
-        WHERE id IN
-            (SELECT id
-             FROM %(tablename)s
-             WHERE ST_DWithin(%(geom_fieldname)s, ST_GeomFromText('%(pt_wkt)s', 4326), %(min_distance)s))
-        ORDER BY "dist"
-        LIMIT 1;
-    """ % params
-    cursor.execute(sql)
+        SELECT DISTINCT ON (p.idx) p.idx, %(field_list)s,
+            ST_Distance(p.geom, b.geom) AS "dist"
+        FROM (VALUES %(values)s) AS p (idx, geom)
+        INNER JOIN %(tablename)s b ON ST_DWithin(b.geom, p.geom, %%s)
+        ORDER BY p.idx, "dist", b.id
+    """ % {'field_list': field_list,
+           'values': values,
+           'tablename': connection.ops.quote_name(Block._meta.db_table),
+           }
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
     num_fields = len(Block._meta.fields)
-    rows = cursor.fetchall()
-    if not rows:
-        raise ReverseGeocodeError('No results')
-    block, distance = [(Block(*row[:num_fields]), row[-1]) for row in rows][0]
-    return block, distance
+    for row in cursor.fetchall():
+        yield row[0], (Block(*row[1:num_fields + 1]), row[-1])
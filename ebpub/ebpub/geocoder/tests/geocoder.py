@@ -67,6 +67,48 @@ class TestSmartGeocoder(django.test.TestCase):
         address = self.geocoder.geocode('Wabash and Jackson')
         self.assertEqual(address['city'], 'CHICAGO')
 
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_geocode_many(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        locations = ['200 S Wabash Ave',
+                     '220 S Wabash St',
+                     '220 Wabash',
+                     '100000 S Wabash',
+                     '200 block of Wabash',
+                     'Wabash and Jackson',
+                     '200 s. wabash ave.',
+                     ]
+        results = self.geocoder.geocode_many(locations)
+        self.assertEqual(len(results), len(locations))
+        for location, result in zip(locations, results):
+            try:
+                expected = self.geocoder.geocode(location)
+            except Exception, e:
+                self.assertEqual(type(result), type(e))
+            else:
+                self.assertEqual(result['address'], expected['address'])
+                self.assertEqual(result['point'], expected['point'])
+        self.assert_(isinstance(results[2], AmbiguousResult))
+        self.assert_(isinstance(results[3], InvalidBlockButValidStreet))
+        # Duplicates are only geocoded once.
+        self.assert_(results[0] is results[6])
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_geocode_many__bulk_queries(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        locations = ['200 S Wabash Ave', '220 S Wabash Ave', '298 S Wabash Ave',
+                     '220 S Wabash St', '250 S Wabash']
+        # One query for misspellings, one for blocks.
+        with self.assertNumQueries(2):
+            results = self.geocoder.geocode_many(locations)
+        for result in results:
+            self.assertEqual(result['city'], 'Chicago')
+
+    def test_geocode_many__empty(self):
+        self.assertEqual(self.geocoder.geocode_many([]), [])
+
 
 class TestFullGeocode(django.test.TestCase):
 
@@ -185,6 +227,194 @@ class TestDisambiguation(django.test.TestCase):
                          [{'name': 'bob', 'city': 'C2', 'state': 'S1', 'zip': 'Z1', 'suffix': 'SF1'}])
 
 
+class TestReverseGeocode(django.test.TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    def test_reverse_geocode(self):
+        from ebpub.geocoder.reverse import reverse_geocode
+        block, distance = reverse_geocode((-87.6261, 41.879))
+        self.assertEqual(block.id, 1000)
+        self.assert_(distance < 0.001)
+        # Also accepts WKT.
+        block, distance = reverse_geocode('POINT(-87.6263 41.8866)')
+        self.assertEqual(block.id, 1001)
+
+    def test_reverse_geocode__widens_search(self):
+        from ebpub.geocoder.reverse import reverse_geocode
+        # About 0.03 degrees south of the nearest block.
+        block, distance = reverse_geocode((-87.6261, 41.85))
+        self.assertEqual(block.id, 1000)
+        self.assert_(distance > 0.007)
+
+    def test_reverse_geocode__too_far(self):
+        from ebpub.geocoder.reverse import reverse_geocode, ReverseGeocodeError
+        self.assertRaises(ReverseGeocodeError, reverse_geocode, (-80.0, 40.0))
+        self.assertRaises(ReverseGeocodeError, reverse_geocode, (-87.6261, 41.85),
+                          max_distance=0.01)
+
+    def test_reverse_geocode_many(self):
+        from ebpub.geocoder.reverse import reverse_geocode_many, ReverseGeocodeError
+        points = [(-87.6261, 41.879), (-80.0, 40.0), (-87.6263, 41.8866),
+                  (-87.6261, 41.879)]
+        # One query finds the nearby points; two more widen the
+        # search for the far one, which then gives up.
+        with self.assertNumQueries(3):
+            results = reverse_geocode_many(points)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0][0].id, 1000)
+        self.assert_(isinstance(results[1], ReverseGeocodeError))
+        self.assertEqual(results[2][0].id, 1001)
+        self.assertEqual(results[3][0].id, 1000)
+        self.assertEqual(reverse_geocode_many([]), [])
+
+
+class TestLRUCache(django.test.TestCase):
+
+    def _make_cache(self, max_size=2):
+        from ebpub.geocoder.caching import LRUCache
+        self.now = 1000.0
+        return LRUCache(max_size, timer=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        lru = self._make_cache()
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)  # 'b' is now the oldest.
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_expiration(self):
+        lru = self._make_cache()
+        lru.set('a', 1, timeout=10)
+        self.now += 9
+        self.assertEqual(lru.get('a'), 1)
+        self.now += 1
+        self.assertEqual(lru.get('a', 'gone'), 'gone')
+        self.assertEqual(len(lru), 0)
+
+    def test_delete_and_disabled(self):
+        lru = self._make_cache()
+        lru.set('a', 1)
+        lru.delete('a')
+        lru.delete('nonexistent')
+        self.assertEqual(lru.get('a'), None)
+        lru = self._make_cache(max_size=0)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), None)
+
+
+class TestGeocoderCaching(django.test.TestCase):
+
+    fixtures = ['wabash.yaml']
+
+    def setUp(self):
+        from ebpub.geocoder import caching
+        caching.clear_local_cache()
+        caching.reset_cache_stats()
+
+    def tearDown(self):
+        from ebpub.geocoder import caching
+        caching.clear_local_cache()
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_layers(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        from ebpub.geocoder import caching
+        from ebpub.geocoder.models import GeocoderCache
+        geocoder = SmartGeocoder(use_cache=True)
+        result = geocoder.geocode('200 S Wabash Ave')
+        self.failIf(result._cache_hit)
+        self.assertEqual(GeocoderCache.objects.count(), 1)
+        self.assertEqual(caching.get_cache_stats()['misses'], 1)
+
+        # Second time comes from memory, no queries at all.
+        with self.assertNumQueries(0):
+            cached = geocoder.geocode('200 S Wabash Ave')
+        self.assert_(cached._cache_hit)
+        self.assertEqual(cached['address'], result['address'])
+        self.assertEqual(caching.get_cache_stats()['lru_hits'], 1)
+
+        # Modifying a result doesn't affect the cache.
+        cached['address'] = 'bogus'
+        self.assertEqual(geocoder.geocode('200 S Wabash Ave')['address'],
+                         result['address'])
+
+        # Without the in-process cache (and with the default
+        # DummyCache), it comes from the database in one query.
+        caching.clear_local_cache()
+        with self.assertNumQueries(1):
+            cached = geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(cached['address'], result['address'])
+        self.assertEqual(cached['block'], result['block'])
+        self.assertEqual(caching.get_cache_stats()['db_hits'], 1)
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_modifying_results(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        from ebpub.geocoder import caching
+        geocoder = SmartGeocoder(use_cache=True)
+        # A fresh result isn't the cached object.
+        result = geocoder.geocode('200 S Wabash Ave')
+        address, x = result['address'], result['point'].x
+        result['address'] = 'bogus'
+        result['point'].x = 0.0
+        cached = geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(caching.get_cache_stats()['lru_hits'], 1)
+        self.assertEqual(cached['address'], address)
+        self.assertEqual(cached['point'].x, x)
+
+        # Nor is one loaded from the database.
+        caching.clear_local_cache()
+        cached = geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(caching.get_cache_stats()['db_hits'], 1)
+        cached['address'] = 'bogus'
+        cached['point'].x = 0.0
+        cached = geocoder.geocode('200 S Wabash Ave')
+        self.assertEqual(caching.get_cache_stats()['lru_hits'], 2)
+        self.assertEqual(cached['address'], address)
+        self.assertEqual(cached['point'].x, x)
+
+    @mock.patch('ebpub.streets.models.get_metro')
+    def test_delete_invalidates(self, mock_get_metro):
+        mock_get_metro.return_value = {'city_name': 'CHICAGO',
+                                       'multiple_cities': False}
+        from ebpub.geocoder import caching
+        from ebpub.geocoder.models import GeocoderCache
+        geocoder = SmartGeocoder(use_cache=True)
+        geocoder.geocode('200 S Wabash Ave')
+        GeocoderCache.objects.all().delete()
+        self.failIf(geocoder.geocode('200 S Wabash Ave')._cache_hit)
+        self.assertEqual(caching.get_cache_stats()['misses'], 2)
+
+    def test_negative_caching(self):
+        from ebpub.geocoder import caching
+        geocoder = SmartGeocoder(use_cache=True)
+        with mock.patch.object(geocoder, '_do_geocode') as mock_geocode:
+            mock_geocode.side_effect = DoesNotExist('nope')
+            self.assertRaises(DoesNotExist, geocoder.geocode, 'Nowhere Special')
+            self.assertRaises(DoesNotExist, geocoder.geocode, 'Nowhere Special')
+            self.assertEqual(mock_geocode.call_count, 1)
+        stats = caching.get_cache_stats()
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_no_cache(self):
+        from ebpub.geocoder import caching
+        geocoder = SmartGeocoder(use_cache=False)
+        with mock.patch.object(geocoder, '_do_geocode') as mock_geocode:
+            mock_geocode.side_effect = DoesNotExist('nope')
+            self.assertRaises(DoesNotExist, geocoder.geocode, 'Nowhere Special')
+            self.assertRaises(DoesNotExist, geocoder.geocode, 'Nowhere Special')
+            self.assertEqual(mock_geocode.call_count, 2)
+        self.assertEqual(caching.get_cache_stats()['misses'], 0)
+
 
 if __name__ == '__main__':
     pass
@@ -40,22 +40,30 @@ from django.contrib.gis import geos
 from ebpub.utils.dates import parse_date
 from ebpub.db.models import NewsItem
 from ebpub.streets.models import Place
+from ebpub.utils.view_utils import encode_page_token, parse_page_token, seek
 import pyrfc3339
 import re
 
-__all__ = ['build_item_query', 'build_place_query']
+__all__ = ['build_item_query', 'build_place_query', 'next_after_token']
+
+# Default order of results; also the key for ``after`` tokens.
+ITEM_ORDERING = ('-item_date', '-pub_date', '-id')
 
 
 class QueryError(Exception):
     def __init__(self, message):
         self.message = message
 
-def build_item_query(request):
+def build_item_query(request, limit=True):
     """
     builds a NewsItem QuerySet according to the request parameters given as
     specified in the API documentation.  raises QueryError if
     invalid query parameters are specified.
 
+    If ``limit`` is False, the ``limit`` and ``offset`` parameters are
+    ignored and the results are not ordered, eg. for counting all
+    matching items.
+
     Returns the queryset, and a dictionary of *unused* parameters.
     """
     params = _copy_nomulti(request.GET)
@@ -65,11 +73,17 @@ def build_item_query(request):
     filters = [_schema_filter,
                _id_filter,
                _daterange_filter, _predefined_place_filter,
-               _radius_filter, _bbox_filter, _attributes_filter, _order_by,
+               _radius_filter, _bbox_filter, _attributes_filter, _search_filter,
+               _order_by,
                _object_limit]
 
     query = NewsItem.objects.by_request(request)
     params = dict(params)
+    if not limit:
+        filters = [f for f in filters if f not in (_order_by, _object_limit)]
+        params.pop('limit', None)
+        params.pop('offset', None)
+        params.pop('after', None)
     state = {}
     for f in filters:
         query, params, state = f(query, params, state)
@@ -110,6 +124,23 @@ def _attributes_filter(query, params, state):
     # not implemented yet
     return query, params, state
 
+def _search_filter(query, params, state):
+    """
+    handles full-text search of item titles and descriptions
+    parameters: search
+    """
+    terms = params.pop('search', None)
+    if terms is None:
+        return query, params, state
+    if not isinstance(terms, basestring):
+        terms = u' '.join(terms)
+    terms = terms.strip()
+    if not terms:
+        raise QueryError('Empty search')
+    query = query.search(terms, ranked=False)
+    state['has_search'] = True
+    return query, params, state
+
 def _daterange_filter(query, params, state):
     """
     handles filtering by start and end date
@@ -249,11 +280,38 @@ def _radius_filter(query, params, state):
 
     return query, params, state
 
+def next_after_token(query, rows):
+    """
+    Given a query from build_item_query() and its results as
+    (id, item_date, pub_date, ...) tuples, returns a token to pass as
+    the ``after`` parameter to get the next page of results; or None
+    if there are no more, or the results are ordered by search rank.
+    """
+    if 'search_rank' in query.query.extra or query.query.high_mark is None:
+        return None
+    limit = query.query.high_mark - query.query.low_mark
+    if not rows or len(rows) < limit:
+        return None
+    id_, item_date, pub_date = rows[-1][:3]
+    return encode_page_token([item_date, pub_date, id_])
+
 def _object_limit(query, params, state):
     """
     handles limiting the number of results and skipping results
-    parameters: limit, offset
+    parameters: limit, offset, after
     """
+    after = params.pop('after', None)
+    if after is not None:
+        if state.get('has_search'):
+            raise QueryError('after can not be combined with search, use offset')
+        if params.get('offset'):
+            raise QueryError('Only one of after and offset may be specified')
+        try:
+            values, index = parse_page_token(after, NewsItem, ITEM_ORDERING)
+        except ValueError:
+            raise QueryError('Invalid after token')
+        query = seek(query, ITEM_ORDERING, values)
+
     try: 
         offset = int(params.get('offset', 0))
     except:
@@ -280,8 +338,11 @@ def _order_by(query, params, state):
     handles order of results.
     parameters: None, currently fixed
     """
-    # it is always by item date currently
-    query = query.order_by('-item_date')
+    # Best search matches first, otherwise by item date.
+    if state.get('has_search'):
+        query = query.order_by('-search_rank', *ITEM_ORDERING)
+    else:
+        query = query.order_by(*ITEM_ORDERING)
     return query, params, state
 
 
@@ -28,6 +28,7 @@ from ebpub.utils.testing import RequestFactory
 from django.contrib.gis import geos
 from django.core.urlresolvers import reverse
 from ebpub.utils.django_testcase_backports import TestCase
+from django.test.testcases import TransactionTestCase
 from django.utils import simplejson
 from ebpub.db.models import Location, NewsItem, Schema
 from ebpub.openblockapi import views
@@ -435,6 +436,55 @@ class TestItemSearchAPI(BaseTestCase):
             assert self._items_exist_in_result(items, ritems)
 
 
+    def test_items_json__streaming(self):
+        schema = Schema.objects.get(slug='test-schema')
+        items = _make_items(5, schema)
+        for item in items:
+            item.save()
+            item.attributes['varchar'] = 'This is a varchar'
+            item.attributes['lookup'] = '7701,7700'
+        # One query for the ids, then three per chunk (NewsItems,
+        # Attributes, Lookups), no matter how many items there are.
+        # SchemaFields are already cached.
+        with self.assertNumQueries(4):
+            body = ''.join(views._iter_items_geojson(NewsItem.objects.filter(schema=schema)))
+        with self.assertNumQueries(10):
+            ''.join(views._iter_items_geojson(NewsItem.objects.filter(schema=schema), chunk_size=2))
+
+        # Same as the non-streaming serialization.
+        ritems = simplejson.loads(body)
+        self.assertEqual(len(ritems['features']), 5)
+        for feature in ritems['features']:
+            item = NewsItem.objects.get(id=feature['properties']['id'])
+            expected = simplejson.loads(simplejson.dumps(
+                    views._item_geojson_dict(item),
+                    default=views._serialize_unknown))
+            self.assertEqual(feature['properties'], expected['properties'])
+            self.assertEqual(feature['geometry']['coordinates'],
+                             expected['geometry']['coordinates'])
+            self.assertEqual(feature['properties']['lookup'],
+                             ['Lookup 7701 Name', 'Lookup 7700 Name'])
+
+    def test_items_json__streaming__db_error(self):
+        schema = Schema.objects.get(slug='test-schema')
+        for item in _make_items(3, schema):
+            item.save()
+        from django.db import DatabaseError
+        with mock.patch('ebpub.openblockapi.views.populate_attributes') as mock_populate:
+            mock_populate.side_effect = DatabaseError('oops')
+            body = ''.join(views._iter_items_geojson(NewsItem.objects.filter(schema=schema)))
+        # Still valid JSON.
+        ritems = simplejson.loads(body)
+        self.assertEqual(ritems['features'], [])
+        self.assert_('error' in ritems)
+
+    def test_streaming_response(self):
+        response = views.StreamingHttpResponse(iter(['a', u'b', 'c']))
+        self.assertEqual(response.content, 'abc')
+        # Content can be read more than once.
+        self.assertEqual(response.content, 'abc')
+        self.assertEqual(list(response), ['abc'])
+
     def test_extension_fields_atom(self):
         zone = 'Pacific/Fiji'
         with self.settings(TIME_ZONE=zone):
@@ -605,6 +655,59 @@ class TestItemSearchAPI(BaseTestCase):
             assert len(ritems['features']) == 5
             assert self._items_exist_in_result(items[2:7], ritems)
 
+    def test_items_after(self):
+        zone = 'Europe/Vienna'
+        with self.settings(TIME_ZONE=zone):
+            schema1 = Schema.objects.get(slug='type1')
+            items = _make_items(7, schema1)
+            for item in items:
+                item.save()
+
+            response = self.client.get(reverse('items_json') + '?limit=5')
+            self.assertEqual(response.status_code, 200)
+            ritems = simplejson.loads(response.content)
+            self.assertEqual([f['properties']['id'] for f in ritems['features']],
+                             [item.id for item in items[:5]])
+            token = ritems['next_after']
+
+            response = self.client.get(reverse('items_json') + '?limit=5&after=' + token)
+            self.assertEqual(response.status_code, 200)
+            ritems = simplejson.loads(response.content)
+            self.assertEqual([f['properties']['id'] for f in ritems['features']],
+                             [item.id for item in items[5:]])
+            # That's all.
+            self.assertEqual(ritems.get('next_after'), None)
+
+            response = self.client.get(reverse('items_json') + '?after=oops')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(reverse('items_json') + '?offset=1&after=' + token)
+            self.assertEqual(response.status_code, 400)
+
+    def test_items_search(self):
+        zone = 'Europe/Vienna'
+        with self.settings(TIME_ZONE=zone):
+            schema1 = Schema.objects.get(slug='type1')
+            items = _make_items(5, schema1)
+            items[3].title = u'Fire on Main Street'
+            items[1].description = u'A fire was reported.'
+            for item in items:
+                item.save()
+
+            response = self.client.get(reverse('items_json') + '?search=fires')
+            self.assertEqual(response.status_code, 200)
+            ritems = simplejson.loads(response.content)
+            # Title matches first, even though they're older.
+            self.assertEqual([f['properties']['title'] for f in ritems['features']],
+                             [items[3].title, items[1].title])
+
+            response = self.client.get(reverse('items_json') + '?search=fire&limit=1&offset=1')
+            ritems = simplejson.loads(response.content)
+            self.assertEqual([f['properties']['title'] for f in ritems['features']],
+                             [items[1].title])
+
+            response = self.client.get(reverse('items_json') + '?search=')
+            self.assertEqual(response.status_code, 400)
+
     def test_items_predefined_location(self):
         zone = 'Europe/Zurich'
         with self.settings(TIME_ZONE=zone):
@@ -712,6 +815,29 @@ def _make_items(number, schema, title_prefix=''):
         curdate += inc
     return items
 
+class TestStreamingAfterRequest(TransactionTestCase):
+
+    fixtures = ('test-schema',)
+
+    def test_iterate_after_request_finished(self):
+        from django.core import signals
+        from django.db import connection
+        schema = Schema.objects.get(slug='test-schema')
+        items = _make_items(3, schema)
+        for item in items:
+            item.save()
+        chunks = views._iter_items_geojson(NewsItem.objects.filter(schema=schema),
+                                           chunk_size=2)
+        # As the WSGI handler does before iterating over the response;
+        # this closes the connection.
+        signals.request_finished.send(sender=self.__class__)
+        self.assertEqual(connection.connection, None)
+        body = ''.join(chunks)
+        self.assertEqual(len(simplejson.loads(body)['features']), 3)
+        # The connection it opened was closed again.
+        self.assertEqual(connection.connection, None)
+
+
 @mock.patch('ebpub.openblockapi.views.throttle_check', mock.Mock(return_value=0))
 class TestGeocoderAPI(BaseTestCase):
 
@@ -1094,6 +1220,55 @@ class TestUtilFunctions(TestCase):
         mock_cache.get.return_value = [int(time.time())] * (throttle_at + 1)
         self.assertEqual(True, throttle.should_be_throttled('some_id'))
 
+    @mock.patch('ebpub.openblockapi.throttle.time.time')
+    def test_bucketedcachethrottle(self, mock_time):
+        from django.core.cache.backends.locmem import LocMemCache
+        from ebpub.openblockapi.throttle import BucketedCacheThrottle
+        throttle = BucketedCacheThrottle(throttle_at=3, timeframe=60, buckets=6)
+        self.assertEqual(throttle.bucket_size, 10)
+        with mock.patch('ebpub.openblockapi.throttle.cache',
+                        LocMemCache('test_bucketedcachethrottle', {})):
+            mock_time.return_value = 1000.0
+            self.assertEqual(False, throttle.should_be_throttled('some_id'))
+            self.assertEqual(0, throttle.seconds_till_unthrottling('some_id'))
+            throttle.accessed('some_id')
+            mock_time.return_value = 1025.0
+            throttle.accessed('some_id')
+            throttle.accessed('some_id')
+            self.assertEqual(True, throttle.should_be_throttled('some_id'))
+            # Other identifiers are counted separately.
+            self.assertEqual(False, throttle.should_be_throttled('other_id'))
+            # The first access, in bucket 100, leaves the window at 1060.
+            self.assertEqual(35, throttle.seconds_till_unthrottling('some_id'))
+
+            mock_time.return_value = 1059.0
+            self.assertEqual(True, throttle.should_be_throttled('some_id'))
+            self.assertEqual(1, throttle.seconds_till_unthrottling('some_id'))
+            mock_time.return_value = 1060.0
+            self.assertEqual(False, throttle.should_be_throttled('some_id'))
+            self.assertEqual(0, throttle.seconds_till_unthrottling('some_id'))
+            # ... and the rest at 1080.
+            mock_time.return_value = 1080.0
+            self.assertEqual([0] * 6,
+                             [c for (b, c) in throttle._counts('some_id')])
+
+    @mock.patch('ebpub.openblockapi.throttle.cache')
+    def test_bucketedcachethrottle__add_race(self, mock_cache):
+        from ebpub.openblockapi.throttle import BucketedCacheThrottle
+        throttle = BucketedCacheThrottle(throttle_at=3, timeframe=60, buckets=6)
+        # Our key expires before incr(), and another request
+        # re-creates it before our add().
+        mock_cache.incr.side_effect = [ValueError, 2]
+        mock_cache.add.side_effect = [True, False]
+        throttle.accessed('some_id')
+        self.assertEqual(2, mock_cache.incr.call_count)
+
+    def test_get_throttle_class(self):
+        from ebpub.openblockapi.views import _get_throttle_class
+        from ebpub.openblockapi.throttle import CacheThrottle
+        with self.settings(API_THROTTLE_CLASS='ebpub.openblockapi.throttle.CacheThrottle'):
+            self.assertEqual(CacheThrottle, _get_throttle_class())
+
     @mock.patch('ebpub.openblockapi.views.check_api_authorization')
     @mock.patch('ebpub.openblockapi.views._throttle')
     def test_throttlecheck(self, mock_throttle, mock_check_api_auth):
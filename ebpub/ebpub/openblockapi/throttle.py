@@ -23,6 +23,7 @@ http://github.com/toastdriven/django-tastypie/
 Copyright 2011 Daniel Lindsley.  BSD license.
 """
 
+import math
 import time
 from django.core.cache import cache
 
@@ -141,3 +142,98 @@ class CacheThrottle(BaseThrottle):
         when = oldest + self.timeframe
         return when - int(time.time())
 
+
+
+class BucketedCacheThrottle(BaseThrottle):
+    """
+    A sliding-window throttle that keeps a fixed number of counters
+    per identifier in the cache, rather than a list of every access.
+
+    The ``timeframe`` is divided into ``buckets`` equal slots (default
+    60, ie. one minute per slot with the default one-hour timeframe).
+    Each access does an atomic ``cache.incr()`` of the current slot's
+    counter, so concurrent processes don't overwrite each other; checking
+    the limit is a single ``cache.get_many()`` of the slots still in the
+    window.  The window is thus accurate to within one slot.
+
+    Each counter expires on its own shortly after it leaves the window,
+    so ``expiration`` is not used.
+    """
+    def __init__(self, throttle_at=150, timeframe=3600, expiration=None,
+                 buckets=60):
+        super(BucketedCacheThrottle, self).__init__(throttle_at, timeframe,
+                                                    expiration)
+        self.buckets = max(1, int(buckets))
+        self.bucket_size = max(1, int(self.timeframe) // self.buckets)
+
+    def _current_bucket(self, now=None):
+        if now is None:
+            now = time.time()
+        return int(now) // self.bucket_size
+
+    def _bucket_key(self, key, bucket):
+        return '%s_%d' % (key, bucket)
+
+    def _counts(self, identifier, now=None):
+        """
+        Returns a list of (bucket, count) pairs for the buckets still in
+        the window, oldest first.
+        """
+        key = self.convert_identifier_to_key(identifier)
+        current = self._current_bucket(now)
+        buckets = range(current - self.buckets + 1, current + 1)
+        keys = [self._bucket_key(key, b) for b in buckets]
+        found = cache.get_many(keys)
+        return [(b, int(found.get(k) or 0)) for (b, k) in zip(buckets, keys)]
+
+    def should_be_throttled(self, identifier, **kwargs):
+        """
+        Returns ``True`` if the user has made ``throttle_at`` or more
+        requests within the timeframe, else ``False``.
+        """
+        total = sum(count for (bucket, count) in self._counts(identifier))
+        return total >= int(self.throttle_at)
+
+    def accessed(self, identifier, **kwargs):
+        """
+        Atomically increments the counter for the current bucket.
+        """
+        key = self._bucket_key(self.convert_identifier_to_key(identifier),
+                               self._current_bucket())
+        # Keep the counter until its bucket has left the window.
+        timeout = int(self.timeframe) + self.bucket_size
+        cache.add(key, 0, timeout)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The key was evicted, or expired, between add() and incr();
+            # or it's a DummyCache.  Either way, start over.
+            if not cache.add(key, 1, timeout):
+                # Another request re-created the key first;
+                # count ourselves on top of it rather than losing a hit.
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    pass
+
+    def seconds_till_unthrottling(self, identifier):
+        """
+        Returns how many seconds until enough old buckets have left the
+        window for the user to be under the limit again; 0 if they
+        already are.
+        """
+        now = time.time()
+        limit = int(self.throttle_at)
+        counts = self._counts(identifier, now)
+        total = sum(count for (bucket, count) in counts)
+        if total < limit:
+            return 0
+        for bucket, count in counts:
+            total -= count
+            if total < limit:
+                # This bucket drops out of the window once the current
+                # bucket is `self.buckets` slots later than it.
+                leaves_window = (bucket + self.buckets) * self.bucket_size
+                return max(1, int(math.ceil(leaves_window - now)))
+        # Eg. throttle_at is 0.
+        return int(self.timeframe)
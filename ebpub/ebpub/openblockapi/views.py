@@ -20,6 +20,8 @@ from apikey.auth import check_api_authorization  # relative import
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db import DatabaseError
 from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
@@ -31,10 +33,12 @@ from django.utils import simplejson
 from django.utils.cache import patch_response_headers
 from django.utils.cache import patch_vary_headers
 from ebpub.db import models
+from ebpub.db.utils import populate_attributes
 from ebpub.geocoder import DoesNotExist
 from ebpub.geocoder.base import full_geocode
 from ebpub.openblockapi.itemquery import _copy_nomulti
 from ebpub.openblockapi.itemquery import build_item_query, build_place_query, QueryError
+from ebpub.openblockapi.itemquery import next_after_token
 from ebpub.streets.models import PlaceType
 from ebpub.utils.dates import parse_date, parse_time
 from ebpub.utils.geodjango import ensure_valid
@@ -53,6 +57,10 @@ ATOM_CONTENT_TYPE = "application/atom+xml"
 JSON_CONTENT_TYPE = 'application/json'
 JAVASCRIPT_CONTENT_TYPE = 'application/javascript'
 
+# How many NewsItems to load from the database at a time
+# when streaming GeoJSON.
+STREAMING_CHUNK_SIZE = 500
+
 LOCAL_TZ = pytz.timezone(settings.TIME_ZONE)
 
 logger = logging.getLogger('openblockapi')
@@ -83,6 +91,50 @@ def APIGETResponse(request, body, **kw):
         kw['content_type'] = JAVASCRIPT_CONTENT_TYPE
         return HttpResponse(body, **kw)
 
+class StreamingHttpResponse(HttpResponse):
+    """
+    An HttpResponse whose content is an iterator of strings, sent to
+    the client as it's generated.
+
+    Middleware that reads ``response.content`` (eg. GZipMiddleware or
+    ConditionalGetMiddleware) will still work, but causes the whole
+    content to be buffered in memory.
+
+    Note that the iterator is consumed after the request has finished
+    and its database connection has been closed; so an iterator that
+    queries the database must close its own connection when done, as
+    :py:func:`_iter_items_geojson` does.  Errors while iterating can't
+    change the response status.
+    """
+
+    def _get_content(self):
+        if not self._is_string:
+            self._container = [''.join(self._container)]
+            self._is_string = True
+        return HttpResponse._get_content(self)
+
+    content = property(_get_content, HttpResponse._set_content)
+
+
+def APIGETStreamingResponse(request, chunks, **kw):
+    """
+    Like APIGETResponse, but ``chunks`` is an iterator of strings
+    that together form the (already JSON-encoded) body.
+    """
+    jsonp = request.GET.get(JSONP_QUERY_PARAM)
+    kw.setdefault('content_type', JSON_CONTENT_TYPE)
+    if jsonp is not None:
+        jsonp = re.sub(r'[^a-zA-Z0-9_]+', '', jsonp)
+        chunks = _wrap_chunks('%s(' % jsonp, chunks, ');')
+        kw['content_type'] = JAVASCRIPT_CONTENT_TYPE
+    return StreamingHttpResponse(chunks, **kw)
+
+def _wrap_chunks(before, chunks, after):
+    yield before
+    for chunk in chunks:
+        yield chunk
+    yield after
+
 def normalize_datetime(dt):
     # XXX needs tests
     if dt.tzinfo is None:
@@ -115,21 +167,36 @@ def api_items_geojson(items):
 
 def _item_geojson_dict(item):
     # Prepare a single NewsItem as a structure that can be JSON-encoded.
-    props = {}
     geom = simplejson.loads(item.location.geojson)
     result = {
         'type': 'Feature',
         'geometry': geom,
+        'properties': _item_properties(item),
         }
-    for attr in item.attributes_for_template():
-        key = attr.sf.name
-        if attr.sf.is_many_to_many_lookup():
-            props[key] = attr.values
-        else:
-            try:
-                props[key] = attr.values[0]
-            except IndexError:
-                props[key] = None
+    return result
+
+def _item_properties(item, schemafields=None):
+    # The properties of a NewsItem's GeoJSON Feature.
+    # If ``schemafields`` (the item's SchemaFields, in display order) is
+    # given, item.attributes should already be populated with Lookups,
+    # eg. by populate_attributes().
+    props = {}
+    if schemafields is None:
+        for attr in item.attributes_for_template():
+            key = attr.sf.name
+            if attr.sf.is_many_to_many_lookup():
+                props[key] = attr.values
+            else:
+                try:
+                    props[key] = attr.values[0]
+                except IndexError:
+                    props[key] = None
+    else:
+        for sf in schemafields:
+            value = item.attributes.get(sf.name)
+            if sf.is_many_to_many_lookup():
+                value = value or []
+            props[sf.name] = value
 
     props.update(
         {'type': item.schema.slug,
@@ -144,8 +211,64 @@ def _item_geojson_dict(item):
          'color': item.schema.map_color,
          'location_name': item.location_name,
          })
-    result['properties'] = props
-    return result
+    return props
+
+def _iter_items_geojson(items, chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Returns an iterator of strings which together make up a GeoJSON
+    FeatureCollection of the NewsItems in ``items`` (a queryset)
+    that have a location.
+
+    Items are loaded from the database ``chunk_size`` at a time, with
+    their attributes and Lookups, and geometries are encoded as GeoJSON
+    by the database.
+    """
+    # Get just the ids first, in order.  Selecting the other ordering
+    # columns (including extras, eg. search_rank) too keeps it valid
+    # to combine the ordering with distinct().
+    fields = ['id', 'item_date', 'pub_date'] + sorted(items.query.extra.keys())
+    rows = list(items.values_list(*fields))
+    ids = [row[0] for row in rows]
+    return _generate_items_geojson(ids, chunk_size, next_after_token(items, rows))
+
+def _generate_items_geojson(ids, chunk_size, next_after=None):
+    # The WSGI handler sends request_finished, which closes the
+    # database connection, before the response is iterated over; so
+    # we may have to open a new one here, and then we must close it
+    # ourselves rather than leave it open until the next request.
+    own_connection = connection.connection is None
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = '\n'
+    try:
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            chunk = models.NewsItem.objects.filter(id__in=chunk_ids, location__isnull=False)
+            chunk = chunk.select_related('schema').geojson(field_name='location')
+            by_id = dict([(item.id, item) for item in chunk])
+            chunk = [by_id[id_] for id_ in chunk_ids if id_ in by_id]
+            if not chunk:
+                continue
+            populate_attributes(chunk)
+            schemafields = models.cached_schema_fields([item.schema_id for item in chunk])
+            for item in chunk:
+                props = _item_properties(item, schemafields.get(item.schema_id, []))
+                yield '%s{"type": "Feature", "geometry": %s, "properties": %s}' % (
+                    separator, item.geojson,
+                    simplejson.dumps(props, default=_serialize_unknown))
+                separator = ',\n'
+    except DatabaseError:
+        # Too late to change the status, but at least end with valid
+        # JSON that says the results are incomplete.
+        logger.exception("Database error while streaming items")
+        yield '\n], "error": "Database error, results are incomplete"}'
+        return
+    finally:
+        if own_connection:
+            connection.close()
+    if next_after:
+        yield '\n], "next_after": "%s"}' % next_after
+    else:
+        yield '\n]}'
 
 def _serialize_unknown(obj):
     # Handle NewsItems and various other types that default json serializer
@@ -223,11 +346,18 @@ def rest_view(methods, cache_timeout=None):
         return wrapper
     return inner
 
-from ebpub.openblockapi.throttle import CacheThrottle
+def _get_throttle_class():
+    # settings.API_THROTTLE_CLASS is a dotted path, like EMAIL_BACKEND.
+    path = getattr(settings, 'API_THROTTLE_CLASS',
+                   'ebpub.openblockapi.throttle.BucketedCacheThrottle')
+    module, cls = path.rsplit('.', 1)
+    import importlib
+    module = importlib.import_module(module)
+    return getattr(module, cls)
 
 
 # We could have more than one throttle instance to be more flexible.
-_throttle = CacheThrottle(
+_throttle = _get_throttle_class()(
     throttle_at=getattr(settings, 'API_THROTTLE_AT', 150), # max requests per timeframe.
     timeframe=getattr(settings, 'API_THROTTLE_TIMEFRAME', 60 * 60), # default 1 hour.
     expiration=getattr(settings, 'API_THROTTLE_EXPIRATION', 60 * 60 * 24 * 7)  # default 1 week.
@@ -301,11 +431,8 @@ def items_json(request):
     try:
         items, params = build_item_query(request)
         # could test for extra params aside from jsonp...
-        items = [item for item in items if item.location is not None]
-        items_geojson_dict = {'type': 'FeatureCollection',
-                              'features': items
-                              }
-        return APIGETResponse(request, items_geojson_dict, content_type=JSON_CONTENT_TYPE)
+        return APIGETStreamingResponse(request, _iter_items_geojson(items),
+                                       content_type=JSON_CONTENT_TYPE)
     except QueryError as err:
         return HttpResponseBadRequest(err.message)
 
@@ -453,6 +580,8 @@ def _items_atom(items):
         feed_url=feed_url,
         id=feed_url,)
 
+    items = list(items)
+    populate_attributes(items)
     for item in items:
         location = item.location
         if location:
@@ -23,11 +23,14 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+from django.conf import settings
 from django.core import urlresolvers
 from django.test import TestCase
 from ebpub.openblockapi.tests import _make_items
 from ebpub.db.models import NewsItem
 from ebpub.db.models import Schema
+from django.contrib.gis import geos
+from django.core.cache import cache
 import mock
 import json
 
@@ -66,3 +69,110 @@ class TestViews(TestCase):
         decoded = json.loads(response.content)
         self.assertEqual(len(decoded['features']), 3)
 
+    def _make_tile_items(self):
+        schema = Schema.objects.create(
+            name='n1', plural_name='n1s', slug='n1', is_public=True,
+            indefinite_article='a', last_updated='2012-01-01',
+            date_name='dn', date_name_plural='dns')
+        items = _make_items(4, schema)
+        # Three close together in Boston, one in Cambridge.
+        points = [(-71.06, 42.36), (-71.0601, 42.3601), (-71.0602, 42.3602),
+                  (-71.11, 42.37)]
+        for item, (lon, lat) in zip(items, points):
+            item.location = geos.Point(lon, lat)
+            item.save()
+        cache.clear()
+        return items
+
+    def test_map_items_tile__clusters(self):
+        self._make_tile_items()
+        # Zoom 11 tile containing all of them.
+        url = urlresolvers.reverse('map_items_tile_json', args=(11, 619, 757))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        features = json.loads(response.content)['features']
+        self.assertEqual(sorted(f['properties']['count'] for f in features), [1, 3])
+        for feature in features:
+            self.assertEqual(feature['properties']['openblock_type'], 'cluster')
+            self.assertEqual(feature['properties']['schemas'],
+                             {'n1': feature['properties']['count']})
+        single = [f for f in features if f['properties']['count'] == 1][0]
+        self.assertEqual(single['geometry']['coordinates'], [-71.11, 42.37])
+        self.assert_('id' in single['properties'])
+
+        # A neighboring tile has none.
+        url = urlresolvers.reverse('map_items_tile_json', args=(11, 620, 757))
+        self.assertEqual(json.loads(self.client.get(url).content)['features'], [])
+
+    def test_map_items_tile__detail(self):
+        items = self._make_tile_items()
+        url = urlresolvers.reverse('map_items_tile_json', args=(16, 19831, 24239))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        features = json.loads(response.content)['features']
+        self.assertEqual(sorted(f['properties']['id'] for f in features),
+                         sorted(item.id for item in items[:3]))
+        self.assertEqual(features[0]['properties']['openblock_type'], 'newsitem')
+
+    def test_map_items_tile__private_schemas(self):
+        self._make_tile_items()
+        private = Schema.objects.create(
+            name='p1', plural_name='p1s', slug='p1', is_public=False,
+            indefinite_article='a', last_updated='2012-01-01',
+            date_name='dn', date_name_plural='dns')
+        item = _make_items(1, private)[0]
+        item.location = geos.Point(-71.06, 42.36)
+        item.save()
+        cache.clear()
+        url = urlresolvers.reverse('map_items_tile_json', args=(11, 619, 757))
+
+        # Staff first, so a shared cache entry would leak to the public.
+        self.client.cookies[settings.STAFF_COOKIE_NAME] = settings.STAFF_COOKIE_VALUE
+        response = self.client.get(url)
+        features = json.loads(response.content)['features']
+        self.assertEqual(sum(f['properties']['count'] for f in features), 5)
+        self.assert_('p1' in response.content)
+        self.assert_('Cookie' in response['Vary'])
+
+        del self.client.cookies[settings.STAFF_COOKIE_NAME]
+        response = self.client.get(url)
+        features = json.loads(response.content)['features']
+        self.assertEqual(sum(f['properties']['count'] for f in features), 4)
+        self.assert_('p1' not in response.content)
+
+    def test_map_items_tile__out_of_range(self):
+        url = urlresolvers.reverse('map_items_tile_json', args=(1, 2, 0))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_headlines(self):
+        items = self._make_tile_items()
+        from ebpub.richmaps.views import render_newsitems
+        ids = [str(item.id) for item in items[:3]]
+        url = urlresolvers.reverse('headlines')
+        query = '&'.join('item_id=newsitem:%s' % i for i in ids + ['nope', '99999'])
+        response = self.client.get(url + '?' + query)
+        self.assertEqual(response.status_code, 200)
+        for item in items[:3]:
+            self.assert_('item_headline_%d' % item.id in response.content)
+        self.assertEqual(response.content.count('<li'), 3)
+
+        # All in one query, and rendered output is cached.
+        from django.core.cache.backends.locmem import LocMemCache
+        with mock.patch('ebpub.richmaps.views.cache',
+                        LocMemCache('test_headlines', {})):
+            with self.assertNumQueries(1):
+                html = render_newsitems(ids + ['nope'], 'newsitem_headline')
+            self.assertEqual(sorted(html.keys()), sorted(ids))
+            with mock.patch('ebpub.richmaps.views._select_template') as mock_select:
+                with self.assertNumQueries(1):
+                    self.assertEqual(render_newsitems(ids, 'newsitem_headline'), html)
+                self.assertEqual(mock_select.call_count, 0)
+
+    def test_item_popup(self):
+        items = self._make_tile_items()
+        url = urlresolvers.reverse('item_popup', args=(items[0].id,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assert_(items[0].title in response.content)
+        url = urlresolvers.reverse('item_popup', args=(99999,))
+        self.assertEqual(self.client.get(url).status_code, 404)
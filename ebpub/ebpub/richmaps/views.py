@@ -18,21 +18,27 @@
 
 from django import template
 from django.conf import settings
+from django.contrib.gis import geos
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db import connection
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.template.loader import get_template, select_template
 from django.utils import simplejson
-from django.utils.cache import patch_response_headers
-from ebpub.db.models import NewsItem
+from django.utils.cache import patch_response_headers, patch_vary_headers
+from ebpub.db.models import NewsItem, Schema
 from ebpub.db.schemafilters import FilterChain
+from ebpub.db.utils import populate_attributes_if_needed
 from ebpub.db.views import _get_filter_schemafields
-from ebpub.openblockapi.itemquery import build_item_query
+from ebpub.openblockapi.itemquery import build_item_query, QueryError
 from ebpub.openblockapi.views import JSON_CONTENT_TYPE
 from ebpub.streets.models import Place, PlaceType
 from ebpub.utils.view_utils import eb_render
 from ebpub.utils.view_utils import get_schema_manager
+from ebpub.utils import mapmath
 import datetime
+import hashlib
 import logging
 import re
 
@@ -410,90 +416,153 @@ def headlines(request):
         cur_template = get_template('richmaps/no_headlines.html')
         html = cur_template.render(template.Context({}))
     else: 
+        newsitem_ids = [item_id for (obtype, item_id) in items if obtype == 'newsitem']
+        place_ids = [item_id for (obtype, item_id) in items if obtype != 'newsitem']
+        newsitem_html = render_newsitems(newsitem_ids, 'newsitem_headline')
+        place_html = render_places(place_ids, 'place_headline')
+        html = []
         for (obtype, item_id) in items:
             if obtype == 'newsitem':
-                html += _item_headline(request, item_id)
-            else: 
-                html += _place_headline(request, item_id)
+                html.append(newsitem_html.get(item_id, ''))
+            else:
+                html.append(place_html.get(item_id, ''))
+        html = ''.join(html)
 
     response = HttpResponse(html)
     patch_response_headers(response, cache_timeout=3600)
     return response
 
 
-def _item_headline(request, item_id):
+# How long to cache rendered NewsItem headlines and popups.
+# Editing a NewsItem changes its cache key; editing its Schema
+# or the templates doesn't, but then, the responses are cached by
+# browsers for this long anyway.
+FRAGMENT_CACHE_TIMEOUT = 3600
+
+_template_cache = {}
+
+def _select_template(kind, slug):
     """
-    returns the headline list html for a single item.
+    Returns the template for richmaps/<kind>_<slug>.html, falling
+    back to richmaps/<kind>.html.  Memoized, unless settings.DEBUG is on.
     """
-    try:
-        item_id = int(item_id)
-        ni = NewsItem.objects.get(id=item_id)
-    except:
-        return ''
+    key = (kind, slug)
+    result = _template_cache.get(key)
+    if result is None:
+        result = select_template(['richmaps/%s_%s.html' % (kind, slug),
+                                  'richmaps/%s.html' % kind,
+                                  ])
+        if not settings.DEBUG:
+            _template_cache[key] = result
+    return result
+
+def _int_ids(ids):
+    result = {}
+    for item_id in ids:
+        try:
+            result[int(item_id)] = item_id
+        except (TypeError, ValueError):
+            pass
+    return result
 
-    schema = ni.schema
-    template_list = ['richmaps/newsitem_headline_%s.html' % schema.slug,
-                     'richmaps/newsitem_headline.html',
-                     ]
-    current_template = select_template(template_list)
-    return current_template.render(template.Context({'newsitem': ni, 'schema': schema, }))
+def render_newsitems(ids, kind):
+    """
+    Renders the richmaps/<kind>_<schema slug>.html (or
+    richmaps/<kind>.html) template for each of the NewsItems with
+    the given ``ids``, eg. with kind='newsitem_headline'.
 
+    Returns a dict mapping each id, exactly as given, to its HTML;
+    ids of non-existent NewsItems are left out.
 
-def _place_headline(request, item_id):
+    Fetches all the NewsItems in one query.  Rendered HTML is cached
+    by id and last modification time, so only those not in the
+    cache have their attributes loaded and get rendered.
     """
-    returns the headline list html for a single place.
+    ids = _int_ids(ids)
+    if not ids:
+        return {}
+    newsitems = list(NewsItem.objects.filter(id__in=ids.keys()).select_related('schema'))
+    keys = dict((ni.id, 'richmaps.%s:%d:%s' % (kind, ni.id, ni.last_modification.isoformat()))
+                for ni in newsitems)
+    cached = cache.get_many(keys.values())
+    result = {}
+    missing = []
+    for ni in newsitems:
+        html = cached.get(keys[ni.id])
+        if html is None:
+            missing.append(ni)
+        else:
+            result[ids[ni.id]] = html
+    if missing:
+        schemas = dict((ni.schema_id, ni.schema) for ni in missing).values()
+        populate_attributes_if_needed(missing, schemas)
+        rendered = {}
+        for ni in missing:
+            html = _select_template(kind, ni.schema.slug).render(
+                template.Context({'newsitem': ni, 'schema': ni.schema, }))
+            result[ids[ni.id]] = html
+            rendered[keys[ni.id]] = html
+        cache.set_many(rendered, FRAGMENT_CACHE_TIMEOUT)
+    return result
+
+def render_places(ids, kind):
     """
-    try:
-        item_id = int(item_id)
-        place = Place.objects.get(id=item_id)
+    Like :py:func:`render_newsitems` but for Places, with templates
+    named by PlaceType slug, eg. kind='place_popup'.  Not cached,
+    since Places don't record when they were modified.
+    """
+    ids = _int_ids(ids)
+    if not ids:
+        return {}
+    result = {}
+    for place in Place.objects.filter(id__in=ids.keys()).select_related('place_type'):
         place_type = place.place_type
-    except:
-        return ''
-
-
-    template_list = ['richmaps/place_headline_%s.html' % place_type.slug,
-                     'richmaps/place_headline.html',
-                     ]
-    current_template = select_template(template_list)
-    return current_template.render(template.Context({'place': place, 'place_type': place_type, }))
+        result[ids[place.id]] = _select_template(kind, place_type.slug).render(
+            template.Context({'place': place, 'place_type': place_type, }))
+    return result
 
 
 def item_popup(request, item_id):
     """
     returns the popup html for a single item.
     """
-    try:
-        item_id = int(item_id)
-        ni = NewsItem.objects.get(id=item_id)
-    except:
+    html = render_newsitems([item_id], 'newsitem_popup').get(item_id)
+    if html is None:
         return HttpResponse(status=404)
-
-    schema = ni.schema
-    template_list = ['richmaps/newsitem_popup_%s.html' % schema.slug,
-                     'richmaps/newsitem_popup.html',
-                     ]
-    current_template = select_template(template_list)
-    html = current_template.render(template.Context({'newsitem': ni, 'schema': schema, }))
     response = HttpResponse(html)
     patch_response_headers(response, cache_timeout=3600)
     return response
 
 def place_popup(request, place_id):
-    try: 
-        place_id = int(place_id)
-        place = Place.objects.get(id=place_id)
-    except:
+    html = render_places([place_id], 'place_popup').get(place_id)
+    if html is None:
         return HttpResponse(status=404)
-
-    template_list = ['richmaps/place_popup_%s.html' % place.place_type.slug,
-                     'richmaps/place_popup.html',
-                     ]
-    current_template = select_template(template_list)
-    html = current_template.render(template.Context({'place': place, 'place_type': place.place_type, }))
     response = HttpResponse(html)
     patch_response_headers(response, cache_timeout=3600)
     return response
 
+def _item_to_feature(item):
+    geom = simplejson.loads(item.location.geojson)
+    result = {
+        'type': 'Feature',
+        'geometry': geom,
+        }
+
+    # Uh-oh, this is not y10k compliant :-p
+    sort_key = '%d-%d-%d-%s-%d' % (9999 - item.item_date.year,
+                                13 - item.item_date.month,
+                                32 - item.item_date.day,
+                                item.title,
+                                item.id)
+    props = {'id': item.id,
+             'openblock_type': 'newsitem',
+             'icon': item.schema.get_map_icon_url(),
+             'color': item.schema.map_color,
+             'sort': sort_key
+            }
+    result['properties'] = props
+    return result
+
 def map_items_json(request):
     """
     slightly briefer and less attribute-accessing 
@@ -502,28 +571,6 @@ def map_items_json(request):
     """
     items, params = build_item_query(request)
 
-    def _item_to_feature(item):
-        geom = simplejson.loads(item.location.geojson)
-        result = {
-            'type': 'Feature',
-            'geometry': geom,
-            }
-
-        # Uh-oh, this is not y10k compliant :-p
-        sort_key = '%d-%d-%d-%s-%d' % (9999 - item.item_date.year,
-                                    13 - item.item_date.month,
-                                    32 - item.item_date.day,
-                                    item.title,
-                                    item.id)
-        props = {'id': item.id,
-                 'openblock_type': 'newsitem',
-                 'icon': item.schema.get_map_icon_url(),
-                 'color': item.schema.map_color,
-                 'sort': sort_key
-                }
-        result['properties'] = props
-        return result
-
     items = [_item_to_feature(item) for item in items if item.location is not None]
     items_geojson_dict = {'type': 'FeatureCollection',
                           'features': items
@@ -533,3 +580,150 @@ def map_items_json(request):
     response = HttpResponse(body, content_type=JSON_CONTENT_TYPE)
     patch_response_headers(response, cache_timeout=3600)
     return response
+
+
+# Tiles at this zoom level or closer get individual items;
+# farther out, items are clustered.
+TILE_DETAIL_ZOOM = 16
+
+# Size, in pixels, of the grid cells that items are clustered in.
+TILE_CLUSTER_PIXELS = 32
+
+TILE_CACHE_TIMEOUT = 3600
+
+def map_items_tile_json(request, zoom, x, y):
+    """
+    GeoJSON for the items in one map tile, in the usual spherical
+    mercator z/x/y scheme.  Accepts the same query parameters as
+    :py:func:`map_items_json`, except ``limit`` and ``offset``; all
+    matching items in the tile are included.
+
+    Below ``TILE_DETAIL_ZOOM``, items are clustered in a grid of
+    ``TILE_CLUSTER_PIXELS`` cells, and each feature is a cluster at
+    the mean location of its items, with these properties:
+
+    * openblock_type: 'cluster'
+    * count: the number of items
+    * schemas: a dict of item counts by schema slug
+    * id: the item's id, if there's only one
+
+    At ``TILE_DETAIL_ZOOM`` and closer, features are individual items,
+    as from :py:func:`map_items_json`.
+
+    An item belongs to the tile containing its centroid.  Responses
+    are cached for an hour, both in Django's cache (keyed by the
+    full URL and the schemas this request may see) and by HTTP
+    caches (varying by cookie, for the staff cookie).
+    """
+    zoom, x, y = int(zoom), int(x), int(y)
+    if zoom > 30 or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        return HttpResponse(status=404)
+    full_path = request.get_full_path()
+    if isinstance(full_path, unicode):
+        full_path = full_path.encode('utf8')
+    # The items are limited to the schemas this request may see,
+    # so tiles can only be shared between requests that see the same.
+    schema_ids = sorted(get_schema_manager(request).allowed_schema_ids())
+    key_data = '%s|%s' % (full_path, ','.join(str(i) for i in schema_ids))
+    cache_key = 'richmaps.tile:%s' % hashlib.md5(key_data).hexdigest()
+    body = cache.get(cache_key)
+    if body is None:
+        try:
+            items, params = build_item_query(request, limit=False)
+        except QueryError, err:
+            return HttpResponseBadRequest(err.message)
+        bounds = mapmath.tile_bounds(zoom, x, y)
+        tile = geos.Polygon.from_bbox(bounds)
+        tile.srid = 4326
+        items = items.filter(location__bboverlaps=tile)
+        if zoom >= TILE_DETAIL_ZOOM:
+            features = _tile_items(items, bounds)
+        else:
+            features = _tile_clusters(items, bounds)
+        body = simplejson.dumps({'type': 'FeatureCollection',
+                                 'features': features})
+        cache.set(cache_key, body, TILE_CACHE_TIMEOUT)
+    response = HttpResponse(body, content_type=JSON_CONTENT_TYPE)
+    patch_response_headers(response, cache_timeout=TILE_CACHE_TIMEOUT)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+def _in_tile(lon, lat, bounds):
+    # Half-open, so a point on an edge is only in one tile.
+    west, south, east, north = bounds
+    return west <= lon < east and south < lat <= north
+
+def _tile_items(items, bounds):
+    features = []
+    for item in items.select_related('schema'):
+        if item.location is None:
+            continue
+        centroid = item.location.centroid
+        if _in_tile(centroid.x, centroid.y, bounds):
+            features.append(_item_to_feature(item))
+    return features
+
+def _tile_clusters(items, bounds):
+    """
+    Counts items per grid cell and schema in one query, and returns
+    a GeoJSON feature for each non-empty cell.
+    """
+    west, south, east, north = bounds
+    cells = mapmath.TILE_SIZE // TILE_CLUSTER_PIXELS
+    merc_north = mapmath.mercator_y(north)
+    cell_width = (east - west) / cells
+    cell_height = (merc_north - mapmath.mercator_y(south)) / cells
+
+    ids = items.values('id')
+    ids_sql, ids_params = ids.query.get_compiler(ids.db).as_sql()
+    sql = """
+        SELECT schema_id,
+               FLOOR((lon - %%s) / %%s) AS grid_x,
+               FLOOR((%%s - LN(TAN(PI() / 4 + RADIANS(lat) / 2))) / %%s) AS grid_y,
+               COUNT(*), AVG(lon), AVG(lat), MIN(id)
+        FROM (SELECT id, schema_id, ST_X(centroid) AS lon, ST_Y(centroid) AS lat
+              FROM (SELECT id, schema_id, ST_Centroid(location) AS centroid
+                    FROM db_newsitem WHERE id IN (%s)) AS centroids
+             ) AS points
+        WHERE lon >= %%s AND lon < %%s AND lat > %%s AND lat <= %%s
+        GROUP BY schema_id, grid_x, grid_y
+    """ % ids_sql
+    params = [west, cell_width, merc_north, cell_height]
+    params.extend(ids_params)
+    params.extend([west, east, south, north])
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+
+    schema_slugs = dict(Schema.objects.filter(id__in=set(r[0] for r in rows)).values_list('id', 'slug'))
+    clusters = {}
+    for schema_id, grid_x, grid_y, count, lon, lat, min_id in rows:
+        # Rounding can put points on the far edges into the next cell.
+        key = (min(int(grid_x), cells - 1), min(int(grid_y), cells - 1))
+        cluster = clusters.setdefault(key, {'count': 0, 'lon': 0.0, 'lat': 0.0,
+                                            'schemas': {}, 'id': None})
+        cluster['count'] += count
+        cluster['lon'] += lon * count
+        cluster['lat'] += lat * count
+        slug = schema_slugs.get(schema_id)
+        cluster['schemas'][slug] = cluster['schemas'].get(slug, 0) + count
+        cluster['id'] = min_id
+
+    features = []
+    for key in sorted(clusters):
+        cluster = clusters[key]
+        count = cluster['count']
+        props = {'openblock_type': 'cluster',
+                 'count': count,
+                 'schemas': cluster['schemas'],
+                 }
+        if count == 1:
+            props['id'] = cluster['id']
+        features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point',
+                             'coordinates': [cluster['lon'] / count,
+                                             cluster['lat'] / count]},
+                'properties': props,
+                })
+    return features
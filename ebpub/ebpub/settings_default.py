@@ -383,6 +383,10 @@ API_THROTTLE_AT=150  # max requests per timeframe.
 API_THROTTLE_TIMEFRAME = 60 * 60 # default 1 hour.
 # How long to retain the times the user has accessed the API. Default 1 week.
 API_THROTTLE_EXPIRATION = 60 * 60 * 24 * 7
+# Which throttle implementation to use, as a dotted path.
+# BucketedCacheThrottle keeps a fixed number of counters per user;
+# the older CacheThrottle keeps a list of every access time.
+API_THROTTLE_CLASS = 'ebpub.openblockapi.throttle.BucketedCacheThrottle'
 
 # NOTE in order to enable throttling, you MUST also configure
 # CACHES['default'] to something other than a DummyCache.  See the CACHES
@@ -421,12 +425,27 @@ RECAPTCHA_PRIVATE_KEY = ''
 #  OTHER                                       #
 ################################################
 
-# Set this True to cache geocoder results in the database;
+# Set this True to cache geocoder results;
 # it's faster but makes troubleshooting harder.
-# (Why doesn't it just use the normal django caching framework?)
 EBPUB_CACHE_GEOCODER = True
 required_settings.append('EBPUB_CACHE_GEOCODER')
 
+# When EBPUB_CACHE_GEOCODER is on, results are also kept in a
+# per-process LRU cache and in CACHES['default'], in front of the
+# database table. See ebpub.geocoder.caching.
+# Max number of results held in each process; 0 disables it.
+EBPUB_GEOCODER_LRU_SIZE = 1000
+# Seconds to keep successful results in the in-process and shared caches.
+EBPUB_GEOCODER_CACHE_TTL = 60 * 60 * 24
+# Seconds to remember addresses that could not be found or parsed;
+# 0 disables negative caching.
+EBPUB_GEOCODER_NEGATIVE_CACHE_TTL = 60 * 10
+
+# Set this False to make NewsItemQuerySet.search() do simple
+# case-insensitive substring matches, instead of using the full-text
+# search index; eg. if your database doesn't support it.
+EBPUB_FULL_TEXT_SEARCH = True
+
 # Required by openblockapi.apikey to associate keys with user profiles.
 AUTH_PROFILE_MODULE = 'preferences.Profile'
 
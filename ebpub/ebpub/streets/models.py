@@ -140,7 +140,8 @@ def proper_city(block):
 
 class BlockManager(models.GeoManager):
     def search(self, street, number=None, prefix=None, predir=None,
-               suffix=None, postdir=None, city=None, state=None, zipcode=None):
+               suffix=None, postdir=None, city=None, state=None, zipcode=None,
+               candidates=None):
         """
         Searches the blocks for the given address bits. Returns a list
         of 2-tuples, (block, geocoded_pt).
@@ -154,9 +155,13 @@ class BlockManager(models.GeoManager):
 
         Note we don't enforce parity (even/odd) matching.
         So 3181 would match the block 3180-3188.
+
+        If ``candidates`` is given, it should be a list of Blocks on
+        this street (eg. from :py:meth:`blocks_by_street`), which
+        will be filtered in memory instead of querying the database.
         """
         filters = {'street': street.upper()}
-        sided_filters = []
+        sided_filters = {}
         if predir:
             filters['predir'] = predir.upper()
         if prefix:
@@ -166,23 +171,30 @@ class BlockManager(models.GeoManager):
         if postdir:
             filters['postdir'] = postdir.upper()
         if city:
-            city_filter = Q(left_city=city.upper()) | Q(right_city=city.upper())
-            sided_filters.append(city_filter)
+            sided_filters['city'] = city.upper()
         if state:
-            state_filter = Q(left_state=state.upper()) | Q(right_state=state.upper())
-            sided_filters.append(state_filter)
+            sided_filters['state'] = state.upper()
         if zipcode:
-            zip_filter = Q(left_zip=zipcode) | Q(right_zip=zipcode)
-            sided_filters.append(zip_filter)
+            sided_filters['zip'] = zipcode
+
+        if number:
+            number = int(re.sub(r'\D', '', number))
 
-        qs = self.filter(*sided_filters, **filters)
+        if candidates is None:
+            q_filters = [Q(**{'left_%s' % key: value}) | Q(**{'right_%s' % key: value})
+                         for key, value in sided_filters.items()]
+            qs = self.filter(*q_filters, **filters)
+            if number:
+                qs = qs.filter(from_num__lte=number, to_num__gte=number)
+        else:
+            qs = [block for block in candidates
+                  if _block_matches(block, number, filters, sided_filters)]
 
         # If a number was given, search against the address ranges in the
         # Block table.
         if number:
-            number = int(re.sub(r'\D', '', number))
             block_tuples = []
-            for block in qs.filter(from_num__lte=number, to_num__gte=number):
+            for block in qs:
                 contains, from_num, to_num = block.contains_number(number)
                 if contains:
                     block_tuples.append((block, from_num, to_num))
@@ -200,6 +212,39 @@ class BlockManager(models.GeoManager):
             blocks = list([(b, None) for b in qs])
         return blocks
 
+    def blocks_by_street(self, streets):
+        """
+        Fetches all Blocks on any of the given (UPPERCASE) street
+        names in one query. Returns a dict mapping street name to a
+        list of blocks, suitable for passing as ``candidates`` to
+        :py:meth:`search`.
+        """
+        result = {}
+        streets = set(streets)
+        if streets:
+            for block in self.filter(street__in=streets):
+                result.setdefault(block.street, []).append(block)
+        return result
+
+
+def _block_matches(block, number, filters, sided_filters):
+    """
+    In-memory equivalent of the filters built by BlockManager.search().
+    """
+    for field, value in filters.items():
+        if getattr(block, field) != value:
+            return False
+    for key, value in sided_filters.items():
+        if value not in (getattr(block, 'left_%s' % key),
+                         getattr(block, 'right_%s' % key)):
+            return False
+    if number:
+        if block.from_num is None or block.to_num is None:
+            return False
+        if not (block.from_num <= number <= block.to_num):
+            return False
+    return True
+
 
 class Block(models.Model):
     """Represents a segment of a single street, typically between two
@@ -847,3 +892,12 @@ class Suburb(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+# Keep ebdata.nlp.gazetteer up to date.
+from django.db.models.signals import post_save, post_delete
+from ebpub.db.models import bump_gazetteer_generation
+
+for _model in (Place, PlaceSynonym, PlaceType, Suburb):
+    post_save.connect(bump_gazetteer_generation, sender=_model)
+    post_delete.connect(bump_gazetteer_generation, sender=_model)
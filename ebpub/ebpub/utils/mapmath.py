@@ -135,3 +135,28 @@ def calculate_bounds(center, resolution, size):
 def center(extent):
     return ((extent[2] - extent[0]) / 2 + extent[0],
             (extent[3] - extent[1]) / 2 + extent[1])
+
+# Tiles in the spherical mercator ("Google") scheme used by the
+# richmaps, as in http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+TILE_SIZE = 256
+
+def mercator_y(lat):
+    """
+    Spherical mercator y for a latitude, in units of the earth's radius.
+    """
+    return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+def lat_from_mercator_y(merc_y):
+    return math.degrees(math.atan(math.sinh(merc_y)))
+
+def tile_bounds(zoom, x, y):
+    """
+    Returns the (west, south, east, north) extent, in degrees, of tile
+    x, y at the given zoom.  Tile 0, 0 is the top left.
+    """
+    n = 2 ** zoom
+    west = x * 360.0 / n - 180
+    east = (x + 1) * 360.0 / n - 180
+    north = lat_from_mercator_y(math.pi * (1 - 2.0 * y / n))
+    south = lat_from_mercator_y(math.pi * (1 - 2.0 * (y + 1) / n))
+    return (west, south, east, north)
@@ -16,6 +16,7 @@
 #   along with ebpub.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from django.contrib.gis.geos import Point
 from django.http import Http404
 from django.test import TestCase
 from django.test.testcases import TransactionTestCase
@@ -24,6 +25,7 @@ from ebpub.db.models import Location, LocationType
 from ebpub.streets.models import Block
 from ebpub.utils.view_utils import make_pid
 from ebpub.utils.view_utils import parse_pid
+import datetime
 import unittest
 
 LINESTRING = 'LINESTRING (0.0 0.0, 1.0 1.0)'
@@ -114,6 +116,82 @@ class PidTests(TestCase):
         self.assertEqual(parse_pid(make_pid(loc)),
                          (loc, None, None))
 
+class TestKeysetPagination(TestCase):
+
+    fixtures = ('crimes',)
+
+    ordering = ('-item_date', '-pub_date', '-id')
+
+    def setUp(self):
+        from ebpub.db.models import NewsItem, Schema
+        schema = Schema.objects.get(slug='crime')
+        NewsItem.objects.all().delete()
+        # Several items on the same dates, to exercise the tie-breakers.
+        for i in range(7):
+            NewsItem.objects.create(
+                schema=schema, title='item %d' % i, description='',
+                item_date=datetime.date(2012, 1, 1 + i // 3),
+                pub_date=datetime.datetime(2012, 1, 5, 12, 0, i % 2, 123),
+                location=Point(0, 0))
+        self.expected = list(NewsItem.objects.order_by(*self.ordering))
+
+    def _qs(self):
+        from ebpub.db.models import NewsItem
+        return NewsItem.objects.all()
+
+    def test_token_round_trip(self):
+        from ebpub.db.models import NewsItem
+        from ebpub.utils.view_utils import make_page_token, parse_page_token
+        item = self.expected[0]
+        token = make_page_token(item, self.ordering, 3)
+        self.assertEqual(parse_page_token(token, NewsItem, self.ordering),
+                         ([item.item_date, item.pub_date, item.id], 3))
+
+    def test_parse_page_token__invalid(self):
+        from ebpub.db.models import NewsItem
+        from ebpub.utils.view_utils import encode_page_token, parse_page_token
+        for token in ('', 'oops', encode_page_token(['2012-01-01']),
+                      encode_page_token(['x', 'y', 'z'])):
+            self.assertRaises(ValueError, parse_page_token, token, NewsItem,
+                              self.ordering)
+
+    def test_keyset_paginate(self):
+        from ebpub.utils.view_utils import keyset_paginate
+        def page(**kwargs):
+            return keyset_paginate(self._qs(), self.ordering, pagesize=3, **kwargs)
+
+        items, prev_token, next_token, start, end = page()
+        self.assertEqual(items, self.expected[:3])
+        self.assertEqual((prev_token, start, end), (None, 0, 3))
+
+        items, prev_token, next_token, start, end = page(after=next_token)
+        self.assertEqual(items, self.expected[3:6])
+        self.assertEqual((start, end), (3, 6))
+
+        items, last_prev, next_token, start, end = page(after=next_token)
+        self.assertEqual(items, self.expected[6:])
+        self.assertEqual((next_token, start, end), (None, 6, 7))
+
+        # And back again.
+        items, prev_token, next_token, start, end = page(before=last_prev)
+        self.assertEqual(items, self.expected[3:6])
+        self.assertEqual((start, end), (3, 6))
+        items, prev_token, next_token, start, end = page(before=prev_token)
+        self.assertEqual(items, self.expected[:3])
+        self.assertEqual((prev_token, start, end), (None, 0, 3))
+
+    def test_seek__mixed_directions(self):
+        from ebpub.utils.view_utils import seek
+        ordering = ('item_date', '-pub_date', 'id')
+        expected = list(self._qs().order_by(*ordering))
+        item = expected[2]
+        values = [item.item_date, item.pub_date, item.id]
+        self.assertEqual(list(seek(self._qs(), ordering, values).order_by(*ordering)),
+                         expected[3:])
+        self.assertEqual(list(seek(self._qs(), ordering, values, reverse=True).order_by(*ordering)),
+                         expected[:2])
+
+
 class TestModelUtils(TransactionTestCase):
 
     # For things that mess with the db too much and need to be in a
@@ -17,15 +17,20 @@
 #
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
+from django.utils import simplejson
+from django.utils.http import urlencode
 from ebpub.constants import BLOCK_RADIUS_CHOICES
 from ebpub.constants import BLOCK_RADIUS_DEFAULT
 from ebpub.db.models import Location
 from ebpub.db.models import Schema
 from ebpub.streets.models import Block
+import base64
 import ebpub.db.constants
 
 
@@ -237,3 +242,181 @@ def paginate(qs, page=1, pagesize=ebpub.db.constants.FILTER_PER_PAGE):
         idx_end = idx_start + len(ni_list)
     has_previous = page > 1
     return ni_list, has_previous, has_next, idx_start, idx_end
+
+
+def _ordering_fields(ordering):
+    return [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+def make_page_token(obj, ordering, index=0):
+    """
+    Returns an opaque token identifying the position of ``obj`` in a
+    list sorted by ``ordering``, a sequence of field names as for
+    ``QuerySet.order_by()``.  ``index`` is the number of items
+    before this position, for display.
+
+    See :py:func:`keyset_paginate`.
+    """
+    values = [getattr(obj, name) for (name, descending) in _ordering_fields(ordering)]
+    return encode_page_token(values, index)
+
+def encode_page_token(values, index=0):
+    """
+    Like :py:func:`make_page_token`, given the values of the ordering
+    fields rather than an object.
+    """
+    values = [value if isinstance(value, (int, long)) else unicode(value)
+              for value in values]
+    token = simplejson.dumps([index, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token).rstrip('=')
+
+def parse_page_token(token, model, ordering):
+    """
+    Returns a (values, index) pair from a token made by
+    :py:func:`make_page_token`, converting the values to the types
+    of the ``model``'s fields.  Raises ValueError if it's invalid.
+    """
+    try:
+        token = str(token)
+        token = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        index, values = simplejson.loads(token)
+        fields = _ordering_fields(ordering)
+        if len(values) != len(fields) or not isinstance(index, (int, long)):
+            raise ValueError
+        values = [model._meta.get_field(name).to_python(value)
+                  for ((name, descending), value) in zip(fields, values)]
+    except (TypeError, ValueError, UnicodeError, ValidationError):
+        raise ValueError("Invalid page token %r" % token)
+    return values, index
+
+def seek(qs, ordering, values, reverse=False):
+    """
+    Filters the queryset to the items that come after ``values`` (a
+    list of values of the ``ordering`` fields) when sorted by
+    ``ordering``, or before them if ``reverse`` is True.
+
+    If all the fields sort in the same direction, this is a single
+    row comparison, which can use an index on those columns.
+    """
+    fields = _ordering_fields(ordering)
+    directions = set([descending != reverse for (name, descending) in fields])
+    if len(directions) == 1:
+        meta = qs.model._meta
+        columns = ['%s.%s' % (meta.db_table, meta.get_field(name).column)
+                   for (name, descending) in fields]
+        where = '(%s) %s (%s)' % (', '.join(columns),
+                                  directions.pop() and '<' or '>',
+                                  ', '.join(['%s'] * len(values)))
+        return qs.extra(where=[where], params=values)
+    # Mixed directions: (a > x) OR (a = x AND b < y) OR ...
+    q = Q()
+    for i, (name, descending) in enumerate(fields):
+        kwargs = dict([(fields[j][0], values[j]) for j in range(i)])
+        kwargs[name + ((descending != reverse) and '__lt' or '__gt')] = values[i]
+        q = q | Q(**kwargs)
+    return qs.filter(q)
+
+def keyset_paginate(qs, ordering, after=None, before=None,
+                    pagesize=ebpub.db.constants.FILTER_PER_PAGE):
+    """
+    Keyset pagination: like :py:func:`paginate`, but instead of
+    skipping some number of items with OFFSET, which gets slower for
+    every page, this selects the items that come after (or before) a
+    given item in ``ordering``.  The last field in ``ordering`` should
+    be unique, eg. 'id'.
+
+    ``after`` and ``before`` are tokens from a previous call; pass at
+    most one of them.  Raises ValueError if they're invalid.
+
+    Returns a list of at most ``pagesize`` results, a token for the
+    previous page (or None), a token for the next page (or None),
+    and start and end indexes as for paginate().
+    """
+    qs = qs.order_by(*ordering)
+    if before:
+        values, idx_end = parse_page_token(before, qs.model, ordering)
+        reverse_ordering = [name.startswith('-') and name[1:] or '-' + name
+                            for name in ordering]
+        items = list(seek(qs, ordering, values, reverse=True).order_by(*reverse_ordering)[:pagesize+1])
+        has_previous = len(items) > pagesize
+        items = items[:pagesize]
+        items.reverse()
+        # The indexes may be off if items were added since.
+        idx_start = max(idx_end - len(items), 0)
+        if not has_previous:
+            idx_start = 0
+        idx_end = idx_start + len(items)
+        has_next = True
+    else:
+        idx_start = 0
+        if after:
+            values, idx_start = parse_page_token(after, qs.model, ordering)
+            qs = seek(qs, ordering, values)
+        items = list(qs[:pagesize+1])
+        has_next = len(items) > pagesize
+        items = items[:pagesize]
+        idx_end = idx_start + len(items)
+        has_previous = bool(after)
+    previous_token = next_token = None
+    if items and has_previous:
+        previous_token = make_page_token(items[0], ordering, idx_start)
+    if items and has_next:
+        next_token = make_page_token(items[-1], ordering, idx_end)
+    return items, previous_token, next_token, idx_start, idx_end
+
+def paginate_by_request(request, qs, ordering,
+                        pagesize=ebpub.db.constants.FILTER_PER_PAGE):
+    """
+    Paginates the queryset according to the ``after`` or ``before``
+    query parameters, using :py:func:`keyset_paginate`; or, for old
+    links, the ``page`` parameter, using :py:func:`paginate`.
+
+    Returns a list of results, and a dict for the template context
+    with keys ``has_next``, ``has_previous``, ``next_page_url``,
+    ``previous_page_url``, ``page_start_index``, ``page_end_index``
+    and ``page_number`` (plus ``next_page_number`` and
+    ``previous_page_number``, for older templates).
+
+    Raises ValueError if the parameters are invalid.
+    """
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if after and before:
+        raise ValueError("Can't page both before and after")
+    if 'page' in request.GET and not (after or before):
+        page = int(request.GET['page'])
+        if page < 1:
+            raise ValueError("Invalid page %r" % page)
+        items, has_previous, has_next, idx_start, idx_end = paginate(qs, page, pagesize)
+        previous_token = next_token = None
+        if items and has_previous:
+            previous_token = make_page_token(items[0], ordering, idx_start)
+        if items and has_next:
+            next_token = make_page_token(items[-1], ordering, idx_end)
+    else:
+        items, previous_token, next_token, idx_start, idx_end = keyset_paginate(
+            qs, ordering, after=after, before=before, pagesize=pagesize)
+        has_previous = previous_token is not None or bool(after and not items)
+        has_next = next_token is not None
+
+    def page_url(**params):
+        # Keep other params, sorted like FilterChain.make_url() does.
+        query = [(key, values) for (key, values) in request.GET.lists()
+                 if key not in ('page', 'after', 'before')]
+        query.extend(params.items())
+        return '?' + urlencode(sorted(query), doseq=True)
+
+    page_number = idx_start // pagesize + 1
+    context = {
+        'has_next': has_next,
+        'has_previous': has_previous,
+        'next_page_url': next_token and page_url(after=next_token),
+        # Past the end with ``after``, previous goes back to the start.
+        'previous_page_url': (previous_token and page_url(before=previous_token)
+                              or has_previous and page_url() or None),
+        'page_number': page_number,
+        'previous_page_number': page_number - 1,
+        'next_page_number': page_number + 1,
+        'page_start_index': idx_start + 1,
+        'page_end_index': idx_end,
+    }
+    return items, context
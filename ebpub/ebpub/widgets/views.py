@@ -24,6 +24,7 @@ from django.template.context import RequestContext
 from django.utils import simplejson as json
 from ebpub.accounts.utils import login_required
 from ebpub.db.models import NewsItem
+from ebpub.db.utils import populate_attributes
 from ebpub.widgets.models import Widget, PinnedItem
 from operator import attrgetter
 import datetime
@@ -61,6 +62,8 @@ def render_widget(widget, items=None):
     """
     if items is None:
         items = widget.fetch_items()
+    items = list(items)
+    populate_attributes(items)
     info = {
         'items': [template_context_for_item(x, widget) for x in items],
         'widget': widget
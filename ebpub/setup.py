@@ -107,6 +107,7 @@ setup(
             'import_neighborhoods = ebpub.db.bin.import_hoods:main',
             'import_zips_tiger = ebpub.db.bin.import_zips:main',
             # 'import_zips_esri = ebpub.streets.blockimport.esri.importers.zipcodes:TODO',
+            'rebuild_newsitem_lookups = ebpub.db.bin.rebuild_newsitem_lookups:main',
             'update_aggregates = ebpub.db.bin.update_aggregates:main',
             'populate_streets = ebpub.streets.bin.populate_streets:main',
             'populate_suburbs = ebpub.streets.bin.populate_suburbs:main',